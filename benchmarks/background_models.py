@@ -0,0 +1,106 @@
+"""
+Frames-per-second cost and false-motion rate of each background engine.
+
+Usage:
+    python -m benchmarks.background_models [clip ...] [--vehicle-frames 120:180,400:460]
+
+A frame counts as false motion when a blob bigger than MIN_AREA is found
+outside the frame ranges given with --vehicle-frames. Without clips, a
+synthetic empty road with a lighting change halfway through is used.
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from speedcam.background import BackgroundModel, ENGINES
+from speedcam.processing import RoiProcessor
+from speedcam.sources import FileSource
+
+BOX = (65, 275, 615, 315)  # carspeed.py defaults
+MIN_AREA = 125
+THRESHOLD = 15
+
+
+def synthetic_clip(count=600, width=640, height=480):
+    """
+    An empty, noisy road that suddenly gets darker halfway through.
+    """
+    rng = np.random.RandomState(0)
+    road = rng.randint(60, 180, (height, width, 3)).astype(np.uint8)
+    for i in range(count):
+        gain = 1.0 if i < count // 2 else 0.6
+        image = cv2.convertScaleAbs(road, alpha=gain)
+        noise = rng.randint(-6, 7, image.shape).astype(np.int16)
+        yield np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def clip_frames(path):
+    source = FileSource(path).open()
+    for frame in source.frames():
+        yield frame.image
+    source.close()
+
+
+def parse_ranges(text):
+    ranges = []
+    for part in filter(None, (text or '').split(',')):
+        start, end = part.split(':')
+        ranges.append((int(start), int(end)))
+    return ranges
+
+
+def has_motion(mask):
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    for c in contours:
+        x, y, w, h = cv2.boundingRect(c)
+        if w * h > MIN_AREA:
+            return True
+    return False
+
+
+def measure(engine, frames, vehicle_ranges):
+    """
+    Runs one engine over a list of frames.
+    :return: (frames per second, false-motion rate, rebuilds)
+    """
+    processor = RoiProcessor(BOX, frames[0].shape)
+    model = BackgroundModel(engine, processor.shape, THRESHOLD)
+    elapsed = 0.0
+    idle_frames = 0
+    false_motion = 0
+
+    for index, image in enumerate(frames):
+        start = time.perf_counter()
+        mask = model.apply(processor.prepare(processor.crop(image)))
+        elapsed += time.perf_counter() - start
+
+        if not any(start_frame <= index < end_frame for start_frame, end_frame in vehicle_ranges):
+            idle_frames += 1
+            if has_motion(mask):
+                false_motion += 1
+
+    return len(frames) / elapsed, false_motion / float(max(idle_frames, 1)), model.rebuilds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('clips', nargs='*')
+    parser.add_argument('--vehicle-frames', help="frame ranges containing vehicles, e.g. 120:180,400:460")
+    args = parser.parse_args()
+
+    vehicle_ranges = parse_ranges(args.vehicle_frames)
+    clips = [(path, list(clip_frames(path))) for path in args.clips] or [('synthetic', list(synthetic_clip()))]
+
+    for name, frames in clips:
+        print("{0}: {1} frames".format(name, len(frames)))
+        for engine in ENGINES:
+            fps, false_rate, rebuilds = measure(engine, frames, vehicle_ranges)
+            print("  {0:<16} {1:8.0f} FPS   false motion {2:6.2%}   rebuilds {3}".format(
+                engine, fps, false_rate, rebuilds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Cost per frame of the original findContours loop versus BlobExtractor, in microseconds, by number of noise specks.
+
+Usage:
+    python -m benchmarks.blob_extraction [--calls N] [--width W] [--height H]
+"""
+
+import argparse
+import timeit
+
+import cv2
+import numpy as np
+
+from speedcam.blobs import BlobExtractor
+
+
+def contour_boxes(mask, min_area=125):
+    """
+    The previous contour stage of the detector.
+    """
+    boxes = []
+    contours = []
+    for c in cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]:
+        (x, y, w, h) = cv2.boundingRect(c)
+        if w * h > min_area:
+            boxes.append((x, y, w, h))
+            contours.append(c)
+    return boxes, contours
+
+
+def motion_mask(width, height, specks, seed=0):
+    """
+    A motion mask of the monitored area with one car and some 2x2 specks of noise.
+    """
+    rng = np.random.RandomState(seed)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.rectangle(mask, (width // 4, height // 4), (width // 4 + 60, height * 3 // 4), 255, -1)
+    for _ in range(specks):
+        x, y = rng.randint(0, width - 2), rng.randint(0, height - 2)
+        mask[y:y + 2, x:x + 2] = 255
+    return mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--width', type=int, default=550)
+    parser.add_argument('--height', type=int, default=40)
+    args = parser.parse_args()
+
+    extractor = BlobExtractor((args.height, args.width))
+    print("{0:>7} {1:>12} {2:>12}".format('specks', 'contours', 'blobs'))
+    for specks in (0, 10, 50, 200, 1000):
+        mask = motion_mask(args.width, args.height, specks)
+        assert len(contour_boxes(mask)[0]) == len(extractor.find(mask)[1])
+        timings = []
+        for call in (lambda: contour_boxes(mask), lambda: extractor.find(mask)):
+            seconds = min(timeit.repeat(call, number=args.calls, repeat=3)) / args.calls
+            timings.append(seconds * 1e6)
+        print("{0:>7} {1:9.1f} us {2:9.1f} us".format(specks, *timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Cost per call of the original grab_rgb versus contour_colour, in microseconds.
+
+Usage:
+    python -m benchmarks.colour_extraction [--calls N]
+"""
+
+import argparse
+import timeit
+
+import cv2
+import numpy as np
+
+from speedcam.colour import contour_colour, MEAN, MEDIAN, DOMINANT
+
+
+def grab_rgb(image, c):
+    """
+    The original full-frame implementation from carspeed.py.
+    """
+    pixels = []
+    mask = np.zeros_like(image)
+    cv2.drawContours(mask, c, -1, color=255, thickness=-1)
+    points = zip(*np.where(mask == 255))
+    for point in points:
+        pixel = (image[point[1], point[0]])
+        pixel = pixel.tolist()
+        pixels.append(pixel)
+    pixels = [tuple(l) for l in pixels]
+    car_color = (pixels[1])
+    return '{0},{1},{2}'.format(car_color[0], car_color[1], car_color[2])
+
+
+def vehicle_scene(width=640, height=480):
+    """
+    A 640x480 frame with a car-sized blob, and its contour.
+    """
+    image = np.random.RandomState(0).randint(0, 255, (height, width, 3)).astype(np.uint8)
+    cv2.rectangle(image, (200, 280), (320, 310), (30, 60, 180), -1)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.rectangle(mask, (200, 280), (320, 310), 255, -1)
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    return image, contours[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+
+    image, contour = vehicle_scene()
+    cases = [
+        ('grab_rgb', lambda: grab_rgb(image, contour)),
+        (MEAN, lambda: contour_colour(image, contour, MEAN)),
+        (MEDIAN, lambda: contour_colour(image, contour, MEDIAN)),
+        (DOMINANT, lambda: contour_colour(image, contour, DOMINANT)),
+    ]
+    for name, call in cases:
+        seconds = min(timeit.repeat(call, number=args.calls, repeat=3)) / args.calls
+        print("{0:<10} {1:10.1f} us/call   -> {2}".format(name, seconds * 1e6, call()))
+
+
+if __name__ == '__main__':
+    main()
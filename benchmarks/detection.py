@@ -0,0 +1,344 @@
+"""
+Throughput and accuracy of the whole detection pipeline against ground truth.
+
+Usage:
+    python -m benchmarks.detection [manifest.json ...] [--output results.json] [--compare baseline.json]
+
+Each manifest describes one recorded clip and the vehicles in it:
+
+    {"video": "clip.mp4",
+     "vehicles": [{"time": 12.4, "speed": 31.0, "direction": "ltr"}, ...]}
+
+where time is the number of seconds into the clip at which the vehicle is
+inside the monitored area, and direction is "ltr" or "rtl". A manifest may
+also give the clip's "monitored_area", "resolution" and "field_of_view", as
+those written by python -m speedcam.synthetic do; otherwise the defaults of
+speedcam.config apply, as to every other setting. Without manifests,
+clips of traffic with known speeds are generated by speedcam.synthetic.
+
+Reported per clip and overall: frames per second, per-frame p50/p99
+latency, peak memory, recall, precision and speed error. --output stores
+the results as JSON; --compare checks them against a stored run and exits
+non-zero on a regression.
+
+The motion gate is on, as in the application, and the fraction of frames
+it skipped is reported; --no-gate takes it out. --audit-gate runs the full
+pipeline on every frame regardless and reports the gate's miss rate: the
+fraction of the frames it would have skipped in which the full pipeline
+found something. --scale 0.5 detects at half resolution.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from speedcam.background import ENGINES
+from speedcam.config import Config
+from speedcam.detector import Detector
+from speedcam.sources import FileSource
+from speedcam.synthetic import TrafficGenerator
+from speedcam.tracker import LEFT_TO_RIGHT
+
+START_TIME = datetime.datetime(2016, 1, 1, 12, 0, 0)
+
+# How much worse than the baseline a run may be before --compare fails
+TOLERANCES = OrderedDict([
+    ('fps', -0.15),  # relative
+    ('p99_ms', 0.5),  # relative
+    ('peak_memory_bytes', 0.25),  # relative
+    ('recall', -0.02),  # absolute
+    ('precision', -0.02),  # absolute
+    ('mean_abs_speed_error', 0.5),  # absolute, mph
+])
+
+
+def synthetic_clip(config, fps, duration=120.0, seed=0):
+    """
+    Traffic in both directions from speedcam.synthetic, the ground truth of the soak test and of
+    frame_source 'synthetic' too, drawn at the config's frame size, monitored area and calibration.
+    :param config: Config
+    :param fps: frame rate of the clip
+    :param duration: seconds of traffic
+    :param seed: of the traffic and the noise
+    :return: (function returning a fresh generator of the frames, list of truth dicts)
+    """
+    def generator():
+        return TrafficGenerator(config.image_width, config.image_height, fps, config.monitored_area,
+                                config.field_of_view, config.ltr_distance, config.rtl_distance,
+                                duration=duration, seed=seed)
+
+    def frames():
+        for image, _ in generator().frames():
+            yield image
+
+    # the generator only knows each vehicle once it is drawn, so draw the clip once for the truth
+    drawn = generator()
+    for _ in drawn.frames():
+        pass
+    return frames, drawn.manifest()['vehicles']
+
+
+def synthetic_clips(config):
+    clips = []
+    for index, fps in enumerate((30.0, 15.0)):
+        frames, truth = synthetic_clip(config, fps, seed=index)
+        clips.append(('synthetic-{0:.0f}fps'.format(fps), frames, fps, truth, config))
+    return clips
+
+
+def load_manifest(path, config):
+    """
+    :param config: Config of the settings the manifest doesn't give
+    :return: (name, function returning a fresh generator of the frames, fps, truth, Config of the clip)
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    video = os.path.join(os.path.dirname(path), manifest['video'])
+    source = FileSource(video).open()
+    fps = source.framerate
+    source.close()
+
+    def frames():
+        source = FileSource(video).open()
+        try:
+            for frame in source.frames():
+                yield frame.image
+        finally:
+            source.close()
+
+    geometry = {}
+    if 'monitored_area' in manifest:
+        geometry['monitored_area'] = tuple(manifest['monitored_area'])
+    if 'resolution' in manifest:
+        geometry['image_width'], geometry['image_height'] = manifest['resolution']
+    if 'field_of_view' in manifest:
+        geometry['field_of_view'] = manifest['field_of_view']
+    return os.path.basename(path), frames, fps, manifest['vehicles'], Config(**dict(config.as_dict(), **geometry))
+
+
+def run_clip(frames, fps, config, audit_gate=False):
+    """
+    Runs the detector over a clip, built as the application builds it.
+    :param frames: function returning a generator of the clip's frames
+    :param config: Config of the clip
+    :param audit_gate: see Detector
+    :return: (list of per-frame seconds, list of detection dicts, the Detector)
+    """
+    detector = None
+    timings = []
+    detections = []
+    for index, image in enumerate(frames()):
+        if detector is None:
+            detector = Detector.from_config(config, tuple(config.monitored_area), image.shape, audit_gate=audit_gate)
+        timestamp = START_TIME + datetime.timedelta(seconds=index / fps)
+        start = time.perf_counter()
+        result = detector.process(image, timestamp)
+        timings.append(time.perf_counter() - start)
+
+        for vehicle in result.vehicles:
+            track = vehicle.track
+            detections.append(dict(
+                first=(track.first_seen - START_TIME).total_seconds(),
+                last=(track.last_seen - START_TIME).total_seconds(),
+                speed=vehicle.estimate.mph,
+                confidence=vehicle.estimate.confidence,
+                direction='ltr' if track.direction == LEFT_TO_RIGHT else 'rtl'))
+    return timings, detections, detector
+
+
+def peak_memory(frames, fps, config, audit_gate=False):
+    """
+    Peak bytes allocated while running the detector over a clip. Includes the buffers
+    and the frame being decoded or generated, and for a synthetic clip the generator's
+    noise field, which are the same from run to run.
+    """
+    tracemalloc.start()
+    run_clip(frames, fps, config, audit_gate)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def match(truth, detections, slack=1.0):
+    """
+    Pairs each true vehicle with at most one detection in the same direction whose track spans its time.
+    :param slack: seconds a track may start after or end before the true time
+    :return: list of (truth, detection) pairs
+    """
+    pairs = []
+    unused = list(detections)
+    for vehicle in sorted(truth, key=lambda v: v['time']):
+        candidates = [d for d in unused if d['direction'] == vehicle['direction'] and
+                      d['first'] - slack <= vehicle['time'] <= d['last'] + slack]
+        if candidates:
+            best = min(candidates, key=lambda d: abs((d['first'] + d['last']) / 2.0 - vehicle['time']))
+            unused.remove(best)
+            pairs.append((vehicle, best))
+    return pairs
+
+
+def score(timings, detections, truth, peak, detector):
+    """
+    :return: OrderedDict of throughput, accuracy and gate figures
+    """
+    timings = np.array(timings[1:])  # the first frame builds the background
+    pairs = match(truth, detections)
+    errors = np.array([d['speed'] - v['speed'] for v, d in pairs]) if pairs else np.zeros(0)
+    gated = detector.gated_frames
+    return OrderedDict([
+        ('frames', len(timings) + 1),
+        ('fps', len(timings) / timings.sum()),
+        ('p50_ms', float(np.percentile(timings, 50) * 1000.0)),
+        ('p99_ms', float(np.percentile(timings, 99) * 1000.0)),
+        ('peak_memory_bytes', peak),
+        ('vehicles', len(truth)),
+        ('detections', len(detections)),
+        ('matched', len(pairs)),
+        ('recall', len(pairs) / float(len(truth)) if truth else 1.0),
+        ('precision', len(pairs) / float(len(detections)) if detections else 1.0),
+        ('mean_abs_speed_error', float(np.abs(errors).mean()) if len(errors) else 0.0),
+        ('max_abs_speed_error', float(np.abs(errors).max()) if len(errors) else 0.0),
+        ('speed_bias', float(errors.mean()) if len(errors) else 0.0),
+        ('gated_frames', gated),
+        ('gate_misses', detector.gate_misses),
+        ('gate_miss_rate', detector.gate_misses / float(gated) if gated else 0.0),
+    ])
+
+
+def overall(results):
+    """
+    Pools the per-clip figures: throughput weighted by frames, accuracy by vehicles.
+    """
+    frames = sum(r['frames'] for r in results)
+    vehicles = sum(r['vehicles'] for r in results)
+    detections = sum(r['detections'] for r in results)
+    matched = sum(r['matched'] for r in results)
+    gated = sum(r['gated_frames'] for r in results)
+    misses = sum(r['gate_misses'] for r in results)
+    return OrderedDict([
+        ('frames', frames),
+        ('fps', sum(r['fps'] * r['frames'] for r in results) / frames),
+        ('p50_ms', sum(r['p50_ms'] * r['frames'] for r in results) / frames),
+        ('p99_ms', max(r['p99_ms'] for r in results)),
+        ('peak_memory_bytes', max(r['peak_memory_bytes'] for r in results)),
+        ('vehicles', vehicles),
+        ('detections', detections),
+        ('matched', matched),
+        ('recall', matched / float(vehicles) if vehicles else 1.0),
+        ('precision', matched / float(detections) if detections else 1.0),
+        ('mean_abs_speed_error', sum(r['mean_abs_speed_error'] * r['matched'] for r in results) / max(matched, 1)),
+        ('max_abs_speed_error', max(r['max_abs_speed_error'] for r in results)),
+        ('gated_frames', gated),
+        ('gate_misses', misses),
+        ('gate_miss_rate', misses / float(gated) if gated else 0.0),
+    ])
+
+
+def compare(current, baseline):
+    """
+    :return: list of regressions, as printable strings
+    """
+    regressions = []
+    for name, tolerance in TOLERANCES.items():
+        now, then = current[name], baseline[name]
+        if name == 'peak_memory_bytes' and not (now and then):
+            continue  # one of the runs skipped the memory pass
+        relative = name in ('fps', 'p99_ms', 'peak_memory_bytes')
+        change = (now - then) / then if relative and then else now - then
+        if (tolerance < 0 and change < tolerance) or (tolerance > 0 and change > tolerance):
+            regressions.append("{0}: {1:.4g} -> {2:.4g}".format(name, then, now))
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('manifests', nargs='*')
+    parser.add_argument('--config', help="JSON file of settings, see speedcam.config.DEFAULTS")
+    parser.add_argument('--threshold', type=int)
+    parser.add_argument('--min-area', type=int)
+    parser.add_argument('--blur', type=int)
+    parser.add_argument('--engine', choices=ENGINES)
+    parser.add_argument('--no-gate', action='store_true', help="take the motion gate out of the pipeline")
+    parser.add_argument('--audit-gate', action='store_true', help="measure the gate's misses")
+    parser.add_argument('--gate-levels', type=int)
+    parser.add_argument('--scale', type=float, help="detection resolution, e.g. 0.5")
+    parser.add_argument('--no-memory', action='store_true', help="skip the slower peak-memory pass")
+    parser.add_argument('--output', help="store the results in this JSON file")
+    parser.add_argument('--compare', help="fail if worse than the results stored in this JSON file")
+    args = parser.parse_args()
+
+    settings = dict(threshold=args.threshold, min_area=args.min_area,
+                    blur_size=(args.blur, args.blur) if args.blur else None, background_engine=args.engine,
+                    motion_gate=False if args.no_gate else None, gate_levels=args.gate_levels,
+                    detection_scale=args.scale)
+    settings = dict((name, value) for name, value in settings.items() if value is not None)
+    config = Config.load(args.config, **settings) if args.config else Config(**settings)
+    if args.audit_gate and not config.motion_gate:
+        parser.error("--audit-gate needs the motion gate")
+    clips = [load_manifest(path, config) for path in args.manifests] or synthetic_clips(config)
+
+    results = OrderedDict()
+    for name, frames, fps, truth, clip_config in clips:
+        timings, detections, detector = run_clip(frames, fps, clip_config, args.audit_gate)
+        peak = 0 if args.no_memory else peak_memory(frames, fps, clip_config, args.audit_gate)
+        results[name] = score(timings, detections, truth, peak, detector)
+
+    summary = overall(list(results.values()))
+    print("{0:<22} {1:>7} {2:>8} {3:>8} {4:>9} {5:>7} {6:>9} {7:>10}".format(
+        'clip', 'FPS', 'p50 ms', 'p99 ms', 'peak KiB', 'recall', 'precision', 'speed err'))
+    for name, r in list(results.items()) + [('overall', summary)]:
+        print("{0:<22} {1:7.0f} {2:8.3f} {3:8.3f} {4:9.0f} {5:7.1%} {6:9.1%} {7:6.2f} mph".format(
+            name, r['fps'], r['p50_ms'], r['p99_ms'], r['peak_memory_bytes'] / 1024.0, r['recall'],
+            r['precision'], r['mean_abs_speed_error']))
+    if config.motion_gate:
+        print("Gate: skipped {0:.1%} of frames".format(summary['gated_frames'] / float(summary['frames'])) +
+              (", missed motion in {0:.2%} of those".format(summary['gate_miss_rate']) if args.audit_gate else ""))
+    print("Process peak RSS: {0:.0f} MiB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+    stored = config.as_dict()
+    stored.pop('database_url')  # may hold a password
+    stored['audit_gate'] = args.audit_gate
+    run = OrderedDict([
+        ('time', datetime.datetime.now().isoformat()),
+        ('revision', git_revision()),
+        ('opencv', cv2.__version__),
+        ('config', stored),
+        ('overall', summary),
+        ('clips', results),
+    ])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(summary, baseline['overall'])
+        if regressions:
+            print("Regressions against {0} ({1}):".format(args.compare, baseline.get('revision')))
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("No regressions against {0} ({1})".format(args.compare, baseline.get('revision')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Checks that vehicles arriving while the camera idles are still measured.
+
+Usage:
+    python -m benchmarks.idle [--speed 50] [--fps 5] [--vehicles 20]
+
+While the monitored area is empty the camera drops to the idle frame rate,
+and the first frames of the next vehicle are captured at that rate, until
+the motion they show switches the camera back to day_fps. Vehicles at
+idle_design_speed are generated in both directions, each arriving at a
+different phase of the frame clock, and run through the detector under a
+RateController idling at the rate SpeedCamera derives from the default
+config. Exits non-zero if any of them is missed. --speed and --fps try
+other speeds and idle rates.
+"""
+
+import argparse
+import datetime
+import sys
+
+import numpy as np
+
+from speedcam.app import SpeedCamera
+from speedcam.config import Config
+from speedcam.detector import Detector
+from speedcam.rate import RateController
+from speedcam.synthetic import TrafficGenerator
+
+START_TIME = datetime.datetime(2016, 1, 1, 12, 0, 0)
+CLOCK_FPS = 60  # traffic is rendered this often; the controller's rate picks which frames are captured
+
+
+class Camera(object):
+    """
+    Stands in for the frame source, remembering the rate the controller sets.
+    """
+
+    def __init__(self):
+        self.framerate = None
+
+    def set_framerate(self, framerate):
+        self.framerate = framerate
+
+
+def measured(config, idle_fps, mph, vehicles, seed=0):
+    """
+    :return: (true vehicles, list of (truth, idle on arrival, measured mph or None))
+    """
+    # one vehicle at a time, several seconds apart, so most arrive at an idle camera
+    generator = TrafficGenerator(config.image_width, config.image_height, CLOCK_FPS, config.monitored_area,
+                                 config.field_of_view, config.ltr_distance, config.rtl_distance,
+                                 vehicles_per_minute=6.0, speeds=(mph, mph), duration=vehicles * 5.0, seed=seed)
+    controller = RateController(Camera(), config.day_fps, config.night_fps, idle_fps, config.idle_after)
+    detector = None
+    detections = []
+    rates = []
+    due = 0.0
+    for image, seconds in generator.frames():
+        if seconds < due - 1e-6:
+            continue
+        if detector is None:
+            detector = Detector.from_config(config, config.monitored_area, image.shape)
+        timestamp = START_TIME + datetime.timedelta(seconds=seconds)
+        result = detector.process(image, timestamp)
+        detections.extend(((v.track.last_seen - START_TIME).total_seconds(), v.estimate.mph)
+                          for v in result.vehicles)
+        # a camera applies a new rate after the frame it is already exposing, so the next frame still
+        # comes at the previous rate
+        interval = 1.0 / (controller.framerate or config.day_fps)
+        framerate = controller.update(timestamp, detector.background.brightness, bool(result.boxes))
+        rates.append((seconds, framerate))
+        due = seconds + interval
+
+    truth = generator.manifest()['vehicles']
+    results = []
+    for vehicle in truth:
+        idle = [rate for seconds, rate in rates if seconds <= vehicle['entered']][-1:] == [idle_fps]
+        found = [mph for last, mph in detections if vehicle['entered'] - 0.5 <= last <= vehicle['left'] + 0.5]
+        results.append((vehicle, idle, found[0] if found else None))
+    return truth, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--speed', type=float, help="mph of every vehicle; by default idle_design_speed")
+    parser.add_argument('--fps', type=float, help="idle frame rate; by default the one SpeedCamera derives")
+    parser.add_argument('--vehicles', type=int, default=20, help="about this many in each direction")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config = Config()
+    fps = args.fps or SpeedCamera(config).idle_fps()
+    mph = args.speed or config.idle_design_speed
+    truth, results = measured(config, fps, mph, args.vehicles, args.seed)
+    idle = [(vehicle, speed) for vehicle, arrived_idle, speed in results if arrived_idle]
+    missed = [vehicle for vehicle, speed in idle if speed is None]
+    errors = np.array([speed - vehicle['speed'] for vehicle, speed in idle if speed is not None])
+
+    print("{0} vehicles at {1:.0f} MPH, {2} arriving while idling at {3:.1f} FPS: {4} measured, {5} missed{6}".format(
+        len(truth), mph, len(idle), fps, len(idle) - len(missed), len(missed),
+        ", speed error {0:.2f} mph".format(np.abs(errors).mean()) if len(errors) else ""))
+    if missed or not idle:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
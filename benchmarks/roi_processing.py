@@ -0,0 +1,128 @@
+"""
+Per-frame latency of the original full-frame processing versus RoiProcessor.
+
+Usage:
+    python -m benchmarks.roi_processing [video_file] [--frames N] [--rotation DEG]
+
+Without a video file, synthetic 640x480 frames with a moving block are used.
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from speedcam.background import BackgroundModel, RUNNING_AVERAGE
+from speedcam.processing import RoiProcessor
+from speedcam.sources import FileSource
+
+BOX = (65, 275, 615, 315)  # carspeed.py defaults
+BLUR_SIZE = (15, 15)
+THRESHOLD = 15
+
+
+def synthetic_frames(count, width=640, height=480):
+    """
+    Generates noisy frames with a block driving through the monitored area.
+    """
+    rng = np.random.RandomState(0)
+    background = rng.randint(0, 255, (height, width, 3)).astype(np.uint8)
+    for i in range(count):
+        image = background.copy()
+        x = (i * 7) % width
+        cv2.rectangle(image, (x, 280), (x + 80, 310), (40, 40, 200), -1)
+        yield image
+
+
+def legacy_step(image, base_image, rotation_degrees):
+    """
+    The per-frame processing as carspeed.py originally did it.
+    """
+    rows, cols, placeholder = image.shape
+    M = cv2.getRotationMatrix2D((cols / 2, rows / 2), rotation_degrees, 1)
+    image = cv2.warpAffine(image, M, (cols, rows))
+    x1, y1, x2, y2 = BOX
+    gray = image[y1:y2, x1:x2]
+    gray = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
+    gray = cv2.GaussianBlur(gray, BLUR_SIZE, 0)
+    if base_image is None:
+        return gray.copy().astype("float")
+    frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(base_image))
+    thresh = cv2.threshold(frameDelta, THRESHOLD, 255, cv2.THRESH_BINARY)[1]
+    thresh = cv2.dilate(thresh, None, iterations=2)
+    cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cv2.accumulateWeighted(gray, base_image, 0.05)
+    return base_image
+
+
+def run_legacy(frames, rotation_degrees):
+    base_image = None
+    timings = []
+    for image in frames:
+        start = time.perf_counter()
+        base_image = legacy_step(image, base_image, rotation_degrees)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_roi(frames, rotation_degrees):
+    processor = None
+    model = None
+    timings = []
+    for image in frames:
+        start = time.perf_counter()
+        if processor is None:
+            processor = RoiProcessor(BOX, image.shape, rotation_degrees, BLUR_SIZE)
+            model = BackgroundModel(RUNNING_AVERAGE, processor.shape, THRESHOLD, learning_rate=0.05)
+        mask = model.apply(processor.prepare(processor.crop(image)))
+        cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def peak_allocation(runner, frames, rotation_degrees):
+    """
+    Peak bytes allocated by the processing itself, buffers included.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    runner(frames, rotation_degrees)
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return peak
+
+
+def summarize(name, timings):
+    timings = np.array(timings[1:]) * 1000.0  # skip the frame that builds the background
+    print("{0:<8} mean {1:6.3f} ms   p50 {2:6.3f} ms   p99 {3:6.3f} ms   ({4:.0f} FPS)".format(
+        name, timings.mean(), np.percentile(timings, 50), np.percentile(timings, 99), 1000.0 / timings.mean()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('video', nargs='?', help="recorded clip to use instead of synthetic frames")
+    parser.add_argument('--frames', type=int, default=500)
+    parser.add_argument('--rotation', type=float, default=0)
+    args = parser.parse_args()
+
+    if args.video:
+        source = FileSource(args.video).open()
+        frames = [frame.image for frame, _ in zip(source.frames(), range(args.frames))]
+        source.close()
+    else:
+        frames = list(synthetic_frames(args.frames))
+
+    print("{0} frames of {1}x{2}, rotation {3}".format(len(frames), frames[0].shape[1], frames[0].shape[0],
+                                                         args.rotation))
+    summarize('legacy', run_legacy(frames, args.rotation))
+    summarize('roi', run_roi(frames, args.rotation))
+
+    for name, runner in (('legacy', run_legacy), ('roi', run_roi)):
+        peak = peak_allocation(runner, frames[:50], args.rotation)
+        print("{0:<8} peak allocation over 50 frames: {1} bytes".format(name, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Load, heavy-traffic and soak test of the whole camera on synthetic traffic.
+
+Usage:
+    python -m benchmarks.soak [--resolution 1920x1080] [--fps 60] [--minutes 5] [--traffic 20]
+                              [--realtime] [--evidence] [--output results.json]
+
+Runs SpeedCamera, capture thread, queue, detection, writer and spool
+included, on frames from speedcam.synthetic, then checks the spooled
+vehicles against the generator's ground truth. Unthrottled it measures the
+highest frame rate the pipeline sustains at a resolution; with --realtime
+frames arrive at --fps like from a camera, and dropped frames show where it
+falls behind. --traffic raises the vehicles per minute in each direction to
+load the tracker; --minutes 60 or more, with --realtime, is a soak run,
+where the resident memory should stay flat.
+
+Reported: frames per second, dropped frames, recall, precision, speed
+error, and resident memory at the start, at the end and its growth per hour
+after the first minute.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from speedcam.app import SpeedCamera
+from speedcam.config import Config
+from speedcam.spool import Spool, VEHICLES
+from speedcam.synthetic import REFERENCE_WIDTH, scaled_area
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def resident_bytes():
+    """
+    :return: resident memory of this process now, or its peak where /proc is missing
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the resident memory every few seconds.
+    """
+
+    def __init__(self, interval=5.0):
+        super(MemorySampler, self).__init__(name='memory-sampler')
+        self.daemon = True
+        self.interval = interval
+        self.samples = []  # (seconds since start, bytes)
+        self._stopping = threading.Event()
+        self.origin = time.time()
+
+    def run(self):
+        while True:
+            self.samples.append((time.time() - self.origin, resident_bytes()))
+            if self._stopping.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+        self.samples.append((time.time() - self.origin, resident_bytes()))
+
+    def growth_per_hour(self, settle=60.0):
+        """
+        :param settle: seconds ignored at the start, while buffers and caches fill
+        :return: least-squares slope of the samples after settling, bytes per hour
+        """
+        samples = [s for s in self.samples if s[0] >= settle]
+        if len(samples) < 3:
+            return 0.0
+        seconds, sizes = np.array(samples, dtype=float).T
+        return float(np.polyfit(seconds, sizes, 1)[0] * 3600.0)
+
+
+def spooled_vehicles(path, start_time):
+    """
+    :return: list of detection dicts: seconds into the run the track was last seen, speed and direction
+    """
+    spool = Spool(path)
+    try:
+        records = spool.pending(10 ** 9)
+    finally:
+        spool.close()
+    return [dict(last=(row['datetime'] - start_time).total_seconds(), speed=row['speed'],
+                 direction='ltr' if row['direction'] == 'North' else 'rtl')
+            for _, kind, row in records if kind == VEHICLES]
+
+
+def match(truth, detections, slack=0.5):
+    """
+    Pairs each true vehicle with at most one detection in the same direction last seen while it was in
+    the monitored area, the earliest: vehicles never overtake in the generated traffic, so each lane is
+    first in, first out.
+    :param slack: seconds before it entered or after it left that still count
+    :return: list of (truth, detection) pairs
+    """
+    pairs = []
+    unused = list(detections)
+    for vehicle in sorted(truth, key=lambda v: v['left']):
+        candidates = [d for d in unused if d['direction'] == vehicle['direction'] and
+                      vehicle['entered'] - slack <= d['last'] <= vehicle['left'] + slack]
+        if candidates:
+            best = min(candidates, key=lambda d: d['last'])
+            unused.remove(best)
+            pairs.append((vehicle, best))
+    return pairs
+
+
+def run(args, directory):
+    """
+    :return: OrderedDict of results
+    """
+    width, height = (int(v) for v in args.resolution.lower().split('x'))
+    scale = width / float(REFERENCE_WIDTH)
+    manifest_path = os.path.join(directory, 'synthetic.json')
+    config = Config(
+        frame_source='synthetic', replay_realtime=args.realtime, image_width=width, image_height=height,
+        day_fps=args.fps, night_fps=args.fps, idle_fps=args.fps, monitored_area=scaled_area(width, height),
+        min_area=int(125 * scale * scale), track_max_distance=int(120 * scale),
+        synthetic_vehicles_per_minute=args.traffic, synthetic_light_period=args.light_period,
+        synthetic_light_steps_per_minute=args.clouds, synthetic_duration=args.minutes * 60.0,
+        synthetic_seed=args.seed, synthetic_manifest_path=manifest_path,
+        dry_run=True, spool_path=os.path.join(directory, 'spool.db'), use_x=False, status_mode='none',
+        metrics_prometheus_path=None, metrics_json_path=None, evidence_enabled=args.evidence,
+        evidence_dir=os.path.join(directory, 'evidence'), speed_threshold=args.speed_threshold)
+
+    sampler = MemorySampler(args.sample_seconds)
+    sampler.start()
+    camera = SpeedCamera(config)
+    camera.start()
+    try:
+        camera.run()
+        seconds, fps = camera.meter.elapsed(), camera.meter.fps()  # before stopping, which takes a while
+    finally:
+        camera.stop()
+    sampler.stop()
+
+    with open(manifest_path) as f:
+        truth = json.load(f)['vehicles']
+    detections = spooled_vehicles(config.spool_path, camera.camera.start_time)
+    pairs = match(truth, detections)
+    errors = np.array([d['speed'] - v['speed'] for v, d in pairs]) if pairs else np.zeros(0)
+    queue = camera.frame_queue.stats()
+    generated = camera.camera.generator.index
+    return OrderedDict([
+        ('resolution', [width, height]),
+        ('fps_target', args.fps),
+        ('realtime', args.realtime),
+        ('seconds', seconds),
+        ('frames_generated', generated),
+        ('frames_processed', camera.meter.frames),
+        ('fps', fps),
+        ('dropped', queue['dropped']),
+        ('dropped_fraction', queue['dropped'] / float(generated) if generated else 0.0),
+        ('vehicles', len(truth)),
+        ('detections', len(detections)),
+        ('matched', len(pairs)),
+        ('recall', len(pairs) / float(len(truth)) if truth else 1.0),
+        ('precision', len(pairs) / float(len(detections)) if detections else 1.0),
+        ('mean_abs_speed_error', float(np.abs(errors).mean()) if len(errors) else 0.0),
+        ('rss_start_bytes', sampler.samples[0][1]),
+        ('rss_end_bytes', sampler.samples[-1][1]),
+        ('rss_peak_bytes', max(size for _, size in sampler.samples)),
+        ('rss_growth_bytes_per_hour', sampler.growth_per_hour()),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--resolution', default='640x480', help="WIDTHxHEIGHT")
+    parser.add_argument('--fps', type=float, default=30.0)
+    parser.add_argument('--minutes', type=float, default=1.0)
+    parser.add_argument('--traffic', type=float, default=6.0, help="vehicles per minute in each direction")
+    parser.add_argument('--light-period', type=float, help="seconds of a full day-night cycle")
+    parser.add_argument('--clouds', type=float, default=0.0, help="sudden changes of light per minute")
+    parser.add_argument('--realtime', action='store_true', help="deliver frames at --fps, like a camera")
+    parser.add_argument('--evidence', action='store_true', help="record evidence of speeders too")
+    parser.add_argument('--speed-threshold', type=float, default=40)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sample-seconds', type=float, default=5.0, help="between memory samples")
+    parser.add_argument('--keep', help="keep the spool, manifest and evidence in this directory")
+    parser.add_argument('--output', help="store the results in this JSON file")
+    args = parser.parse_args()
+
+    directory = args.keep or tempfile.mkdtemp(prefix='speedcam-soak-')
+    if args.keep and not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        results = run(args, directory)
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print("{0}x{1}: {2:.1f} FPS over {3:.0f}s, {4} of {5} frames dropped ({6:.1%})".format(
+        results['resolution'][0], results['resolution'][1], results['fps'], results['seconds'],
+        results['dropped'], results['frames_generated'], results['dropped_fraction']))
+    print("Vehicles: {0} true, {1} detected; recall {2:.1%}, precision {3:.1%}, speed error {4:.2f} mph".format(
+        results['vehicles'], results['detections'], results['recall'], results['precision'],
+        results['mean_abs_speed_error']))
+    print("Resident memory: {0:.0f} MiB at start, {1:.0f} MiB at end, {2:+.1f} MiB/hour after the first minute".format(
+        results['rss_start_bytes'] / 2.0 ** 20, results['rss_end_bytes'] / 2.0 ** 20,
+        results['rss_growth_bytes_per_hour'] / 2.0 ** 20))
+
+    if args.output:
+        results['time'] = datetime.datetime.now().isoformat()
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
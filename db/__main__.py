@@ -0,0 +1,39 @@
+"""
+Database maintenance commands.
+
+    python -m db dedupe                        remove duplicate rows written before track keys existed
+    python -m db backfill-rollups              rebuild the dashboard rollups from all vehicles
+    python -m db partition                     move an unpartitioned vehicles table into monthly partitions
+    python -m db export DIRECTORY [--detach]   write closed monthly partitions to Parquet files
+
+The database is $SPEEDCAM_DATABASE_URL, or the default in db.DEFAULT_URL.
+"""
+
+import sys
+
+from db import backfill_rollups, ensure_schema, get_engine, remove_duplicate_speeds
+from db.partitions import export_closed_partitions, migrate_to_partitions
+
+
+def main(argv):
+    engine = get_engine()
+    if argv == ['dedupe']:
+        ensure_schema(engine)
+        print("Removed {0} duplicate vehicles.".format(remove_duplicate_speeds(engine)))
+    elif argv == ['backfill-rollups']:
+        ensure_schema(engine)
+        print("Summarized {0} vehicles.".format(backfill_rollups(engine)))
+    elif argv == ['partition']:
+        ensure_schema(engine)
+        print("Moved {0} vehicles into monthly partitions.".format(migrate_to_partitions(engine)))
+    elif argv[:1] == ['export'] and len(argv) in (2, 3) and argv[2:] in ([], ['--detach']):
+        for path in export_closed_partitions(engine, argv[1], detach=argv[2:] == ['--detach']):
+            print("Wrote {0}".format(path))
+    else:
+        print(__doc__.strip())
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
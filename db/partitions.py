@@ -0,0 +1,272 @@
+"""
+Monthly partitioning of the vehicles table (PostgreSQL only).
+
+The vehicles table is range-partitioned on datetime, one partition per
+month, plus a default partition for anything outside the months created.
+Each partition only indexes datetime with a BRIN index, which stays tiny
+and cheap to maintain because rows arrive in time order. Closed months can
+be exported to Parquet files for offline analysis and then detached.
+"""
+
+import datetime
+import os
+import re
+
+from sqlalchemy import text
+
+PARTITIONED_VEHICLES = """
+CREATE TABLE vehicles (
+    id INTEGER NOT NULL DEFAULT nextval('vehicles_id_seq'),
+    "sessionID" VARCHAR REFERENCES log ("sessionID"),
+    datetime TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    speed DOUBLE PRECISION,
+    direction VARCHAR,
+    color VARCHAR,
+    rating DOUBLE PRECISION,
+    rating_version INTEGER,
+    track_key VARCHAR,
+    evidence VARCHAR,
+    PRIMARY KEY (id, datetime),
+    UNIQUE (track_key, datetime)
+) PARTITION BY RANGE (datetime)
+"""
+
+
+def month_start(when):
+    return datetime.datetime(when.year, when.month, 1)
+
+
+def next_month(month):
+    return datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    """
+    :param month: any datetime within the month
+    :return: name of the month's partition, e.g. vehicles_y2016m04
+    """
+    return "vehicles_y{0:04d}m{1:02d}".format(month.year, month.month)
+
+
+def partition_month(name):
+    """
+    :param name: a partition name made by partition_name
+    :return: start of the partition's month
+    """
+    match = re.match(r'vehicles_y(\d{4})m(\d{2})\Z', name)
+    if match is None or not 1 <= int(match.group(2)) <= 12:
+        raise ValueError("Not a monthly vehicles partition: {0!r}".format(name))
+    return datetime.datetime(int(match.group(1)), int(match.group(2)), 1)
+
+
+def quoted_partition(connection, name):
+    """
+    Partition names end up in DDL, which takes no bound parameters, so they are checked and quoted.
+    :param connection: connection to the database
+    :param name: a partition name made by partition_name
+    :return: the name quoted for the connection's dialect
+    """
+    partition_month(name)
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def is_partitioned(connection):
+    return connection.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'vehicles'")).first() is not None
+
+
+def create_partition(connection, month):
+    """
+    Creates the partition for one month if it doesn't exist yet. Rows of that month already
+    in the default partition would make PostgreSQL refuse the new one, so the default is
+    detached while they are moved across, then attached again.
+    :param connection: connection to the database, within a transaction
+    :param month: any datetime within the month
+    :return: number of rows moved out of the default partition
+    """
+    start = month_start(month)
+    end = next_month(start)
+    name = partition_name(start)
+    if connection.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar() is not None:
+        return 0
+
+    bounds = {'start': start, 'end': end}
+    partition = quoted_partition(connection, name)
+    # the bounds are formatted from datetimes built here: PARTITION OF takes no bound parameters
+    create = "CREATE TABLE {0} PARTITION OF vehicles FOR VALUES FROM ('{1}') TO ('{2}')".format(
+        partition, start.isoformat(' '), end.isoformat(' '))
+    stranded = connection.execute(text(
+        "SELECT 1 FROM vehicles_default WHERE datetime >= :start AND datetime < :end LIMIT 1"), bounds).first()
+    if stranded is None:
+        connection.execute(text(create))
+        return 0
+
+    connection.execute(text("ALTER TABLE vehicles DETACH PARTITION vehicles_default"))
+    connection.execute(text(create))
+    moved = connection.execute(text(
+        'INSERT INTO {0} (id, "sessionID", datetime, speed, direction, color, rating, rating_version, '
+        'track_key, evidence) '
+        'SELECT id, "sessionID", datetime, speed, direction, color, rating, rating_version, track_key, evidence '
+        'FROM vehicles_default WHERE datetime >= :start AND datetime < :end'.format(partition)), bounds).rowcount
+    connection.execute(text("DELETE FROM vehicles_default WHERE datetime >= :start AND datetime < :end"), bounds)
+    connection.execute(text("ALTER TABLE vehicles ATTACH PARTITION vehicles_default DEFAULT"))
+    return moved
+
+
+def ensure_partitions(bind, months_ahead=2, now=None):
+    """
+    Creates the partitions for this month and the next few.
+    :param bind: engine
+    :param months_ahead: how many future months to prepare
+    :param now: current time, for testing
+    :return: None
+    """
+    month = month_start(now or datetime.datetime.now())
+    with bind.begin() as connection:
+        for _ in range(months_ahead + 1):
+            create_partition(connection, month)
+            month = next_month(month)
+
+
+def create_partitioned_vehicles(connection):
+    """
+    Creates an empty partitioned vehicles table with its BRIN index and default partition.
+    :param connection: connection to the database
+    :return: None
+    """
+    connection.execute(text("CREATE SEQUENCE IF NOT EXISTS vehicles_id_seq"))
+    connection.execute(text(PARTITIONED_VEHICLES))
+    connection.execute(text("CREATE INDEX vehicles_datetime_brin ON vehicles USING brin (datetime)"))
+    connection.execute(text("CREATE TABLE vehicles_default PARTITION OF vehicles DEFAULT"))
+
+
+def migrate_to_partitions(bind):
+    """
+    Moves an existing unpartitioned vehicles table into a partitioned one.
+    The old table is kept as vehicles_unpartitioned until dropped by hand.
+    :param bind: engine
+    :return: number of rows moved
+    """
+    with bind.begin() as connection:
+        if is_partitioned(connection):
+            return 0
+
+        connection.execute(text("ALTER TABLE vehicles RENAME TO vehicles_unpartitioned"))
+        connection.execute(text("ALTER SEQUENCE IF EXISTS vehicles_id_seq OWNED BY NONE"))
+        for constraint in ('vehicles_pkey', 'vehicles_track_key_key'):
+            connection.execute(text("ALTER INDEX IF EXISTS {0} RENAME TO {0}_unpartitioned".format(constraint)))
+        create_partitioned_vehicles(connection)
+
+        first, last = connection.execute(text(
+            "SELECT min(datetime), max(datetime) FROM vehicles_unpartitioned")).first()
+        if first is not None:
+            month = month_start(first)
+            while month <= last:
+                create_partition(connection, month)
+                month = next_month(month)
+
+        moved = connection.execute(text(
+            'INSERT INTO vehicles (id, "sessionID", datetime, speed, direction, color, rating, rating_version, '
+            'track_key, evidence) '
+            'SELECT id, "sessionID", datetime, speed, direction, color, rating, rating_version, track_key, evidence '
+            'FROM vehicles_unpartitioned WHERE datetime IS NOT NULL')).rowcount
+        connection.execute(text(
+            "SELECT setval('vehicles_id_seq', GREATEST((SELECT max(id) FROM vehicles), 1))"))
+
+    ensure_partitions(bind)
+    return moved
+
+
+def closed_partitions(bind, now=None):
+    """
+    Attached partitions for months that have ended, oldest first.
+    :param bind: engine
+    :param now: current time, for testing
+    :return: list of (partition name, month start)
+    """
+    current = month_start(now or datetime.datetime.now())
+    with bind.connect() as connection:
+        names = connection.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'vehicles'")).scalars().all()
+
+    partitions = []
+    for name in names:
+        try:
+            month = partition_month(name)
+        except ValueError:
+            continue
+        if month < current:
+            partitions.append((name, month))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def export_partition(bind, name, directory, chunk_size=50000):
+    """
+    Writes one partition to a zstd-compressed Parquet file.
+    :param bind: engine
+    :param name: partition to export, as made by partition_name
+    :param directory: where to put the file
+    :param chunk_size: rows fetched and written per row group
+    :return: path of the file written
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Exporting partitions needs pyarrow: pip install pyarrow")
+
+    schema = pa.schema([
+        ('id', pa.int32()),
+        ('sessionID', pa.string()),
+        ('datetime', pa.timestamp('us')),
+        ('speed', pa.float64()),
+        ('direction', pa.string()),
+        ('color', pa.string()),
+        ('rating', pa.float64()),
+        ('rating_version', pa.int32()),
+        ('track_key', pa.string()),
+        ('evidence', pa.string()),
+    ])
+    path = os.path.join(directory, name + '.parquet')
+
+    with bind.connect() as connection:
+        query = text('SELECT id, "sessionID", datetime, speed, direction, color, rating, rating_version, '
+                     'track_key, evidence FROM {0} ORDER BY datetime'.format(quoted_partition(connection, name)))
+        result = connection.execution_options(stream_results=True).execute(query)
+        with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+
+    return path
+
+
+def export_closed_partitions(bind, directory, detach=False, now=None):
+    """
+    Exports every closed month to Parquet, optionally detaching it afterwards.
+    :param bind: engine
+    :param directory: where to put the files
+    :param detach: detach each partition from vehicles once exported
+    :param now: current time, for testing
+    :return: list of paths written
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    paths = []
+    for name, month in closed_partitions(bind, now):
+        path = os.path.join(directory, name + '.parquet')
+        if not os.path.exists(path):
+            path = export_partition(bind, name, directory)
+            paths.append(path)
+        if detach:
+            with bind.begin() as connection:
+                connection.execute(text("ALTER TABLE vehicles DETACH PARTITION {0}".format(
+                    quoted_partition(connection, name))))
+    return paths
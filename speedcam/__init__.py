@@ -0,0 +1,3 @@
+"""
+Reusable building blocks for the car speed detector.
+"""
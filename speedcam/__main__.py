@@ -0,0 +1,14 @@
+"""
+Runs the speed camera: python -m speedcam [--config settings.json] [--headless] ...
+"""
+
+import time
+
+STARTED = time.time()  # before the heavy imports, so they count towards the cold start
+
+import sys
+
+from speedcam.app import main
+
+if __name__ == '__main__':
+    sys.exit(main(started=STARTED))
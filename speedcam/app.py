@@ -0,0 +1,522 @@
+"""
+The speed camera application.
+
+Importing this module has no side effects. main() parses the command line
+into a Config and runs a SpeedCamera, which opens the spool and the camera,
+starts the worker threads and runs the detection loop until the source
+ends, 'q' is pressed or it is interrupted.
+
+The database is never touched on the way to the first frame: the spool
+forwarder imports SQLAlchemy, creates the one shared engine and checks the
+schema on its own thread once detection is running. The time from start
+to the first processed frame is reported as cold_start_seconds.
+"""
+
+import argparse
+import datetime
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4 as uuid
+
+from speedcam.background import RUNNING_AVERAGE
+from speedcam.config import Config
+from speedcam.detector import Detector, MIN_TRACK_FRAMES, vehicle_row
+from speedcam.display import Display, select_monitored_area
+from speedcam.evidence import EvidenceRecorder, FrameRing
+from speedcam.framebus import FrameBus, FrameBusReader
+from speedcam.metrics import Metrics, MetricsExporter
+from speedcam.pipeline import FrameQueue, CaptureThread, DROP_OLDEST, BLOCK
+from speedcam.processing import RoiProcessor
+from speedcam.rate import RateController, crossing_fps
+from speedcam.sources import open_source, ThroughputMeter
+from speedcam.spool import Spool, Forwarder, LOG
+from speedcam.stats import SpeedStatistics, StatsPublisher
+from speedcam.status import StatusRenderer
+from speedcam.writer import DetectionWriter
+
+# the following enumerated values are used to make the program more readable
+WAITING = 0
+TRACKING = 1
+STUCK = 3
+
+
+def _database_engine(url):
+    def create():
+        from db import get_engine  # imports SQLAlchemy, so only on the forwarder thread
+        return get_engine(url)
+    return create
+
+
+class SpeedCamera(object):
+    """
+    One camera watching one monitored area, from capture to the spool.
+    """
+
+    def __init__(self, config, started=None):
+        """
+        :param config: Config
+        :param started: time.time() at process start, for measuring the cold start
+        """
+        self.config = config
+        self.started = started or time.time()
+        self.session_id = uuid()
+        self.time_on = datetime.datetime.now()  # This is used for the log
+        self.cold_start = None
+
+        # state maintains the state of the speed computation process
+        # it starts as WAITING
+        # while the tracker follows at least one vehicle it is TRACKING
+        self.state = WAITING
+        self.text_on_image = 'No cars'
+        self.last_vehicle_detected = 'N/A'
+        self.last_mph_detected = 'N/A'
+        self.box = tuple(config.monitored_area)
+
+        self.meter = ThroughputMeter()
+        self.metrics = Metrics(config.metrics_enabled)
+        self.speeds = SpeedStatistics(config.speed_threshold, config.speed_stats_window, config.speed_stats_windows)
+        self.spool = None
+        self.camera = None
+        self.detector = None
+        self.controller = None
+        self.frame_queue = None
+        self.capture_thread = None
+        self.writer = None
+        self.evidence = None
+        self.forwarder = None
+        self.status = None
+        self.bus = None
+        self.display = None
+        self.preview = None
+        self.exporter = None
+        self.stats_publisher = None
+
+    def log_entry(self, in_out):
+        """
+        Put usage in log table, by way of the spool
+        """
+        row = dict(sessionID=str(self.session_id), timeOn=self.time_on)
+        if in_out == "out":
+            row['timeOff'] = datetime.datetime.now()
+            print("Writing exit time ({}) to log table and exiting program.".format(row['timeOff']))
+        self.spool.append(LOG, [row])
+
+    def open_camera(self):
+        """
+        Opens the frame source at full frame rate.
+        :return: the opened frame source
+        """
+        config = self.config
+        path, generator = config.video_file, None
+        if config.frame_source == 'synthetic':
+            from speedcam.synthetic import generator_from_config
+            path, generator = config.synthetic_manifest_path, generator_from_config(config)
+            self.box = generator.box  # the default area is scaled to the frame size
+        self.camera = open_source(config.frame_source, config.resolution, config.day_fps,
+                                  device=config.video_device, path=path,
+                                  realtime=config.replay_realtime,
+                                  max_framerate=max(config.day_fps, config.night_fps), generator=generator)
+        print("Camera initialized")
+        return self.camera
+
+    def choose_monitored_area(self):
+        """
+        Lets the user draw the monitored area on a reference image, when there is a screen.
+        :return: None
+        """
+        if self.config.use_x and self.config.draw_monitored_area:
+            # grab a reference image to use for drawing the monitored area's boundary
+            image = self.camera.capture().image
+            processor = RoiProcessor(self.box, image.shape, self.config.rotation_degrees)
+            self.box = select_monitored_area(processor.straighten(image), self.box)
+
+        x1, y1, x2, y2 = self.box
+        print("Initial Parameters:")
+        print(" Upper left_x:               {}".format(x1))
+        print(" Upper left_y:               {}".format(y1))
+        print(" Lower right_x:              {}".format(x2))
+        print(" Lower right_y:              {}".format(y2))
+        print(" Monitored width:            {}".format(x2 - x1))
+        print(" Monitored height:           {}".format(y2 - y1))
+        print(" Monitored area:             {}".format((x2 - x1) * (y2 - y1)))
+
+    def status_fields(self):
+        """
+        Collects the fields shown by the status renderer. Runs on the renderer thread.
+        :return: OrderedDict of fields
+        """
+        last_db_commit = 'N/A'
+        if self.writer.last_flush is not None:
+            last_db_commit = datetime.datetime.fromtimestamp(self.writer.last_flush).strftime('%Y-%m-%d %H:%M:%S')
+
+        x1, y1, x2, y2 = self.box
+        return OrderedDict([
+            ('status', self.text_on_image),
+            ('monitored_area', "{0}x{1} at ({2}, {3})".format(x2 - x1, y2 - y1, x1, y1)),
+            ('last_vehicle_detected', "{0} at {1} MPH".format(self.last_vehicle_detected, self.last_mph_detected)),
+            ('speeds', self.speeds.describe()),
+            ('last_database_commit', last_db_commit if self.forwarder else 'dry run'),
+            ('frame_rate', "{0:.1f} processed, {1} requested".format(self.meter.fps(), self.controller.framerate)),
+            ('nighttime', self.controller.nighttime),
+            ('queued_frames', self.frame_queue.depth()),
+            ('spooled_rows', self.spool.depth()),
+        ])
+
+    def start(self):
+        """
+        Opens the spool and the camera and starts every worker thread.
+        :return: None
+        """
+        config = self.config
+        self.spool = Spool(config.spool_path)
+        self.open_camera()
+        self.choose_monitored_area()
+
+        self.log_entry("in")  # Log usage
+        self.writer = DetectionWriter(self.spool, config.db_batch_size, config.db_flush_interval,
+                                      metrics=self.metrics)
+        self.writer.start()
+        if not config.dry_run:
+            self.forwarder = Forwarder(self.spool, _database_engine(config.database_url))
+            self.forwarder.start()
+        self.start_evidence()
+        self.start_capture()
+
+        self.status = StatusRenderer(self.status_fields, config.status_mode, config.status_interval,
+                                     config.status_path)
+        self.status.start()
+        self.start_viewers()
+
+        self.metrics.add_collector(lambda: dict(
+            fps=self.meter.fps(),
+            requested_fps=self.controller.framerate or 0,
+            cold_start_seconds=self.cold_start or 0.0,
+            gated_frames=self.detector.gated_frames if self.detector else 0,
+            published_frames=self.bus.published if self.bus else 0,
+            **{'queue_' + name: value for name, value in self.frame_queue.stats().items()}))
+        self.metrics.add_collector(lambda: {'writer_' + name: value for name, value in self.writer.stats().items()})
+        self.metrics.add_collector(self.speeds.gauges)
+        if self.forwarder is not None:
+            self.metrics.add_collector(
+                lambda: {'spool_' + name: value for name, value in self.forwarder.stats().items()})
+        if self.evidence is not None:
+            self.metrics.add_collector(
+                lambda: {'evidence_' + name: value for name, value in self.evidence.stats().items()})
+        if config.metrics_enabled:
+            self.exporter = MetricsExporter(self.metrics, config.metrics_prometheus_path, config.metrics_json_path,
+                                            config.metrics_interval)
+            self.exporter.start()
+        if config.speed_stats_path:
+            self.stats_publisher = StatsPublisher(self.speeds.as_dict, config.speed_stats_path,
+                                                  config.speed_stats_interval)
+            self.stats_publisher.start()
+
+    def start_evidence(self):
+        """
+        Starts the thread recording evidence of speeders, if enabled. Call once the writer exists.
+        :return: None
+        """
+        config = self.config
+        if config.evidence_enabled:
+            self.evidence = EvidenceRecorder(FrameRing(config.evidence_buffer_mb * 2 ** 20), self.writer,
+                                             config.evidence_dir, config.evidence_format,
+                                             config.evidence_pre_seconds, config.evidence_post_seconds,
+                                             config.evidence_queue_size)
+            self.evidence.start()
+
+    def idle_fps(self):
+        """
+        :return: idle_fps, raised if a vehicle arriving at idle_design_speed would be seen in too few frames
+            to be measured, were the camera to stay idle
+        """
+        config = self.config
+        x1, _, x2, _ = self.box
+        return max(config.idle_fps, crossing_fps(x2 - x1, config.image_width, config.field_of_view,
+                                                 min(config.ltr_distance, config.rtl_distance),
+                                                 config.idle_design_speed, samples=MIN_TRACK_FRAMES))
+
+    def start_capture(self):
+        """
+        Starts the capture thread feeding the frame queue, under the control of the frame-rate controller.
+        :return: None
+        """
+        config = self.config
+        idle_fps = self.idle_fps()
+        if idle_fps > config.idle_fps:
+            print("Idling at {0:.1f} FPS rather than {1}, to measure vehicles up to {2} MPH".format(
+                idle_fps, config.idle_fps, config.idle_design_speed))
+        self.controller = RateController(self.camera, config.day_fps, config.night_fps, idle_fps,
+                                         config.idle_after)
+
+        # synthetic traffic in real time stands in for a camera, so it drops frames like one
+        replay = config.frame_source == 'file' or (config.frame_source == 'synthetic' and not config.replay_realtime)
+        policy = config.queue_policy or (BLOCK if replay else DROP_OLDEST)
+        self.frame_queue = FrameQueue(config.queue_size, policy, skip_every=config.queue_skip_every)
+        self.capture_thread = CaptureThread(self.camera, self.frame_queue)
+        self.capture_thread.start()
+
+    def start_viewers(self):
+        """
+        Opens the frame bus and what reads it: the display, which run() shows, and the preview server.
+        :return: None
+        """
+        config = self.config
+        preview = config.preview_port is not None
+        if not (config.use_x or preview):
+            return
+        if preview and config.frame_bus_name is None:
+            raise ValueError("The preview needs a frame_bus_name")
+
+        rates = ([config.display_fps] if config.use_x else []) + ([config.preview_fps] if preview else [])
+        self.bus = FrameBus(config.frame_bus_name if preview else None, config.frame_bus_slots, max_fps=max(rates))
+        if config.use_x:
+            self.display = Display(FrameBusReader(bus=self.bus), config.display_fps,
+                                   debug_window="DebugView" if config.debug else None)
+        if preview:
+            # a process of its own: encoding JPEGs and serving browsers never competes with detection
+            self.preview = subprocess.Popen([
+                sys.executable, '-m', 'speedcam.preview', '--bus', config.frame_bus_name,
+                '--host', config.preview_host, '--port', str(config.preview_port),
+                '--fps', str(config.preview_fps), '--quality', str(config.preview_quality)])
+
+    def stop_viewers(self):
+        """
+        Stops the display and the preview server and frees the frame bus.
+        :return: None
+        """
+        if self.display is not None:
+            self.display.stop()
+        if self.preview is not None:
+            self.preview.terminate()
+            try:
+                self.preview.wait(5.0)
+            except subprocess.TimeoutExpired:
+                self.preview.kill()
+        if self.bus is not None:
+            self.bus.close()
+
+    def move_monitored_area(self, box, shape):
+        """
+        Monitors another area from the next frame on, e.g. one drawn in the preview.
+        :param box: (upper left x, upper left y, lower right x, lower right y)
+        :param shape: shape of the frames
+        :return: None
+        """
+        rows, cols = shape[:2]
+        x1, y1, x2, y2 = box
+        x1, x2 = max(min(x1, x2), 0), min(max(x1, x2), cols)
+        y1, y2 = max(min(y1, y2), 0), min(max(y1, y2), rows)
+        if x2 - x1 < 16 or y2 - y1 < 8:
+            self.status.event("Ignored monitored area {0}: too small".format(box))
+            return
+        self.box = (x1, y1, x2, y2)
+        self.detector = None  # rebuilt for the new area, with a new background, on the next frame
+        self.controller.idle_fps = self.idle_fps()  # a narrower area is crossed sooner
+        self.status.event("Monitored area moved to {0}; set monitored_area to keep it".format(self.box))
+
+    def process(self, frame):
+        """
+        Runs one frame through detection and hands its vehicles to the writer.
+        :param frame: Frame
+        :return: False once the user has asked to quit
+        """
+        config = self.config
+        metrics = self.metrics
+
+        # use the time the frame was captured, not the time we got around to it
+        timestamp = frame.timestamp
+        image = frame.image
+        if self.detector is None:
+            self.detector = Detector.from_config(config, self.box, image.shape, metrics)
+        detector = self.detector
+        nighttime = self.controller.nighttime
+
+        # keep the latest frames for evidence, by reference; never encoded here
+        if self.evidence is not None:
+            with metrics.stage('evidence'):
+                self.evidence.ring.push(image, timestamp)
+
+        if config.background_engine == RUNNING_AVERAGE:
+            detector.background.learning_rate = config.night_learning_rate if nighttime else config.day_learning_rate
+
+        # crop the frame to the monitored area, find what moved against the
+        # background, follow it, and measure every vehicle that left the area
+        show_frame = self.bus is not None and self.bus.wants_frame()
+        result = detector.process(image, timestamp, nighttime, keep_small=show_frame)
+
+        # idle the camera while the road is empty, and tell day from night by brightness
+        self.controller.update(timestamp, detector.background.brightness, bool(result.boxes))
+
+        for vehicle in result.vehicles:
+            track, estimate = vehicle.track, vehicle.estimate
+            row = vehicle_row(vehicle, self.session_id, "{0}:{1}".format(self.session_id, track.id))
+            # a speeder's row follows its evidence, once the recorder has written it
+            if not (self.evidence is not None and estimate.mph > config.speed_threshold and
+                    self.evidence.record(row, track.first_seen, track.last_seen,
+                                         "{0:.0f} MPH".format(estimate.mph))):
+                self.writer.submit(row)  # Table for statistics calculations
+            self.speeds.add(row['direction'], estimate.mph, track.last_seen)
+            metrics.count('vehicles')
+            self.status.event("Added new vehicle {0}: {1} MPH ({2:.0%} confidence)".format(
+                track.id, round(estimate.mph, 2), estimate.confidence))
+            self.last_vehicle_detected = track.last_seen.strftime('%Y-%m-%d %H:%M:%S')
+            self.last_mph_detected = round(estimate.mph, 2)
+
+        if result.stuck:
+            self.status.event("Caught motion loop. Creating new base snapshot")
+            self.state = STUCK
+        elif detector.tracking:
+            if self.state != TRACKING:
+                self.text_on_image = 'Tracking'
+                self.status.event(self.text_on_image)
+            self.state = TRACKING
+        elif self.state != WAITING:
+            self.state = WAITING
+            self.text_on_image = 'No Car Detected'
+
+        # publish the frame only when a viewer is due for one; the boxes are drawn by the viewers
+        if show_frame:
+            with metrics.stage('display'):
+                self.bus.publish(detector.processor.straighten(image), timestamp, self.box,
+                                 [box + (1,) for box in result.boxes] + [box + (0,) for box in result.small_boxes],
+                                 self.text_on_image, result.mask)
+        if self.bus is not None:
+            box = self.bus.roi_request()
+            if box is not None:
+                self.move_monitored_area(box, image.shape)
+        return self.display is None or not self.display.quit_requested.is_set()  # 'q' pressed in the window
+
+    def run(self):
+        """
+        Processes frames until the source ends, 'q' is pressed or CTRL+C. With a window, call it on the main
+        thread: the window is shown there, as HighGUI requires, and detection runs on a thread of its own.
+        :return: None
+        """
+        if self.display is None:
+            self.detect()
+            return
+
+        errors = []
+
+        def detect():
+            try:
+                self.detect()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self.display.stop()  # the source ended: close the window
+
+        detection = threading.Thread(target=detect, name="detection")
+        detection.start()
+        try:
+            self.display.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.display.quit_requested.set()  # detection stops after its current frame
+            detection.join()
+        if errors:
+            raise errors[0]
+
+    def detect(self):
+        """
+        Processes frames until the source ends, 'q' is pressed or CTRL+C.
+        :return: None
+        """
+        waited = time.perf_counter()
+        try:
+            for frame in self.frame_queue.frames():
+                started = time.perf_counter()
+                self.metrics.observe('wait', started - waited)  # time spent waiting on the capture thread
+                self.meter.tick()
+
+                keep_going = self.process(frame)
+                if self.cold_start is None:
+                    self.cold_start = time.time() - self.started
+                    self.status.event("First frame processed {0:.2f}s after start".format(self.cold_start))
+                if not keep_going:
+                    break
+
+                waited = time.perf_counter()
+                self.metrics.observe('frame', waited - started)
+        except KeyboardInterrupt:  # Catch a CTRL+C interrupt as program exit and close gracefully
+            pass
+        finally:
+            self.log_entry("out")
+
+    def stop(self):
+        """
+        Stops every thread, flushing what is waiting, and prints a summary.
+        :return: None
+        """
+        self.capture_thread.stop()
+        self.capture_thread.join(2.0)
+        self.stop_viewers()
+        self.status.stop(2.0)
+        if self.exporter is not None:
+            self.exporter.stop(2.0)
+        if self.stats_publisher is not None:
+            self.stats_publisher.stop(2.0)
+
+        if self.capture_thread.error is not None:
+            print("Capture failed: {0}".format(self.capture_thread.error))
+        print("Processed {0} frames in {1:.1f}s ({2:.1f} FPS)".format(
+            self.meter.frames, self.meter.elapsed(), self.meter.fps()))
+
+        self.camera.close()
+        if self.evidence is not None:
+            self.evidence.stop(30.0)  # before the writer, which gets the speeders' rows from it
+            print("Evidence: {recorded} recorded, {dropped} dropped, {failed} failed".format(**self.evidence.stats()))
+        self.writer.stop(30.0)
+        print("Detection writer: {written} written, {dropped} dropped, {failed} failed".format(
+            **self.writer.stats()))
+        if self.forwarder is not None:
+            self.forwarder.stop(30.0)
+            print("Spool: {forwarded} forwarded, {spooled} still spooled".format(**self.forwarder.stats()))
+        else:
+            print("Dry run: {0} records left in {1}".format(self.spool.depth(), self.config.spool_path))
+        self.spool.close()
+        print("Frame queue: {dropped} dropped, {skipped} skipped, {late} late".format(**self.frame_queue.stats()))
+        print("Frame rate changed {0} times".format(self.controller.changes))
+        if self.cold_start is not None:
+            print("Cold start: first frame processed {0:.2f}s after start".format(self.cold_start))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the speed of passing vehicles.")
+    parser.add_argument('--config', help="JSON file of settings, see speedcam.config.DEFAULTS")
+    parser.add_argument('--source', dest='frame_source', choices=('picamera', 'v4l2', 'file', 'synthetic'))
+    parser.add_argument('--video', dest='video_file', help="recorded video for --source file")
+    parser.add_argument('--realtime', dest='replay_realtime', action='store_true', default=None,
+                        help="replay a video, or generate traffic, at its frame rate")
+    parser.add_argument('--headless', dest='use_x', action='store_false', default=None,
+                        help="never open a window")
+    parser.add_argument('--database-url')
+    parser.add_argument('--dry-run', action='store_true', default=None,
+                        help="spool vehicles without connecting to the database")
+    return parser.parse_args(argv)
+
+
+def main(argv=None, started=None):
+    """
+    Command-line entry point.
+    :param argv: arguments, sys.argv[1:] by default
+    :param started: time.time() at process start, if known earlier than now
+    :return: exit status
+    """
+    started = started or time.time()
+    args = vars(parse_args(argv))
+    path = args.pop('config')
+    overrides = dict((name, value) for name, value in args.items() if value is not None)
+    config = Config.load(path, **overrides) if path else Config(**overrides)
+
+    camera = SpeedCamera(config, started)
+    camera.start()
+    try:
+        camera.run()
+    finally:
+        camera.stop()
+    return 0
@@ -0,0 +1,212 @@
+"""
+Background models.
+
+A BackgroundModel turns blurred grayscale images of the monitored area into
+dilated binary motion masks. The engine doing the background estimation is
+chosen at start-up:
+
+    running_average - cv2.accumulateWeighted, as carspeed.py has always done
+    mog2            - cv2.BackgroundSubtractorMOG2
+    knn             - cv2.BackgroundSubtractorKNN
+
+Every model watches the brightness of incoming frames. When it drifts away
+from the brightness the background was built at (clouds, dusk, headlights),
+a fresh engine is trained on the side while the current one keeps producing
+masks, and is swapped in once warmed up. No frame is skipped for it.
+"""
+
+import cv2
+import numpy as np
+
+RUNNING_AVERAGE = 'running_average'
+MOG2 = 'mog2'
+KNN = 'knn'
+ENGINES = (RUNNING_AVERAGE, MOG2, KNN)
+
+
+class RunningAverageEngine(object):
+    """
+    Background as a running average of frames.
+    """
+
+    def __init__(self, shape, threshold=15, learning_rate=0.05):
+        self.threshold = threshold
+        self.learning_rate = learning_rate
+        self.base = np.empty(shape, dtype=np.float32)
+        self.base_u8 = np.empty(shape, dtype=np.uint8)  # what frames are compared against
+        self.delta = np.empty(shape, dtype=np.uint8)
+        self.ready = False
+
+    def foreground(self, gray, learn, dst):
+        """
+        Writes a binary mask of pixels differing from the background into dst.
+        :param gray: blurred grayscale image
+        :param learn: blend the image into the background afterwards
+        :param dst: output buffer
+        :return: dst
+        """
+        if not self.ready:
+            self.base[...] = gray
+            self.base_u8[...] = gray
+            self.ready = True
+            dst[...] = 0
+            return dst
+
+        cv2.absdiff(gray, self.base_u8, dst=self.delta)
+        cv2.threshold(self.delta, self.threshold, 255, cv2.THRESH_BINARY, dst=dst)
+        if learn:
+            cv2.accumulateWeighted(gray, self.base, self.learning_rate)
+            cv2.convertScaleAbs(self.base, dst=self.base_u8)
+        return dst
+
+
+class SubtractorEngine(object):
+    """
+    Background from one of OpenCV's background subtractors.
+    """
+
+    def __init__(self, subtractor, shape, learning_rate=-1):
+        """
+        :param subtractor: a cv2.BackgroundSubtractor, created with detectShadows=False
+        :param learning_rate: passed to apply(); -1 lets OpenCV choose from the history length
+        """
+        self.subtractor = subtractor
+        self.learning_rate = learning_rate
+        self.raw = np.empty(shape, dtype=np.uint8)
+        self.ready = True
+
+    def foreground(self, gray, learn, dst):
+        rate = self.learning_rate if learn else 0
+        self.subtractor.apply(gray, self.raw, rate)
+        cv2.threshold(self.raw, 200, 255, cv2.THRESH_BINARY, dst=dst)
+        return dst
+
+
+def create_engine(engine, shape, threshold=15, learning_rate=None, history=500):
+    """
+    Creates a background estimation engine by name.
+    :param engine: RUNNING_AVERAGE, MOG2 or KNN
+    :param shape: (rows, cols) of the monitored area
+    :param threshold: pixel difference counted as motion
+    :param learning_rate: how quickly new frames are absorbed, None for the engine's default
+    :param history: number of frames the subtractors remember
+    :return: an engine
+    """
+    if engine == RUNNING_AVERAGE:
+        return RunningAverageEngine(shape, threshold, 0.05 if learning_rate is None else learning_rate)
+    elif engine == MOG2:
+        subtractor = cv2.createBackgroundSubtractorMOG2(history, threshold ** 2 / 9.0, False)
+    elif engine == KNN:
+        subtractor = cv2.createBackgroundSubtractorKNN(history, 400.0, False)
+    else:
+        raise ValueError("Unknown background engine: {0}".format(engine))
+
+    return SubtractorEngine(subtractor, shape, -1 if learning_rate is None else learning_rate)
+
+
+class BackgroundModel(object):
+    """
+    Produces motion masks, rebuilding the background when lighting drifts.
+    """
+
+    def __init__(self, engine, shape, threshold=15, learning_rate=None, drift_threshold=20.0,
+                 drift_frames=15, warmup_frames=30):
+        """
+        :param engine: RUNNING_AVERAGE, MOG2 or KNN
+        :param shape: (rows, cols) of the monitored area
+        :param threshold: pixel difference counted as motion
+        :param learning_rate: how quickly new frames are absorbed, None for the engine's default
+        :param drift_threshold: change in mean brightness that counts as a lighting change
+        :param drift_frames: how many frames in a row the change must last
+        :param warmup_frames: frames a replacement background is trained on before it is used
+        """
+        self.engine_name = engine
+        self.shape = shape
+        self.threshold = threshold
+        self.drift_threshold = drift_threshold
+        self.drift_frames = drift_frames
+        self.warmup_frames = warmup_frames
+
+        self.engine = create_engine(engine, shape, threshold, learning_rate)
+        self.candidate = None
+        self.candidate_frames = 0
+        self.reference_brightness = None
+        self.brightness = None  # mean brightness of the last frame
+        self.drifting_frames = 0
+        self.rebuilds = 0
+
+        self.fg = np.empty(shape, dtype=np.uint8)
+        self.scratch = np.empty(shape, dtype=np.uint8)
+        self.mask = np.empty(shape, dtype=np.uint8)
+
+    @property
+    def learning_rate(self):
+        return self.engine.learning_rate
+
+    @learning_rate.setter
+    def learning_rate(self, rate):
+        self.engine.learning_rate = rate
+        if self.candidate is not None:
+            self.candidate.learning_rate = rate
+
+    @property
+    def rebuilding(self):
+        return self.candidate is not None
+
+    def reset(self):
+        """
+        Throws the background away; the next frame starts a new one.
+        :return: None
+        """
+        self.engine = create_engine(self.engine_name, self.shape, self.threshold, self.engine.learning_rate)
+        self.candidate = None
+        self.reference_brightness = None
+        self.drifting_frames = 0
+
+    def rebuild(self):
+        """
+        Starts training a replacement background alongside the current one.
+        :return: None
+        """
+        if self.candidate is None:
+            self.candidate = create_engine(self.engine_name, self.shape, self.threshold,
+                                           self.engine.learning_rate)
+            self.candidate_frames = 0
+            self.rebuilds += 1
+
+    def _watch_brightness(self, gray, learn):
+        brightness = self.brightness = cv2.mean(gray)[0]
+        if self.reference_brightness is None:
+            self.reference_brightness = brightness
+            return
+
+        if abs(brightness - self.reference_brightness) > self.drift_threshold:
+            self.drifting_frames += 1
+            if self.drifting_frames >= self.drift_frames:
+                self.rebuild()
+                self.reference_brightness = brightness
+                self.drifting_frames = 0
+        else:
+            self.drifting_frames = 0
+            if learn:  # follow gradual changes the engine absorbs by itself
+                self.reference_brightness += 0.05 * (brightness - self.reference_brightness)
+
+    def apply(self, gray, learn=True):
+        """
+        Computes the dilated binary motion mask for a frame.
+        :param gray: blurred grayscale image of the monitored area
+        :param learn: whether the frame may update the background, i.e. no vehicle is being tracked
+        :return: the mask buffer, overwritten by the next call
+        """
+        self._watch_brightness(gray, learn)
+
+        if self.candidate is not None:
+            # The replacement learns from every frame, as the old background is known to be stale
+            self.candidate.foreground(gray, True, self.scratch)
+            self.candidate_frames += 1
+            if self.candidate_frames >= self.warmup_frames:
+                self.engine, self.candidate = self.candidate, None
+
+        self.engine.foreground(gray, learn, self.fg)
+        cv2.dilate(self.fg, None, dst=self.mask, iterations=2)
+        return self.mask
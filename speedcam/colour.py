@@ -0,0 +1,89 @@
+"""
+Vehicle colour extraction.
+
+Works on the bounding-box sub-array of a blob only, with a mask at that
+size, so the cost depends on the size of the vehicle rather than the size
+of the frame. Intended to run once per committed vehicle.
+"""
+
+import cv2
+import numpy as np
+
+MEAN = 'mean'
+MEDIAN = 'median'
+DOMINANT = 'dominant'
+
+
+def _masked_pixels(image, contour):
+    """
+    Returns the bounding-box sub-array of a contour and a mask of the pixels inside it.
+    """
+    x, y, w, h = cv2.boundingRect(contour)
+    patch = image[y:y + h, x:x + w]
+    mask = np.zeros(patch.shape[:2], dtype=np.uint8)
+    cv2.drawContours(mask, [contour], -1, color=255, thickness=-1, offset=(-x, -y))
+    return patch, mask
+
+
+def dominant_colour(pixels, levels=8):
+    """
+    Finds the most common colour in a small quantized histogram.
+    :param pixels: N x 3 array of BGR pixels
+    :param levels: quantization levels per channel
+    :return: mean BGR value of the pixels in the fullest histogram bin
+    """
+    step = 256 // levels
+    quantized = (pixels // step).astype(np.int32)
+    bins = (quantized[:, 0] * levels + quantized[:, 1]) * levels + quantized[:, 2]
+    fullest = np.bincount(bins, minlength=levels ** 3).argmax()
+    return pixels[bins == fullest].mean(axis=0)
+
+
+def contour_colour(image, contour, method=MEDIAN):
+    """
+    Determines the colour of the pixels within a contour.
+    :param image: BGR image the contour was found in
+    :param contour: a contour, in the image's coordinates
+    :param method: MEAN, MEDIAN or DOMINANT
+    :return: a string value 'r,g,b' representing the colour, or None if the contour is empty.
+    """
+    patch, mask = _masked_pixels(image, contour)
+    return masked_colour(patch, mask, method)
+
+
+def blob_colour(image, box, mask, method=MEDIAN):
+    """
+    Determines the colour of the pixels of a blob.
+    :param image: BGR image the blob was found in
+    :param box: (x, y, w, h) of the blob
+    :param mask: the blob within its box, non-zero inside, e.g. from BlobExtractor.blob_mask()
+    :param method: MEAN, MEDIAN or DOMINANT
+    :return: a string value 'r,g,b' representing the colour, or None if the blob is empty.
+    """
+    x, y, w, h = box
+    return masked_colour(image[y:y + h, x:x + w], mask, method)
+
+
+def masked_colour(patch, mask, method=MEDIAN):
+    """
+    :param patch: BGR pixels
+    :param mask: uint8 mask the size of patch, non-zero for the pixels to use
+    :param method: MEAN, MEDIAN or DOMINANT
+    :return: a string value 'r,g,b' representing the colour, or None if the mask is empty.
+    """
+    if method == MEAN:
+        if not mask.any():
+            return None
+        b, g, r = cv2.mean(patch, mask=mask)[:3]
+    else:
+        pixels = patch[mask > 0]
+        if not len(pixels):
+            return None
+        if method == MEDIAN:
+            b, g, r = np.median(pixels, axis=0)
+        elif method == DOMINANT:
+            b, g, r = dominant_colour(pixels)
+        else:
+            raise ValueError("Unknown colour method: {0}".format(method))
+
+    return '{0},{1},{2}'.format(int(round(r)), int(round(g)), int(round(b)))
@@ -0,0 +1,162 @@
+"""
+Settings for the speed camera.
+
+Every setting and its default is listed in DEFAULTS. A Config starts from
+those and is overridden by a JSON file and then by keyword arguments, e.g.
+from the command line. Nothing is read or opened at import time.
+"""
+
+import json
+from collections import OrderedDict
+
+DEFAULTS = OrderedDict([
+    # Frame source: 'picamera', 'v4l2' (cv2.VideoCapture), 'file' (recorded video) or 'synthetic'
+    ('frame_source', 'picamera'),
+    ('video_device', 0),
+    ('video_file', None),
+    ('replay_realtime', False),  # When replaying a file, False runs as fast as the CPU allows
+    ('image_width', 640),
+    ('image_height', 480),
+    ('field_of_view', 53.5),
+    ('rotation_degrees', 0),  # Rotate image by this amount to create flat road
+
+    # Synthetic traffic, see speedcam.synthetic: rendered at image_width x image_height and day_fps
+    ('synthetic_vehicles_per_minute', 6.0),  # Mean arrivals in each direction
+    ('synthetic_speeds', (15, 55)),  # Slowest and fastest mph
+    ('synthetic_light_period', None),  # Seconds of a full day-night cycle, or None for daylight
+    ('synthetic_light_steps_per_minute', 0.0),  # Sudden changes of light, like passing clouds
+    ('synthetic_noise', 4.0),  # Standard deviation of the sensor noise, in grey levels
+    ('synthetic_duration', None),  # Seconds of traffic, or None to run until stopped
+    ('synthetic_seed', 0),
+    ('synthetic_manifest_path', 'synthetic.json'),  # Ground truth of the traffic, written on exit
+
+    # Frame rates while something is moving, chosen by measured brightness
+    ('day_fps', 30),
+    ('night_fps', 15),
+    ('idle_fps', 5),  # Frame rate while the monitored area is empty; raised if too low to measure idle_design_speed
+    ('idle_design_speed', 50),  # Fastest vehicle (mph) sure to be measured when it arrives at an idle camera
+    ('idle_after', 3.0),  # Seconds without motion before dropping to idle_fps
+
+    # Capture runs on its own thread, feeding the detection loop through a bounded queue
+    ('queue_size', 8),
+    ('queue_policy', None),  # 'drop_oldest', 'block' or 'skip_nth'; None blocks for replays, drops for cameras
+    ('queue_skip_every', 2),  # Only used by skip_nth
+
+    # Monitored area, (upper left x, upper left y, lower right x, lower right y)
+    ('monitored_area', (65, 260, 615, 315)),
+    ('draw_monitored_area', True),  # With use_x, draw the area on screen at start-up
+
+    # Detection
+    ('ltr_distance', 27),  # Left to right distance to median
+    ('rtl_distance', 34),  # Right to left distance to median
+    ('threshold', 15),
+    ('min_area', 125),  # Smallest bounding box, in pixels, that can be a vehicle
+    ('blob_min_aspect', None),  # Narrowest width / height of a vehicle, or None
+    ('blob_max_aspect', None),  # Widest width / height of a vehicle, or None
+    ('blob_reject_edges', ()),  # Blobs touching these edges aren't vehicles: 'top' and/or 'bottom'
+    ('blur_size', (15, 15)),
+    ('minimum_speed', 10),  # Don't detect cars in parking lots, walkers, and slow drivers
+    ('maximum_speed', 100),  # Anything higher than this is likely to be noise.
+    ('speed_threshold', 40),  # Vehicles faster than this are speeders: evidence is kept of them
+    ('track_max_distance', 120),  # Furthest (pixels) a vehicle may be from where its track expected it a
+                                  # day_fps frame later; in proportion after longer, e.g. while idle
+    ('track_max_missed', 3),  # Frames a vehicle may go unseen before its track is dropped
+    ('background_engine', 'running_average'),  # 'running_average', 'mog2' or 'knn'
+    ('day_learning_rate', 0.05),  # Running average only; original is 0.25
+    ('night_learning_rate', 0.25),
+    ('colour_method', 'median'),  # 'mean', 'median' or 'dominant'
+    ('detection_scale', 1.0),  # 0.5 detects at half resolution, for about a third of the work per frame
+
+    # Motion gate: a decimated look at the monitored area decides whether a frame needs full detection
+    ('motion_gate', True),
+    ('gate_levels', 3),  # The gate looks at 1 / 2 ** levels of the width and height
+    ('gate_threshold', 15),
+    ('gate_min_fraction', 0.005),  # Fraction of the gate's pixels that must change to run full detection
+    ('gate_refresh_frames', 30),  # While the road is idle, update the full background this often
+    ('gate_refresh_max_frames', 120),  # ... and at the latest this often, even if no idle frame was quiet
+
+    # Evidence of speeders, encoded on its own thread from a fixed buffer of the latest frames
+    ('evidence_enabled', True),
+    ('evidence_dir', 'evidence'),
+    ('evidence_format', 'clip'),  # 'clip' (MJPG .avi) or 'still' (one JPEG)
+    ('evidence_buffer_mb', 128),  # Memory for buffered frames; 128 MB holds 4.5s of 640x480
+    ('evidence_pre_seconds', 1.0),  # Video kept from before the vehicle entered the monitored area
+    ('evidence_post_seconds', 0.5),  # and after it left
+    ('evidence_queue_size', 4),  # Speeders waiting to be encoded before more are written without evidence
+
+    # Vehicles are written in batches to a local spool file, forwarded to the database when reachable
+    ('database_url', None),  # None uses $SPEEDCAM_DATABASE_URL or db.DEFAULT_URL
+    ('dry_run', False),  # Spool vehicles without ever connecting to the database
+    ('spool_path', 'spool.db'),
+    ('db_batch_size', 50),
+    ('db_flush_interval', 5.0),  # seconds
+
+    # Output
+    ('use_x', True),  # False runs headless: no OpenCV window is ever opened
+    ('display_fps', 10),  # Most redraws per second of the window
+    ('debug', True),  # Also show the motion mask
+    ('preview_port', None),  # Serve a browser preview on this port, e.g. 8080; None serves none
+    ('preview_host', '127.0.0.1'),  # '0.0.0.0' lets other machines in, and anyone in can move the area
+    ('preview_fps', 5),
+    ('preview_quality', 80),  # JPEG quality, 0 to 100
+    ('frame_bus_name', 'speedcam'),  # Shared memory the preview reads frames from; pipelines append their name
+    ('frame_bus_slots', 4),  # Frames kept for viewers
+    ('status_mode', 'terminal'),  # 'terminal', 'log' (JSON lines), 'file' (JSON status file) or 'none'
+    ('status_interval', 1.0),  # seconds
+    ('status_path', 'status.json'),
+    ('metrics_enabled', True),  # False makes every timer a no-op
+    ('metrics_interval', 15.0),  # seconds between exports
+    ('metrics_prometheus_path', 'speedcam.prom'),  # for node_exporter's textfile collector, or None
+    ('metrics_json_path', 'metrics.json'),  # or None
+    ('speed_stats_path', 'speeds.json'),  # Live speed statistics per direction and time window, or None
+    ('speed_stats_interval', 5.0),  # seconds between writes
+    ('speed_stats_window', 900),  # seconds per time window
+    ('speed_stats_windows', 96),  # Windows kept: 96 of 15 minutes is a day
+])
+
+
+class Config(object):
+    """
+    A complete set of settings, as attributes.
+    """
+
+    def __init__(self, **settings):
+        """
+        :param settings: settings to change from DEFAULTS
+        """
+        for name, value in DEFAULTS.items():
+            setattr(self, name, value)
+        self.update(**settings)
+
+    def update(self, **settings):
+        """
+        Changes settings, rejecting names that don't exist so that typos aren't silently ignored.
+        :param settings: name=value pairs
+        :return: self
+        """
+        for name, value in settings.items():
+            if name not in DEFAULTS:
+                raise ValueError("Unknown setting: {0}".format(name))
+            if isinstance(DEFAULTS[name], tuple) and value is not None:
+                value = tuple(value)  # JSON only has lists
+            setattr(self, name, value)
+        return self
+
+    @classmethod
+    def load(cls, path, **settings):
+        """
+        Reads settings from a JSON object in a file.
+        :param path: JSON file
+        :param settings: settings that take precedence over the file
+        :return: Config
+        """
+        with open(path) as f:
+            config = cls(**json.load(f))
+        return config.update(**settings)
+
+    def as_dict(self):
+        return OrderedDict((name, getattr(self, name)) for name in DEFAULTS)
+
+    @property
+    def resolution(self):
+        return self.image_width, self.image_height
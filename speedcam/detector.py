@@ -0,0 +1,266 @@
+"""
+The per-frame detection pipeline.
+
+A Detector takes full frames and their capture times and returns the
+vehicles that finished crossing the monitored area, with their speed,
+confidence and colour:
+
+    [gate] -> crop -> prepare -> background -> blobs -> track -> speed -> colour
+
+With the motion gate, frames in which nothing moves stop after the gate;
+the full-resolution background is then only refreshed every few frames.
+While any vehicle is being tracked, or the background is being rebuilt
+after a change of light, every frame runs the whole pipeline.
+
+It owns no camera, window or database, so the same code runs in
+the application, in the benchmarks and over recorded clips.
+"""
+
+from collections import namedtuple
+
+from speedcam.background import BackgroundModel, RUNNING_AVERAGE
+from speedcam.blobs import BlobExtractor
+from speedcam.colour import blob_colour, MEDIAN
+from speedcam.gate import MotionGate
+from speedcam.metrics import Metrics
+from speedcam.processing import RoiProcessor
+from speedcam.speed import CONFIDENCE_VERSION, PixelScale, estimate_track_speed
+from speedcam.tracker import CentroidTracker, LEFT_TO_RIGHT
+
+Vehicle = namedtuple('Vehicle', ['track', 'estimate', 'colour'])
+FrameResult = namedtuple('FrameResult', ['vehicles', 'boxes', 'small_boxes', 'mask', 'stuck'])
+
+MIN_TRACK_FRAMES = 3  # fewest frames a vehicle must be seen in to be measured
+
+
+def vehicle_row(vehicle, session_id, track_key):
+    """
+    :param vehicle: Vehicle
+    :param session_id: session the vehicle was seen in
+    :param track_key: key unique to the vehicle's track, for idempotent inserts
+    :return: dict of vehicles table columns
+    """
+    track, estimate = vehicle.track, vehicle.estimate
+    return dict(
+        sessionID=str(session_id),
+        datetime=track.last_seen,
+        speed=estimate.mph,
+        direction="North" if track.direction == LEFT_TO_RIGHT else "South",
+        color=vehicle.colour,
+        rating=estimate.confidence,
+        rating_version=CONFIDENCE_VERSION,
+        track_key=track_key,
+        evidence=None,
+    )
+
+
+class Detector(object):
+    """
+    Finds vehicles and measures their speed, one frame at a time.
+    """
+
+    def __init__(self, box, frame_shape, image_width, field_of_view, ltr_distance, rtl_distance,
+                 rotation_degrees=0, blur_size=(15, 15), threshold=15, min_area=125,
+                 background_engine=RUNNING_AVERAGE, minimum_speed=10, maximum_speed=100, track_max_distance=120,
+                 track_interval=None, track_max_missed=3, stuck_frames=50, colour_method=MEDIAN, min_aspect=None,
+                 max_aspect=None, reject_edges=(), motion_gate=False, gate_levels=3,
+                 gate_threshold=15, gate_min_fraction=0.005, gate_refresh_frames=30,
+                 gate_refresh_max_frames=120, audit_gate=False,
+                 detection_scale=1.0, metrics=None):
+        """
+        :param box: (upper_left_x, upper_left_y, lower_right_x, lower_right_y) of the monitored area
+        :param frame_shape: shape of the full frames, (rows, cols, channels)
+        :param image_width: width of the camera image in pixels
+        :param field_of_view: horizontal field of view of the camera, in degrees
+        :param ltr_distance: distance to the left-to-right lane, in feet
+        :param rtl_distance: distance to the right-to-left lane, in feet
+        :param rotation_degrees: rotate frames by this amount to create a flat road
+        :param blur_size: Gaussian blur kernel size
+        :param threshold: difference from the background that counts as motion
+        :param min_area: smallest bounding-box area, in pixels, that can be a vehicle
+        :param background_engine: one of background.ENGINES
+        :param minimum_speed: vehicles slower than this (mph) are ignored
+        :param maximum_speed: vehicles this fast or faster (mph) are taken for noise
+        :param track_max_distance: furthest (pixels) a vehicle may be from where its track expected it
+        :param track_interval: seconds after which track_max_distance applies, further in proportion; None: always
+        :param track_max_missed: frames a vehicle may go unseen before its track is dropped
+        :param stuck_frames: a track this long means the background is wrong; it is rebuilt
+        :param colour_method: one of colour.MEAN, MEDIAN or DOMINANT
+        :param min_aspect: narrowest width / height of a vehicle's bounding box, or None
+        :param max_aspect: widest width / height of a vehicle's bounding box, or None
+        :param reject_edges: blobs touching any of these edges of the monitored area, see blobs.EDGES,
+            are not vehicles; vehicles enter from the left and right
+        :param motion_gate: skip the full pipeline on frames in which the gate sees nothing move
+        :param gate_levels: each level halves the width and height the gate looks at
+        :param gate_threshold: difference from the gate's background that counts as change
+        :param gate_min_fraction: fraction of the gate's pixels that must change to open it
+        :param gate_refresh_frames: while the gate is closed, update the full background this often
+        :param gate_refresh_max_frames: update it after this many closed frames even if none was quiet
+        :param audit_gate: run the full pipeline on every frame anyway, counting the gate's misses
+        :param detection_scale: detect at this fraction of the camera resolution, e.g. 0.5
+        :param metrics: Metrics to time the stages into, or None
+        """
+        # sizes are given in camera pixels; the pipeline works in detection pixels
+        self.minimum_speed = minimum_speed
+        self.maximum_speed = maximum_speed
+        self.stuck_frames = stuck_frames
+        self.colour_method = colour_method
+        self.detection_scale = detection_scale
+        self.metrics = metrics or Metrics(enabled=False)
+
+        self.processor = RoiProcessor(box, frame_shape, rotation_degrees, blur_size, detection_scale)
+        self.background = BackgroundModel(background_engine, self.processor.shape, threshold)
+        self.blobs = BlobExtractor(self.processor.shape, min_area * detection_scale ** 2, min_aspect, max_aspect,
+                                   reject_edges)
+        self.tracker = CentroidTracker(self.processor.width, track_max_distance * detection_scale, track_max_missed,
+                                       interval=track_interval)
+        self.scale = PixelScale(self.processor.width, image_width, field_of_view, ltr_distance, rtl_distance,
+                                pixel_size=1.0 / detection_scale)
+
+        self.gate = None
+        if motion_gate:
+            x1, y1, x2, y2 = box
+            self.gate = MotionGate((y2 - y1, x2 - x1), gate_levels, gate_threshold, gate_min_fraction)
+        self.gate_refresh_frames = gate_refresh_frames
+        self.gate_refresh_max_frames = gate_refresh_max_frames
+        self.since_refresh = 0
+        self.audit_gate = audit_gate
+        self.gated_frames = 0  # frames the gate kept from the full pipeline
+        self.gate_misses = 0  # audited frames the gate closed on, yet the full pipeline found something in
+
+        self.stuck = False
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config, box, frame_shape, metrics=None, audit_gate=False):
+        """
+        :param config: Config
+        :param box: monitored area, which may differ from config.monitored_area if drawn by the user
+        :param frame_shape: shape of the full frames
+        :param metrics: Metrics to time the stages into, or None
+        :param audit_gate: run the full pipeline on every frame anyway, counting the gate's misses
+        :return: Detector
+        """
+        return cls(box, frame_shape, config.image_width, config.field_of_view, config.ltr_distance,
+                   config.rtl_distance, rotation_degrees=config.rotation_degrees, blur_size=config.blur_size,
+                   threshold=config.threshold, min_area=config.min_area,
+                   background_engine=config.background_engine, minimum_speed=config.minimum_speed,
+                   maximum_speed=config.maximum_speed, track_max_distance=config.track_max_distance,
+                   track_interval=1.0 / config.day_fps, track_max_missed=config.track_max_missed,
+                   colour_method=config.colour_method,
+                   min_aspect=config.blob_min_aspect, max_aspect=config.blob_max_aspect,
+                   reject_edges=config.blob_reject_edges, motion_gate=config.motion_gate,
+                   gate_levels=config.gate_levels, gate_threshold=config.gate_threshold,
+                   gate_min_fraction=config.gate_min_fraction,
+                   gate_refresh_frames=config.gate_refresh_frames,
+                   gate_refresh_max_frames=config.gate_refresh_max_frames, audit_gate=audit_gate,
+                   detection_scale=config.detection_scale, metrics=metrics)
+
+    @property
+    def tracking(self):
+        return bool(self.tracker.tracks)
+
+    def process(self, image, timestamp, nighttime=False, keep_small=False):
+        """
+        Runs one frame through the pipeline.
+        :param image: full BGR frame
+        :param timestamp: capture time of the frame
+        :param nighttime: skip colour extraction, which headlights make meaningless
+        :param keep_small: also return the boxes too small to be vehicles, for display
+        :return: FrameResult; its mask is overwritten by the next call
+        """
+        metrics = self.metrics
+        if self.stuck:
+            self.stuck = False
+            self.background.reset()
+            if self.gate is not None:
+                self.gate.reset()
+
+        # a replacement background being trained after a change of light needs every frame
+        gate_checked = gate_closed = False
+        if self.gate is not None and not self.tracker.tracks and not self.background.rebuilding:
+            gate_checked = True
+            with metrics.stage('gate'):
+                gate_closed = not self.gate.apply(self.processor.frame_roi(image))
+            if gate_closed:
+                self.gated_frames += 1
+                self.since_refresh += 1
+                self.gate.learn()
+                if not self.audit_gate:
+                    # a refresh absorbs the frame strongly, so wait for a quiet one, but not for ever: under
+                    # steady noise the background, and the brightness measured from it, would go stale
+                    if (self.since_refresh >= self.gate_refresh_frames and self.gate.quiet() or
+                            self.since_refresh >= self.gate_refresh_max_frames):
+                        self._refresh_background(image)
+                    return FrameResult([], [], [], self.background.mask, False)
+
+        with metrics.stage('crop'):
+            roi = self.processor.crop(image)
+        with metrics.stage('prepare'):
+            gray = self.processor.prepare(roi)
+
+        # learn the background only while no vehicle is being tracked
+        with metrics.stage('background'):
+            mask = self.background.apply(gray, learn=not self.tracker.tracks)
+
+        # label every blob and keep those that could be vehicles, without a Python loop over them
+        with metrics.stage('blobs'):
+            blobs, chosen, keep = self.blobs.find(mask)
+            boxes = [tuple(box) for box in blobs.boxes[chosen].tolist()]
+            ids = blobs.ids[chosen].tolist()
+        small_boxes = [tuple(box) for box in blobs.boxes[~keep].tolist()] if keep_small else []
+
+        if gate_closed and boxes:
+            self.gate_misses += 1
+        elif gate_checked and not gate_closed and not boxes:
+            self.gate.learn()  # opened for nothing, e.g. a change of light it hasn't absorbed yet
+
+        with metrics.stage('track'):
+            finished = self.tracker.update(boxes, ids, timestamp)[1]
+
+        vehicles = []
+        for track in finished:
+            if not track.exited or track.count < MIN_TRACK_FRAMES:
+                continue
+
+            with metrics.stage('speed'):
+                estimate = estimate_track_speed(track, self.scale)
+            if estimate is None or not (self.minimum_speed <= estimate.mph < self.maximum_speed):
+                self.rejected += 1
+                metrics.count('rejected_tracks')
+                continue
+
+            colour = 'nighttime'
+            if not nighttime:
+                with metrics.stage('colour'):
+                    # an exited track was seen in this frame, so its label is current
+                    colour = blob_colour(roi, track.box, self.blobs.blob_mask(track.blob, track.box),
+                                         self.colour_method)
+            vehicles.append(Vehicle(track, estimate, colour))
+
+        # a track that never ends is a background that no longer matches the road
+        stuck = any(track.count >= self.stuck_frames for track in self.tracker.tracks)
+        if stuck:
+            self.tracker.clear()
+            self.stuck = True
+
+        if self.detection_scale != 1.0:  # back to camera pixels for display
+            boxes = [tuple(int(v / self.detection_scale) for v in box) for box in boxes]
+            small_boxes = [tuple(int(v / self.detection_scale) for v in box) for box in small_boxes]
+        return FrameResult(vehicles, boxes, small_boxes, mask, stuck)
+
+    def _refresh_background(self, image):
+        """
+        Brings the full background up to date with an idle frame, as if it had learnt from every
+        frame the gate skipped since the last refresh.
+        :param image: full BGR frame in which nothing is moving
+        :return: None
+        """
+        background = self.background
+        with self.metrics.stage('background'):
+            rate = background.learning_rate
+            if background.engine_name == RUNNING_AVERAGE:
+                background.learning_rate = 1.0 - (1.0 - rate) ** self.since_refresh
+            self.since_refresh = 0
+            background.apply(self.processor.prepare(self.processor.crop(image)), learn=True)
+            background.learning_rate = rate
@@ -0,0 +1,188 @@
+"""
+Optional on-screen display.
+
+The Display owns every OpenCV window call. HighGUI is only safe on the
+main thread with the Qt and Cocoa backends, so the display runs there,
+like select_monitored_area before it, and detection runs on a thread of
+its own. It reads the frames the detection loop publishes to a FrameBus,
+at its own pace, so an X server that is slow, remote or missing can never
+hold detection up. Annotations are drawn on the display's own copy of the
+frame, never on the one being analysed.
+
+The same windows can be opened from another process, or another terminal,
+while a camera publishes to a shared frame bus:
+
+    python -m speedcam.display [--bus speedcam]
+"""
+
+import argparse
+import datetime
+import threading
+
+import cv2
+
+from speedcam.framebus import FrameBusReader
+
+
+def annotate(image, box, boxes, text, timestamp, prompt=None):
+    """
+    Draws what was found in a frame onto it.
+    :param image: straightened full frame, which is modified
+    :param box: monitored area, (upper left x, upper left y, lower right x, lower right y)
+    :param boxes: (x, y, w, h, is_vehicle) in monitored-area coordinates
+    :param text: road status
+    :param timestamp: capture time of the frame, in seconds since the epoch
+    :param prompt: line of instructions, or None
+    :return: the image
+    """
+    left, top, right, bottom = box
+    for x, y, w, h, is_vehicle in boxes:
+        colour = (0, 0, 255) if is_vehicle else (255, 0, 0)
+        cv2.rectangle(image, (left + x, top + y), (left + x + w, top + y + h), colour, 2)
+
+    # draw the text and timestamp on the frame
+    cv2.putText(image, datetime.datetime.fromtimestamp(timestamp).strftime("%A %d %B %Y %I:%M:%S%p"),
+                (10, image.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 1)
+    cv2.putText(image, "Road Status: {}".format(text), (10, 20),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
+    if prompt:
+        cv2.putText(image, prompt, (10, 35), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
+
+    # define the monitored area right and left boundary
+    cv2.line(image, (left, top), (left, bottom), (0, 255, 0))
+    cv2.line(image, (right, top), (right, bottom), (0, 255, 0))
+    return image
+
+
+class Display(object):
+    """
+    Shows the latest published frame with its annotations at a limited rate, from the thread that runs it.
+    """
+
+    def __init__(self, reader, max_fps=10, window="Speed Camera", debug_window=None):
+        """
+        :param reader: FrameBusReader of the frames to show
+        :param max_fps: most redraws per second
+        :param window: name of the main window
+        :param debug_window: name of a window showing the motion mask, or None for no mask
+        """
+        self.reader = reader
+        self.interval = 1.0 / max_fps
+        self.window = window
+        self.debug_window = debug_window
+        self.prompt = "Press 'q' to quit"
+        self.shown = 0
+        self.missed = 0  # frames overwritten on the bus while being copied
+
+        self.quit_requested = threading.Event()
+        self._stop_event = threading.Event()
+
+    def redraw(self, last):
+        """
+        Shows the latest frame if it is newer than the last one shown.
+        :param last: sequence number of the last frame shown
+        :return: sequence number of the frame now shown
+        """
+        self.reader.request()
+        published = self.reader.latest()
+        if published is None or published.sequence == last:
+            return last
+
+        image = published.image.copy()
+        mask = published.mask.copy() if self.debug_window and published.mask.size else None
+        if not self.reader.valid(published):
+            self.missed += 1
+            return last
+
+        annotate(image, published.box, published.boxes, published.text, published.timestamp, self.prompt)
+        cv2.imshow(self.window, image)
+        if mask is not None:
+            cv2.imshow(self.debug_window, mask)
+        self.shown += 1
+        return published.sequence
+
+    def run(self):
+        """
+        Redraws until stopped or 'q' is pressed in the window. Call it on the main thread.
+        :return: None
+        """
+        last = None
+        wait = max(int(self.interval * 1000), 1)
+        while not self._stop_event.is_set():
+            last = self.redraw(last)
+            # windows only repaint while waitKey runs, so keep calling it even without new frames
+            if cv2.waitKey(wait) & 0xFF == ord("q"):
+                self.quit_requested.set()
+                break
+
+        cv2.destroyAllWindows()
+        self.reader.close()
+
+    def stop(self):
+        """
+        Makes run() close the windows and return, from any thread.
+        :return: None
+        """
+        self._stop_event.set()
+
+
+def select_monitored_area(image, box, window="Speed Camera"):
+    """
+    Lets the user drag a rectangle over a reference image to choose the monitored area.
+    :param image: reference frame, already straightened
+    :param box: area to use if nothing is drawn
+    :param window: name of the window to draw in
+    :return: (upper left x, upper left y, lower right x, lower right y)
+    """
+    prompt = "Define the monitored area - press 'c' to continue"
+    state = dict(drawing=False, start=None, end=None)
+
+    def redraw():
+        shown = image.copy()
+        cv2.putText(shown, prompt, (10, 35), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)
+        if state['start'] is not None and state['end'] is not None:
+            cv2.rectangle(shown, state['start'], state['end'], (0, 255, 0), 2)
+        return shown
+
+    def on_mouse(event, x, y, flags, param):
+        if event == cv2.EVENT_LBUTTONDOWN:
+            state.update(drawing=True, start=(x, y), end=(x, y))
+        elif event == cv2.EVENT_MOUSEMOVE and state['drawing']:
+            state['end'] = (x, y)
+        elif event == cv2.EVENT_LBUTTONUP:
+            state.update(drawing=False, end=(x, y))
+
+    # create an image window and place it in the upper left corner of the screen
+    cv2.namedWindow(window, cv2.WINDOW_AUTOSIZE)
+    cv2.moveWindow(window, 10, 40)
+    cv2.setMouseCallback(window, on_mouse)
+
+    # wait while the user draws the monitored area's boundary, until 'c' is pressed
+    while True:
+        cv2.imshow(window, redraw())
+        if cv2.waitKey(1) & 0xFF == ord("c"):
+            break
+    cv2.destroyWindow(window)  # the display opens its own windows
+
+    if state['start'] is None or state['start'] == state['end']:
+        return tuple(box)
+
+    # the rectangle could be drawn starting from any corner, so normalize the coordinates
+    (ix, iy), (fx, fy) = state['start'], state['end']
+    return min(ix, fx), min(iy, fy), max(ix, fx), max(iy, fy)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show the frames a speed camera publishes.")
+    parser.add_argument('--bus', default='speedcam', help="frame_bus_name of the camera")
+    parser.add_argument('--fps', type=float, default=10)
+    parser.add_argument('--no-mask', action='store_true', help="don't show the motion mask")
+    args = parser.parse_args(argv)
+
+    display = Display(FrameBusReader(args.bus), args.fps, debug_window=None if args.no_mask else "DebugView")
+    display.run()  # 'q' in the window quits
+    return 0
+
+
+if __name__ == '__main__':
+    main()
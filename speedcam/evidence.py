@@ -0,0 +1,260 @@
+"""
+Image evidence of speeders.
+
+Every frame is kept in a FrameRing, by reference: frame sources hand over a
+new image for every frame, and nothing draws on it afterwards, so nothing
+is copied. The ring holds as many frames as fit in evidence_buffer_mb and
+drops the oldest, so its memory is fixed whatever happens downstream. When a vehicle faster than the speed
+threshold leaves the monitored area, the detection loop only queues a job.
+The EvidenceRecorder thread takes the frames around the vehicle's passage
+from the ring and encodes them to disk: an MJPG clip or one JPEG still.
+Once the file is written, the recorder submits the vehicle row with its
+path in the evidence column. If the recorder's queue is full, the row is
+submitted without evidence rather than waiting.
+
+Frames the ring drops before the recorder reaches them are left out of the
+clip and counted as overwritten; a larger buffer prevents
+that.
+"""
+
+import datetime
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+CLIP = 'clip'
+STILL = 'still'
+FORMATS = (CLIP, STILL)
+
+
+class FrameRing(object):
+    """
+    The most recent frames, as many as fit in a fixed amount of memory.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: memory for the frames; the ring holds as many as fit, at least one
+        """
+        self.max_bytes = max_bytes
+        self.capacity = 0
+        self.frames = None  # sized on the first push, once the frame size is known
+        self.timestamps = None
+        self.pushed = 0
+        self._lock = threading.Lock()
+        self._arrived = threading.Condition(self._lock)
+
+    def push(self, image, timestamp):
+        """
+        Keeps a frame in the ring, in place of the oldest one. The frame is not copied, so it must
+        not be modified afterwards: sources hand over a new image for every frame.
+        :param image: frame, the same shape every time
+        :param timestamp: capture time of the frame
+        :return: None
+        """
+        with self._lock:
+            if self.frames is None:
+                self.capacity = max(int(self.max_bytes // image.nbytes), 1)
+                self.frames = [None] * self.capacity
+                self.timestamps = [None] * self.capacity
+            slot = self.pushed % self.capacity
+            self.frames[slot] = image
+            self.timestamps[slot] = timestamp
+            self.pushed += 1
+            self._arrived.notify_all()
+
+    def between(self, start, end):
+        """
+        :param start: earliest capture time
+        :param end: latest capture time
+        :return: sequence numbers of the frames in the ring captured from start to end
+        """
+        with self._lock:
+            first = max(self.pushed - self.capacity, 0)
+            return [sequence for sequence in range(first, self.pushed)
+                    if start <= self.timestamps[sequence % self.capacity] <= end]
+
+    def get(self, sequence):
+        """
+        :param sequence: sequence number of a frame
+        :return: (frame, capture time), or None if it has been dropped; the frame stays valid once dropped
+        """
+        with self._lock:
+            if sequence < self.pushed - self.capacity or sequence >= self.pushed:
+                return None
+            slot = sequence % self.capacity
+            return self.frames[slot], self.timestamps[slot]
+
+    def wait_for(self, timestamp, timeout):
+        """
+        Waits for a frame captured at or after a time.
+        :param timestamp: capture time to wait for
+        :param timeout: most seconds to wait
+        :return: True if such a frame has arrived
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            while not (self.pushed and self.timestamps[(self.pushed - 1) % self.capacity] >= timestamp):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._arrived.wait(remaining)
+            return True
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return 0 if self.frames is None else sum(frame.nbytes for frame in self.frames if frame is not None)
+
+
+class EvidenceRecorder(threading.Thread):
+    """
+    Encodes the frames around speeders to disk and then submits their rows.
+    """
+
+    def __init__(self, ring, sink, directory, fmt=CLIP, pre_seconds=1.0, post_seconds=0.5, queue_size=4):
+        """
+        :param ring: FrameRing the detection loop pushes every frame into
+        :param sink: where rows go once their evidence is written, e.g. a DetectionWriter
+        :param directory: evidence is written to dated directories under this
+        :param fmt: CLIP or STILL
+        :param pre_seconds: seconds of video before the vehicle entered the monitored area
+        :param post_seconds: seconds of video after it left
+        :param queue_size: vehicles waiting to be encoded before more are submitted without evidence
+        """
+        super(EvidenceRecorder, self).__init__(name="evidence")
+        self.daemon = True
+        if fmt not in FORMATS:
+            raise ValueError("Unknown evidence format: {0}".format(fmt))
+        self.ring = ring
+        self.sink = sink
+        self.directory = directory
+        self.fmt = fmt
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.jobs = queue.Queue(maxsize=queue_size)
+
+        self.recorded = 0
+        self.dropped = 0
+        self.failed = 0
+        self.overwritten = 0
+        self.last_encode_seconds = 0.0
+        self._stopping = threading.Event()
+
+    def record(self, row, first_seen, last_seen, label=''):
+        """
+        Queues a vehicle for evidence. Never waits.
+        :param row: vehicles row, submitted to the sink once the evidence is written
+        :param first_seen: capture time the vehicle entered the monitored area
+        :param last_seen: capture time it left
+        :param label: text drawn on the evidence
+        :return: True if queued; if False the caller still owns the row
+        """
+        try:
+            self.jobs.put_nowait((row, first_seen, last_seen, label))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def path_for(self, row, last_seen):
+        name = "{0:%H%M%S}_{1:.0f}mph_{2}".format(last_seen, row['speed'], row['track_key'].replace(':', '-'))
+        return os.path.join(self.directory, last_seen.strftime('%Y%m%d'),
+                            name + ('.avi' if self.fmt == CLIP else '.jpg'))
+
+    def collect(self, first_seen, last_seen):
+        """
+        Takes the frames around a vehicle from the ring.
+        :return: list of (frame, capture time)
+        """
+        start = first_seen - datetime.timedelta(seconds=self.pre_seconds)
+        end = last_seen + datetime.timedelta(seconds=self.post_seconds)
+        sequences = self.ring.between(start, end)
+        frames = [self.ring.get(sequence) for sequence in sequences]  # before they are dropped
+
+        if not self._stopping.is_set() and self.ring.wait_for(end, self.post_seconds + 1.0):
+            after = sequences[-1] if sequences else -1
+            frames += [self.ring.get(sequence) for sequence in self.ring.between(start, end) if sequence > after]
+
+        self.overwritten += sum(frame is None for frame in frames)
+        return [frame for frame in frames if frame is not None]
+
+    def encode(self, frames, path, label):
+        """
+        Writes frames to path, atomically.
+        :return: None
+        """
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for image, timestamp in frames:
+            cv2.putText(image, "{0} {1}".format(timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')[:-4], label),
+                        (10, image.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+
+        base, extension = os.path.splitext(path)
+        temporary = base + '.tmp' + extension  # OpenCV picks the container by extension
+        if self.fmt == STILL:
+            if not cv2.imwrite(temporary, frames[len(frames) // 2][0]):
+                raise IOError("Could not write {0}".format(temporary))
+        else:
+            elapsed = (frames[-1][1] - frames[0][1]).total_seconds()
+            fps = (len(frames) - 1) / elapsed if elapsed > 0 else 10.0
+            height, width = frames[0][0].shape[:2]
+            writer = cv2.VideoWriter(temporary, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+            if not writer.isOpened():
+                raise IOError("Could not write {0}".format(temporary))
+            try:
+                for image, timestamp in frames:
+                    writer.write(image)
+            finally:
+                writer.release()
+        os.replace(temporary, path)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            row, first_seen, last_seen, label = job
+            started = time.time()
+            try:
+                frames = self.collect(first_seen, last_seen)
+                if frames:
+                    path = self.path_for(row, last_seen)
+                    self.encode(frames, path, label)
+                    row = dict(row, evidence=path)
+                    self.recorded += 1
+                else:
+                    self.failed += 1
+            except Exception as e:  # Keep the row; only its evidence is lost
+                print("Evidence failed: {0}".format(e))
+                self.failed += 1
+            self.last_encode_seconds = time.time() - started
+            self.sink.submit(row)
+
+    def stop(self, timeout=None):
+        """
+        Encodes what is queued, without waiting for more frames, and stops the thread.
+        :param timeout: seconds to wait for the thread
+        :return: None
+        """
+        self._stopping.set()
+        self.jobs.put(None)
+        if self.is_alive():
+            self.join(timeout)
+
+    def stats(self):
+        return {
+            'queued': self.jobs.qsize(),
+            'recorded': self.recorded,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'overwritten_frames': self.overwritten,
+            'last_encode_seconds': self.last_encode_seconds,
+            'buffer_frames': self.ring.capacity,
+            'buffer_bytes': self.ring.nbytes,
+        }
@@ -0,0 +1,382 @@
+"""
+Frames for viewers, in shared memory.
+
+The detection process publishes the straightened frame, its motion mask
+and what it found (the monitored area, the boxes, the road status) into a
+ring of slots in one multiprocessing.shared_memory block. Viewers in other
+processes, such as the preview server (speedcam.preview), map the same
+block and read frames as numpy views of it: nothing is pickled, piped or
+copied on the way. A viewer that wants to draw on a frame copies it first,
+so annotations never reach the pixels that detection analyses.
+
+Each slot carries the sequence number of the frame in it; the publisher
+clears it while writing. A reader checks it before and after using a
+frame, and drops frames overwritten in the meantime, so the publisher
+never waits for readers while they use a frame. Sequence numbers are only
+written and read under a lock shared by the processes, a POSIX record lock
+on the block: plain numpy loads and stores are no memory barrier, and on a
+weakly ordered CPU such as the Pi's ARM a reader could otherwise see a new
+sequence number before the pixels written ahead of it. Frames are only
+published when a reader has asked for one recently, at most max_fps times
+a second, so an unwatched bus costs detection nothing but a clock check.
+
+Readers can also ask the detection process to move the monitored area;
+it picks the request up between frames.
+
+Shared memory needs Python 3.8. Without a name the bus lives in private
+memory, for readers in the same process such as the display.
+"""
+
+import os
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows; the x86 CPUs it mostly runs on keep stores, and loads, in order
+    fcntl = None
+
+MAGIC = b'SCFB'
+VERSION = 1
+DEMAND_SECONDS = 2.0  # a reader's request for frames lasts this long
+TEXT_BYTES = 64
+
+HEADER = np.dtype([
+    ('magic', 'S4'), ('version', '<u4'), ('slots', '<u4'), ('rows', '<u4'), ('cols', '<u4'),
+    ('channels', '<u4'), ('max_boxes', '<u4'), ('pid', '<u4'), ('closed', '<u4'),
+    ('roi_serial', '<u4'), ('roi_request', '<i4', (4,)),  # written by readers
+    ('latest', '<i8'), ('demand', '<f8'),
+])
+
+# boxes are (x, y, w, h, is_vehicle) in monitored-area coordinates
+Published = namedtuple('Published', ['sequence', 'timestamp', 'box', 'boxes', 'text', 'image', 'mask'])
+
+
+def _slot_dtype(max_boxes):
+    return np.dtype([
+        ('sequence', '<i8'), ('timestamp', '<f8'), ('box', '<i4', (4,)), ('mask_rows', '<u4'),
+        ('mask_cols', '<u4'), ('count', '<u4'), ('boxes', '<i4', (max_boxes, 5)), ('text', 'S{0}'.format(TEXT_BYTES)),
+    ])
+
+
+def _aligned(offset, alignment=64):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _layout(slots, rows, cols, channels, max_boxes):
+    """
+    :return: (slot dtype, offset of the slots, of the frames, of the masks, total size in bytes)
+    """
+    slot = _slot_dtype(max_boxes)
+    slots_at = _aligned(HEADER.itemsize)
+    frames_at = _aligned(slots_at + slots * slot.itemsize)
+    masks_at = _aligned(frames_at + slots * rows * cols * channels)
+    return slot, slots_at, frames_at, masks_at, masks_at + slots * rows * cols
+
+
+class _Views(object):
+    """
+    The header, slots, frames and masks of a bus, as numpy arrays over its memory.
+    """
+
+    def __init__(self, buf):
+        self.header = np.ndarray((), dtype=HEADER, buffer=buf)
+        h = self.header
+        slots, rows, cols, channels = int(h['slots']), int(h['rows']), int(h['cols']), int(h['channels'])
+        slot, slots_at, frames_at, masks_at, size = _layout(slots, rows, cols, channels, int(h['max_boxes']))
+        self.slots = np.ndarray((slots,), dtype=slot, buffer=buf, offset=slots_at)
+        self.frames = np.ndarray((slots, rows, cols, channels), dtype=np.uint8, buffer=buf, offset=frames_at)
+        self.masks = np.ndarray((slots, rows * cols), dtype=np.uint8, buffer=buf, offset=masks_at)
+
+
+def _shared_memory():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError("A named frame bus needs Python 3.8 or later; set frame_bus_name to None")
+    return shared_memory
+
+
+def _attach(name):
+    """
+    Maps an existing shared memory block without taking ownership of it.
+    """
+    shared_memory = _shared_memory()
+    try:
+        return shared_memory.SharedMemory(name, track=False)  # Python 3.13
+    except TypeError:
+        pass
+    block = shared_memory.SharedMemory(name)
+    # before 3.13 every process that maps a block would otherwise unlink it at exit
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+class _SequenceLock(object):
+    """
+    Lock around the sequence numbers of a bus, between the threads of a process and, given the file
+    descriptor of the shared memory, between processes.
+    """
+
+    def __init__(self, fd=None):
+        self.fd = fd if fcntl is not None else None
+        self._lock = threading.Lock()  # record locks belong to the process, not to one of its threads
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self.fd is not None:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._lock.release()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if self.fd is not None:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+
+def _close(block):
+    try:
+        block.close()
+    except BufferError:  # frames still referenced; the mapping goes when they do
+        pass
+
+
+class FrameBus(object):
+    """
+    The publishing end, in the detection process.
+    """
+
+    def __init__(self, name=None, slots=4, max_boxes=32, max_fps=10):
+        """
+        :param name: name of the shared memory block, or None for private memory
+        :param slots: frames kept; a reader has slots - 1 publications to finish with a frame
+        :param max_boxes: boxes kept per frame, vehicles first
+        :param max_fps: most frames published per second
+        """
+        self.name = name
+        self.slots = slots
+        self.max_boxes = max_boxes
+        self.interval = 1.0 / max_fps
+        self.views = None  # created on the first publish, once the frame size is known
+        self.lock = None
+        self.published = 0
+        self._block = None
+        self._last_publish = 0.0
+        self._roi_serial = 0
+
+    def open(self, shape):
+        """
+        Allocates the bus for frames of a shape.
+        :param shape: (rows, cols, channels) of the frames
+        :return: None
+        """
+        rows, cols, channels = shape
+        size = _layout(self.slots, rows, cols, channels, self.max_boxes)[-1]
+        if self.name is None:
+            buf = bytearray(size)
+            self.lock = _SequenceLock()
+        else:
+            shared_memory = _shared_memory()
+            try:
+                self._block = shared_memory.SharedMemory(self.name, create=True, size=size)
+            except FileExistsError:  # left behind by a process that was killed
+                _attach(self.name).unlink()
+                self._block = shared_memory.SharedMemory(self.name, create=True, size=size)
+            buf = self._block.buf
+            self.lock = _SequenceLock(getattr(self._block, '_fd', None))
+
+        header = np.ndarray((), dtype=HEADER, buffer=buf)
+        header[...] = (MAGIC, VERSION, self.slots, rows, cols, channels, self.max_boxes, os.getpid(), 0, 0,
+                       (0, 0, 0, 0), -1, 0.0)
+        self.views = _Views(buf)
+        self.views.slots['sequence'] = -1
+
+    def wants_frame(self):
+        """
+        Cheap check for the detection loop, so frames are only copied when someone will look at them.
+        :return: True if a frame should be published now
+        """
+        now = time.time()
+        if now - self._last_publish < self.interval:
+            return False
+        return self.views is None or now - float(self.views.header['demand']) < DEMAND_SECONDS
+
+    def publish(self, image, timestamp, box, boxes=(), text='', mask=None):
+        """
+        Copies a frame and what was found in it into the next slot.
+        :param image: straightened full frame
+        :param timestamp: capture time of the frame
+        :param box: monitored area, (upper left x, upper left y, lower right x, lower right y)
+        :param boxes: (x, y, w, h, is_vehicle) in monitored-area coordinates
+        :param text: road status
+        :param mask: motion mask of the monitored area, or None
+        :return: sequence number of the frame
+        """
+        if self.views is None:
+            self.open(image.shape)
+        views = self.views
+        sequence = self.published
+        index = sequence % self.slots
+        slot = views.slots[index]
+
+        with self.lock:
+            slot['sequence'] = -1  # readers drop the slot until it is complete
+        np.copyto(views.frames[index], image)
+        if mask is not None:
+            rows, cols = mask.shape
+            views.masks[index, :rows * cols].reshape(rows, cols)[...] = mask
+            slot['mask_rows'], slot['mask_cols'] = rows, cols
+        else:
+            slot['mask_rows'] = slot['mask_cols'] = 0
+        boxes = list(boxes)[:self.max_boxes]
+        if boxes:
+            slot['boxes'][:len(boxes)] = boxes
+        slot['count'] = len(boxes)
+        slot['box'] = box
+        slot['text'] = text.encode('utf-8')[:TEXT_BYTES]
+        slot['timestamp'] = timestamp.timestamp() if hasattr(timestamp, 'timestamp') else timestamp
+        with self.lock:
+            slot['sequence'] = sequence
+            views.header['latest'] = sequence
+
+        self.published += 1
+        self._last_publish = time.time()
+        return sequence
+
+    def roi_request(self):
+        """
+        :return: the monitored area a reader asked for since the last call, or None
+        """
+        if self.views is None:
+            return None
+        header = self.views.header
+        with self.lock:
+            serial = int(header['roi_serial'])
+            if serial == self._roi_serial:
+                return None
+            self._roi_serial = serial
+            return tuple(int(v) for v in header['roi_request'])
+
+    def close(self):
+        """
+        Tells readers the bus is gone and frees it.
+        :return: None
+        """
+        if self.views is not None:
+            self.views.header['closed'] = 1
+        self.views = None
+        self.lock = None
+        if self._block is not None:
+            _close(self._block)
+            self._block.unlink()
+            self._block = None
+
+
+class FrameBusReader(object):
+    """
+    The reading end, in a viewer.
+    """
+
+    def __init__(self, name=None, bus=None):
+        """
+        :param name: name of a shared FrameBus, which may not exist yet
+        :param bus: FrameBus in this process, instead of a name
+        """
+        self.name = name
+        self.bus = bus
+        self.views = None
+        self.lock = None
+        self._block = None
+
+    def _connect(self):
+        if self.bus is not None:
+            self.views, self.lock = self.bus.views, self.bus.lock
+        elif self.views is None:
+            try:
+                self._block = _attach(self.name)
+            except FileNotFoundError:
+                return None
+            views = _Views(self._block.buf)
+            if views.header['magic'] != MAGIC or views.header['version'] != VERSION:
+                self.close()
+                raise ValueError("{0} is not a frame bus".format(self.name))
+            self.views = views
+            self.lock = _SequenceLock(getattr(self._block, '_fd', None))
+        elif self.views.header['closed']:  # the publisher restarted; its new bus is a new block
+            self.close()
+            return self._connect()
+        return self.views
+
+    def request(self):
+        """
+        Asks the publisher for frames for the next few seconds.
+        :return: None
+        """
+        views = self._connect()
+        if views is not None:
+            views.header['demand'] = time.time()
+
+    def latest(self):
+        """
+        The most recent frame, as views of the bus. Check valid() after using them.
+        :return: Published, or None if nothing has been published
+        """
+        views = self._connect()
+        if views is None:
+            return None
+        with self.lock:
+            sequence = int(views.header['latest'])
+            if sequence < 0:
+                return None
+            index = sequence % len(views.slots)
+            slot = views.slots[index]
+            if int(slot['sequence']) != sequence:
+                return None
+        published = Published(sequence, float(slot['timestamp']), tuple(int(v) for v in slot['box']),
+                              [tuple(int(v) for v in b) for b in slot['boxes'][:int(slot['count'])]],
+                              slot['text'].decode('utf-8', 'replace'), views.frames[index],
+                              views.masks[index, :int(slot['mask_rows']) * int(slot['mask_cols'])].reshape(
+                                  int(slot['mask_rows']), int(slot['mask_cols'])))
+        return published if self.valid(published) else None
+
+    def valid(self, published):
+        """
+        :param published: from latest()
+        :return: True if its slot has not been overwritten since
+        """
+        views = self.views
+        if views is None:
+            return False
+        with self.lock:
+            return int(views.slots[published.sequence % len(views.slots)]['sequence']) == published.sequence
+
+    def request_roi(self, box):
+        """
+        Asks the detection process to monitor another area.
+        :param box: (upper left x, upper left y, lower right x, lower right y)
+        :return: True if the request was made
+        """
+        views = self._connect()
+        if views is None:
+            return False
+        with self.lock:
+            views.header['roi_request'] = box
+            views.header['roi_serial'] = int(views.header['roi_serial']) + 1
+        return True
+
+    def close(self):
+        self.views = None
+        self.lock = None
+        if self._block is not None:
+            _close(self._block)
+            self._block = None
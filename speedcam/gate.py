@@ -0,0 +1,103 @@
+"""
+Motion gate in front of the detection pipeline.
+
+The road is empty most of the time, yet every frame would otherwise pay
+for the full-resolution colour conversion, blur, background model and
+blob search. The gate looks at the monitored area decimated by
+2 ** levels in each direction (a pyramid level reached by sampling, not
+by repeated blurring, which would cost as much as what it saves), lightly
+blurred, and compares it with a background of its own at that size. Only
+when enough of it has changed does the frame go through the full
+pipeline. On a 550x40 area an idle frame then costs about a tenth of a
+full one.
+
+A car entering the area changes whole blocks of pixels, so it survives
+decimation; the gate's blind spot is small or low-contrast motion, which
+the full pipeline would discard as too small anyway. How often the gate
+skips a frame the full pipeline would have found something in can be
+measured by running a Detector with audit_gate, see benchmarks/detection.py.
+"""
+
+import cv2
+import numpy as np
+
+
+class MotionGate(object):
+    """
+    Decides cheaply whether a frame of the monitored area needs full detection.
+    """
+
+    def __init__(self, shape, levels=3, threshold=15, min_fraction=0.005, learning_rate=0.05):
+        """
+        :param shape: (rows, cols) of the monitored area at camera resolution
+        :param levels: each level halves the width and height looked at
+        :param threshold: difference from the gate's background that counts as change
+        :param min_fraction: fraction of the decimated pixels that must change to open the gate
+        :param learning_rate: how quickly idle frames are absorbed into the gate's background
+        """
+        rows, cols = shape[:2]
+        factor = 2 ** levels
+        self.size = (max(cols // factor, 1), max(rows // factor, 1))  # as cv2 wants it: (width, height)
+        small = (self.size[1], self.size[0])
+        self.threshold = threshold
+        self.learning_rate = learning_rate
+        self.min_pixels = max(int(round(min_fraction * small[0] * small[1])), 1)
+
+        self.small = np.empty(small + (3,), dtype=np.uint8)
+        self.gray = np.empty(small, dtype=np.uint8)
+        self.blurred = np.empty(small, dtype=np.uint8)
+        self.delta = np.empty(small, dtype=np.uint8)
+        self.base = np.empty(small, dtype=np.float32)
+        self.base_u8 = np.empty(small, dtype=np.uint8)
+        self.ready = False
+
+        self.changed = 0  # pixels that changed in the last frame
+        self.opened = 0
+        self.closed = 0
+
+    def apply(self, roi):
+        """
+        :param roi: colour monitored area at camera resolution; a view of the frame will do
+        :return: True if the frame needs the full pipeline
+        """
+        cv2.resize(roi, self.size, dst=self.small, interpolation=cv2.INTER_NEAREST)
+        cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        cv2.blur(self.gray, (3, 3), dst=self.blurred)
+
+        if not self.ready:  # the first frame builds the full background too
+            self.base[...] = self.blurred
+            self.base_u8[...] = self.blurred
+            self.ready = True
+            self.opened += 1
+            return True
+
+        cv2.absdiff(self.blurred, self.base_u8, dst=self.delta)
+        cv2.threshold(self.delta, self.threshold, 255, cv2.THRESH_BINARY, dst=self.delta)
+        self.changed = cv2.countNonZero(self.delta)
+        if self.changed >= self.min_pixels:
+            self.opened += 1
+            return True
+        self.closed += 1
+        return False
+
+    def quiet(self):
+        """
+        :return: True if so little changed in the last frame, under a quarter of what opens the gate, that
+            it is noise rather than the edge of a vehicle, and the full background may absorb the frame
+        """
+        return self.changed * 4 < self.min_pixels
+
+    def learn(self):
+        """
+        Blends the last frame into the gate's background. Call only when nothing was found in it.
+        :return: None
+        """
+        cv2.accumulateWeighted(self.blurred, self.base, self.learning_rate)
+        cv2.convertScaleAbs(self.base, dst=self.base_u8)
+
+    def reset(self):
+        """
+        Throws the background away; the next frame starts a new one and opens the gate.
+        :return: None
+        """
+        self.ready = False
@@ -0,0 +1,287 @@
+"""
+Hot-path instrumentation.
+
+Each stage of the detection loop is timed into a fixed-bucket latency
+histogram; recording a time is a perf_counter() call and a bisect, with no
+allocation. Counters are bumped in place, and gauges (queue depths, dropped
+frames, ...) are read from the components that own them only when the
+metrics are exported. A MetricsExporter thread periodically writes
+everything as a Prometheus text file (for node_exporter's textfile
+collector) and/or a JSON file.
+
+Instrumentation switched off (Metrics(enabled=False)) hands out a shared
+no-op timer, so the loop runs the same code either way at no cost.
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Upper bounds of the latency buckets, in seconds: 100 us to 1 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.03, 0.05,
+                   0.075, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        :param bounds: sorted upper bounds of the buckets; larger values go to an overflow bucket
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by interpolating within its bucket.
+        :param q: quantile, 0 to 1
+        :return: estimated value, or 0.0 with no observations
+        """
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def snapshot(self):
+        """
+        :return: (cumulative counts per bound, with +Inf last, count, sum)
+        """
+        counts = list(self.counts)
+        cumulative = []
+        total = 0
+        for count in counts:
+            total += count
+            cumulative.append(total)
+        return cumulative, total, self.sum
+
+
+class _Timer(object):
+    """
+    Context manager timing one stage into a histogram. One instance per stage, reused every frame.
+    """
+
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics(object):
+    """
+    Stage histograms, counters and gauge collectors for one pipeline.
+    """
+
+    def __init__(self, enabled=True, prefix='speedcam'):
+        """
+        :param enabled: False turns every timer and counter into a no-op
+        :param prefix: prefix of the exported metric names
+        """
+        self.enabled = enabled
+        self.prefix = prefix
+        self.started = time.time()
+        self.histograms = OrderedDict()
+        self.counters = OrderedDict()
+        self._timers = {}
+        self._collectors = []
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def stage(self, name):
+        """
+        Timer for one stage, e.g. `with metrics.stage('blur'): ...`
+        :param name: stage name
+        :return: a reusable context manager
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        timer = self._timers.get(name)
+        if timer is None:
+            timer = self._timers[name] = _Timer(self.histogram(name))
+        return timer
+
+    def observe(self, name, seconds):
+        """
+        Records a stage time measured elsewhere, e.g. on another thread.
+        :param name: stage name
+        :param seconds: time taken
+        :return: None
+        """
+        if self.enabled:
+            self.histogram(name).observe(seconds)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_collector(self, collect):
+        """
+        Registers a source of gauges, read at export time only.
+        :param collect: callable returning a dict of name: number
+        :return: None
+        """
+        self._collectors.append(collect)
+
+    def gauges(self):
+        gauges = OrderedDict()
+        for collect in self._collectors:
+            for name, value in collect().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauges[name] = value
+        return gauges
+
+    def as_dict(self):
+        """
+        :return: every metric as plain data, with p50/p90/p99 per stage
+        """
+        stages = OrderedDict()
+        for name, histogram in list(self.histograms.items()):
+            stages[name] = OrderedDict([
+                ('count', histogram.count),
+                ('mean', histogram.sum / histogram.count if histogram.count else 0.0),
+                ('p50', histogram.quantile(0.5)),
+                ('p90', histogram.quantile(0.9)),
+                ('p99', histogram.quantile(0.99)),
+                ('max', histogram.max),
+            ])
+        return OrderedDict([
+            ('time', time.time()),
+            ('uptime', time.time() - self.started),
+            ('stages', stages),
+            ('counters', OrderedDict(self.counters)),
+            ('gauges', self.gauges()),
+        ])
+
+    def as_prometheus(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        p = self.prefix
+        lines = ["# HELP {0}_stage_seconds Time spent in each stage of the detection loop.".format(p),
+                 "# TYPE {0}_stage_seconds histogram".format(p)]
+        for name, histogram in list(self.histograms.items()):
+            cumulative, count, total = histogram.snapshot()
+            for bound, value in zip(histogram.bounds, cumulative):
+                lines.append('{0}_stage_seconds_bucket{{stage="{1}",le="{2}"}} {3}'.format(p, name, bound, value))
+            lines.append('{0}_stage_seconds_bucket{{stage="{1}",le="+Inf"}} {2}'.format(p, name, count))
+            lines.append('{0}_stage_seconds_sum{{stage="{1}"}} {2}'.format(p, name, total))
+            lines.append('{0}_stage_seconds_count{{stage="{1}"}} {2}'.format(p, name, count))
+
+        for name, value in list(self.counters.items()):
+            lines.append("# TYPE {0}_{1}_total counter".format(p, name))
+            lines.append("{0}_{1}_total {2}".format(p, name, value))
+
+        for name, value in self.gauges().items():
+            lines.append("# TYPE {0}_{1} gauge".format(p, name))
+            lines.append("{0}_{1} {2}".format(p, name, value))
+
+        lines.append("# TYPE {0}_uptime_seconds gauge".format(p))
+        lines.append("{0}_uptime_seconds {1:.1f}".format(p, time.time() - self.started))
+        return "\n".join(lines) + "\n"
+
+
+def _write_atomically(path, content):
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        f.write(content)
+    os.replace(temporary, path)  # scrapers never see a half-written file
+
+
+class MetricsExporter(threading.Thread):
+    """
+    Writes the metrics to files at a fixed interval.
+    """
+
+    def __init__(self, metrics, prometheus_path=None, json_path=None, interval=15.0):
+        """
+        :param metrics: Metrics to export
+        :param prometheus_path: Prometheus text file (name it *.prom for node_exporter), or None
+        :param json_path: JSON file, or None
+        :param interval: seconds between exports
+        """
+        super(MetricsExporter, self).__init__(name="metrics-exporter")
+        self.daemon = True
+        self.metrics = metrics
+        self.prometheus_path = prometheus_path
+        self.json_path = json_path
+        self.interval = interval
+        self.exports = 0
+        self.last_error = None
+        self._stop_event = threading.Event()
+
+    def export(self):
+        if self.prometheus_path:
+            _write_atomically(self.prometheus_path, self.metrics.as_prometheus())
+        if self.json_path:
+            _write_atomically(self.json_path, json.dumps(self.metrics.as_dict(), indent=1))
+        self.exports += 1
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.export()
+            except Exception as e:  # Metrics are never worth stopping detection for
+                if self.last_error is None:
+                    print("Exporting metrics failed: {0}".format(e))
+                self.last_error = e
+
+    def stop(self, timeout=None):
+        """
+        Stops the thread after one final export.
+        :param timeout: seconds to wait for the thread
+        :return: None
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        try:
+            self.export()
+        except Exception as e:
+            self.last_error = e
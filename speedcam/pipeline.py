@@ -0,0 +1,180 @@
+"""
+Threaded capture stage.
+
+A CaptureThread reads frames from a FrameSource and hands them to the
+detection stage through a bounded FrameQueue, so a slow commit or screen
+redraw never delays the next capture. What happens when the queue is full
+is decided by its policy:
+
+    DROP_OLDEST - discard the oldest queued frame to make room (default)
+    BLOCK       - wait for the detection stage to catch up
+    SKIP_NTH    - only queue every Nth frame, dropping the newest if still full
+"""
+
+import threading
+import time
+from collections import deque
+
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+SKIP_NTH = 'skip_nth'
+
+
+class FrameQueue(object):
+    """
+    Bounded ring queue between the capture and detection stages.
+    """
+
+    def __init__(self, maxsize=8, policy=DROP_OLDEST, skip_every=2, late_after=0.5):
+        """
+        :param maxsize: number of frames the queue may hold
+        :param policy: DROP_OLDEST, BLOCK or SKIP_NTH
+        :param skip_every: for SKIP_NTH, keep one frame out of this many
+        :param late_after: frames waiting longer than this many seconds are counted as late
+        """
+        if policy not in (DROP_OLDEST, BLOCK, SKIP_NTH):
+            raise ValueError("Unknown queue policy: {0}".format(policy))
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.skip_every = max(1, skip_every)
+        self.late_after = late_after
+
+        self.frames_in = 0
+        self.frames_out = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.late = 0
+
+        self._items = deque()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def put(self, frame):
+        """
+        Queues a frame according to the queue policy.
+        :param frame: a Frame
+        :return: True if the frame was queued.
+        """
+        with self._lock:
+            self.frames_in += 1
+
+            if self.policy == SKIP_NTH and (self.frames_in - 1) % self.skip_every != 0:
+                self.skipped += 1
+                return False
+
+            if len(self._items) >= self.maxsize:
+                if self.policy == BLOCK:
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._not_full.wait()
+                elif self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return False
+
+            if self._closed:
+                return False
+
+            self._items.append((time.time(), frame))
+            self._not_empty.notify()
+            return True
+
+    def get(self, timeout=None):
+        """
+        Removes and returns the oldest frame.
+        :param timeout: seconds to wait for a frame, None to wait forever
+        :return: a Frame, or None when the queue is closed and empty or the wait timed out.
+        """
+        with self._lock:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self._items:
+                if self._closed:
+                    return None
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._not_empty.wait(remaining)
+
+            queued_at, frame = self._items.popleft()
+            self.frames_out += 1
+            if time.time() - queued_at > self.late_after:
+                self.late += 1
+
+            self._not_full.notify()
+            return frame
+
+    def frames(self):
+        """
+        Generator yielding frames until the queue is closed and drained.
+        :return: Frame
+        """
+        while True:
+            frame = self.get()
+            if frame is None:
+                return
+            yield frame
+
+    def close(self):
+        """
+        Stops accepting frames and wakes up anyone waiting on the queue.
+        :return: None
+        """
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def depth(self):
+        with self._lock:
+            return len(self._items)
+
+    def stats(self):
+        """
+        :return: dict of queue counters
+        """
+        with self._lock:
+            return {
+                'depth': len(self._items),
+                'frames_in': self.frames_in,
+                'frames_out': self.frames_out,
+                'dropped': self.dropped,
+                'skipped': self.skipped,
+                'late': self.late,
+            }
+
+
+class CaptureThread(threading.Thread):
+    """
+    Reads frames from a source on its own thread and feeds them to a FrameQueue.
+    """
+
+    def __init__(self, source, queue):
+        super(CaptureThread, self).__init__(name="capture")
+        self.daemon = True
+        self.source = source
+        self.queue = queue
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            for frame in self.source.frames():
+                if self._stop_event.is_set():
+                    break
+                self.queue.put(frame)
+        except Exception as e:  # Hand the failure to the detection stage instead of dying silently
+            self.error = e
+        finally:
+            self.queue.close()
+
+    def stop(self):
+        """
+        Asks the thread to stop after the current frame.
+        :return: None
+        """
+        self._stop_event.set()
+        self.queue.close()
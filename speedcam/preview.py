@@ -0,0 +1,292 @@
+"""
+Browser preview of a running speed camera.
+
+A small HTTP server in its own process, reading the frames a camera
+publishes to a shared FrameBus, so that a headless camera can be watched,
+and its monitored area set, from a browser instead of an X display. Each
+published frame is annotated and encoded once, however many browsers are
+watching, and frames are only published while someone is.
+
+Usage:
+    python -m speedcam.preview [--bus speedcam] [--host 127.0.0.1] [--port 8080]
+
+SpeedCamera starts it itself when preview_port is set. Pages:
+
+    /              live view; drag a rectangle over it to move the monitored area
+    /stream.mjpg   MJPEG stream of the annotated frames
+    /snapshot.jpg  the latest annotated frame
+    /mask.mjpg     MJPEG stream of the motion mask
+    /roi           GET the monitored area as JSON, or POST {"box": [x1, y1, x2, y2]} to move it
+
+Anyone who can reach the server can move the monitored area, so it only
+listens on localhost unless told otherwise.
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import cv2
+
+from speedcam.display import annotate
+from speedcam.framebus import FrameBusReader
+
+FRAME = 'frame'
+MASK = 'mask'
+BOUNDARY = 'speedcamframe'
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<title>Speed Camera</title>
+<style>
+  body { font-family: sans-serif; margin: 1em; }
+  #view { position: relative; display: inline-block; cursor: crosshair; }
+  #view img { display: block; max-width: 100%; }
+  #view canvas { position: absolute; left: 0; top: 0; }
+</style>
+</head>
+<body>
+<div id="view"><img id="frame" src="/stream.mjpg"><canvas id="overlay"></canvas></div>
+<p>Drag a rectangle over the road to move the monitored area.
+   <button id="apply" disabled>Apply</button> <span id="message"></span></p>
+<p><img src="/mask.mjpg" alt="motion mask"></p>
+<script>
+var frame = document.getElementById('frame'), overlay = document.getElementById('overlay');
+var apply = document.getElementById('apply'), message = document.getElementById('message');
+var context = overlay.getContext('2d'), start = null, box = null;
+
+function point(event) {
+  var bounds = overlay.getBoundingClientRect(), scale = frame.naturalWidth / bounds.width;
+  return [Math.round((event.clientX - bounds.left) * scale), Math.round((event.clientY - bounds.top) * scale)];
+}
+function draw() {
+  overlay.width = frame.clientWidth;
+  overlay.height = frame.clientHeight;
+  context.clearRect(0, 0, overlay.width, overlay.height);
+  if (box) {
+    var scale = frame.clientWidth / frame.naturalWidth;
+    context.strokeStyle = 'yellow';
+    context.lineWidth = 2;
+    context.strokeRect(box[0] * scale, box[1] * scale, (box[2] - box[0]) * scale, (box[3] - box[1]) * scale);
+  }
+}
+overlay.onmousedown = function (event) { start = point(event); };
+overlay.onmousemove = function (event) {
+  if (!start) return;
+  var end = point(event);
+  box = [Math.min(start[0], end[0]), Math.min(start[1], end[1]), Math.max(start[0], end[0]),
+         Math.max(start[1], end[1])];
+  apply.disabled = false;
+  draw();
+};
+overlay.onmouseup = function () { start = null; };
+apply.onclick = function () {
+  var request = new XMLHttpRequest();
+  request.open('POST', '/roi');
+  request.setRequestHeader('Content-Type', 'application/json');
+  request.onload = function () {
+    message.textContent = request.status === 200 ? 'Monitored area ' + box.join(', ') : request.responseText;
+    box = null;
+    apply.disabled = true;
+    draw();
+  };
+  request.send(JSON.stringify({box: box}));
+};
+frame.onload = draw;
+window.onresize = draw;
+</script>
+</body>
+</html>
+"""
+
+
+class FrameEncoder(object):
+    """
+    JPEG encodes the latest published frame and mask, once each, for every client.
+    """
+
+    def __init__(self, reader, quality=80):
+        """
+        :param reader: FrameBusReader
+        :param quality: JPEG quality, 0 to 100
+        """
+        self.reader = reader
+        self.params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        self.encoded = {}  # kind: (sequence, JPEG bytes)
+        self.missed = 0
+        self._lock = threading.Lock()
+
+    def latest(self, kind=FRAME):
+        """
+        :param kind: FRAME or MASK
+        :return: (sequence, JPEG bytes) of the latest frame, or None if nothing has been published
+        """
+        with self._lock:
+            self.reader.request()
+            published = self.reader.latest()
+            cached = self.encoded.get(kind)
+            if published is None or (cached is not None and cached[0] == published.sequence):
+                return cached
+
+            if kind == FRAME:
+                image = annotate(published.image.copy(), published.box, published.boxes, published.text,
+                                 published.timestamp)
+            else:
+                image = published.mask  # encoded straight from the bus
+            ok, data = cv2.imencode('.jpg', image, self.params) if image.size else (False, None)
+            if not ok or not self.reader.valid(published):
+                self.missed += 1
+                return cached
+            self.encoded[kind] = (published.sequence, data.tobytes())
+            return self.encoded[kind]
+
+    def monitored_area(self):
+        """
+        :return: the monitored area of the latest frame, or None if nothing has been published
+        """
+        with self._lock:
+            published = self.reader.latest()
+            return None if published is None else published.box
+
+    def move_monitored_area(self, box):
+        """
+        Asks the camera to monitor another area.
+        :param box: (upper left x, upper left y, lower right x, lower right y)
+        :return: None, or why the area can't be used
+        """
+        x1, y1, x2, y2 = box
+        with self._lock:
+            if self.reader.latest() is None:
+                return "No frame published yet"
+            header = self.reader.views.header
+            if not (0 <= x1 < x2 <= int(header['cols']) and 0 <= y1 < y2 <= int(header['rows'])):
+                return "Box outside the frame"
+            self.reader.request_roi(box)
+        return None
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    server_version = 'speedcam-preview'
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/':
+            self.send_body(PAGE.encode('utf-8'), 'text/html; charset=utf-8')
+        elif path == '/snapshot.jpg':
+            encoded = self.server.encoder.latest(FRAME)
+            if encoded is None:
+                self.send_error(503, "No frame published yet")
+            else:
+                self.send_body(encoded[1], 'image/jpeg')
+        elif path in ('/stream.mjpg', '/mask.mjpg'):
+            self.stream(FRAME if path == '/stream.mjpg' else MASK)
+        elif path == '/roi':
+            box = self.server.encoder.monitored_area()
+            if box is None:
+                self.send_error(503, "No frame published yet")
+            else:
+                self.send_body(json.dumps(dict(box=box)).encode('utf-8'), 'application/json')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/roi':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            box = [int(v) for v in json.loads(self.rfile.read(length).decode('utf-8'))['box']]
+            if len(box) != 4:
+                raise ValueError("box needs 4 values")
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, "Expected {0}: {1}".format('{"box": [x1, y1, x2, y2]}', e))
+            return
+
+        error = self.server.encoder.move_monitored_area(box)
+        if error is not None:
+            self.send_error(400, error)
+        else:
+            self.send_body(json.dumps(dict(box=box)).encode('utf-8'), 'application/json')
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, kind):
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary={0}'.format(BOUNDARY))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        last = None
+        try:
+            while not self.server.stopping.is_set():
+                encoded = self.server.encoder.latest(kind)
+                if encoded is not None and encoded[0] != last:
+                    last, data = encoded
+                    self.wfile.write('--{0}\r\nContent-Type: image/jpeg\r\nContent-Length: {1}\r\n\r\n'.format(
+                        BOUNDARY, len(data)).encode('ascii'))
+                    self.wfile.write(data)
+                    self.wfile.write(b'\r\n')
+                time.sleep(self.server.interval)
+        except (BrokenPipeError, ConnectionResetError):  # the browser went away
+            pass
+
+    def log_message(self, format, *args):
+        pass  # a line per MJPEG frame request would flood the terminal
+
+
+class PreviewServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the preview pages, a thread per client.
+    """
+    daemon_threads = True
+
+    def __init__(self, reader, address, max_fps=5, quality=80):
+        """
+        :param reader: FrameBusReader of the camera's frames
+        :param address: (host, port) to listen on
+        :param max_fps: most frames a second sent to each client
+        :param quality: JPEG quality, 0 to 100
+        """
+        HTTPServer.__init__(self, address, PreviewHandler)
+        self.reader = reader  # only used through the encoder, which serializes the handler threads
+        self.encoder = FrameEncoder(reader, quality)
+        self.interval = 1.0 / max_fps
+        self.stopping = threading.Event()
+
+    def server_close(self):
+        self.stopping.set()
+        HTTPServer.server_close(self)
+        self.reader.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a browser preview of a speed camera.")
+    parser.add_argument('--bus', default='speedcam', help="frame_bus_name of the camera")
+    parser.add_argument('--host', default='127.0.0.1', help="0.0.0.0 to allow other machines")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fps', type=float, default=5)
+    parser.add_argument('--quality', type=int, default=80)
+    args = parser.parse_args(argv)
+
+    server = PreviewServer(FrameBusReader(args.bus), (args.host, args.port), args.fps, args.quality)
+    print("Preview on http://{0}:{1}/".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+ROI-first frame processing.
+
+Only the monitored area is ever touched: it is cropped (or, when the camera
+needs straightening, warped directly into place) and then converted to
+grayscale and blurred into buffers allocated once at start-up. Motion masks
+are made from the result by a background model (see background.py).
+
+With a scale below 1 the monitored area is shrunk as it is cropped, so the
+whole pipeline runs on fewer pixels; everything downstream then works in
+detection pixels rather than camera pixels.
+"""
+
+import cv2
+import numpy as np
+
+
+class RoiProcessor(object):
+    """
+    Turns frames into blurred grayscale images of the monitored area.
+    """
+
+    def __init__(self, box, frame_shape, rotation_degrees=0, blur_size=(15, 15), scale=1.0):
+        """
+        :param box: (upper_left_x, upper_left_y, lower_right_x, lower_right_y) of the monitored area
+        :param frame_shape: shape of the full frames, (rows, cols, channels)
+        :param rotation_degrees: rotate the frame by this amount to create a flat road
+        :param blur_size: Gaussian blur kernel size, in camera pixels
+        :param scale: detection pixels per camera pixel, e.g. 0.5 to detect at half resolution
+        """
+        self.box = box
+        self.scale = scale
+        # the blur covers the same part of the road at any scale; kernel sizes must stay odd
+        self.blur_size = tuple(max(int(size * scale) | 1, 1) for size in blur_size)
+
+        x1, y1, x2, y2 = box
+        self.width = int(round((x2 - x1) * scale))
+        self.height = int(round((y2 - y1) * scale))
+        rows, cols = frame_shape[:2]
+
+        # Straightening only needs the pixels that land inside the monitored area, so
+        # shift the rotation matrix by the ROI origin and warp straight into a buffer,
+        # shrinking it on the way when detecting at a lower resolution.
+        self.matrix = None
+        self.roi = None
+        if rotation_degrees:
+            self.matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), rotation_degrees, 1)
+            self.matrix[0, 2] -= x1
+            self.matrix[1, 2] -= y1
+            self.matrix *= scale
+            self.full_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), rotation_degrees, 1)
+        if rotation_degrees or scale != 1.0:
+            self.roi = np.empty((self.height, self.width, 3), dtype=np.uint8)
+
+        shape = (self.height, self.width)
+        self.gray = np.empty(shape, dtype=np.uint8)
+        self.blurred = np.empty(shape, dtype=np.uint8)
+        self.shape = shape
+
+    def crop(self, image):
+        """
+        Returns the colour monitored area of a frame, straightened and scaled if needed.
+        :param image: full BGR frame
+        :return: BGR array of the monitored area (a view when neither is needed)
+        """
+        if self.matrix is not None:
+            cv2.warpAffine(image, self.matrix, (self.width, self.height), dst=self.roi)
+            return self.roi
+
+        roi = self.frame_roi(image)
+        if self.roi is not None:
+            cv2.resize(roi, (self.width, self.height), dst=self.roi, interpolation=cv2.INTER_LINEAR)
+            return self.roi
+        return roi
+
+    def frame_roi(self, image):
+        """
+        :param image: full BGR frame
+        :return: view of the monitored area at camera resolution, neither straightened nor scaled
+        """
+        x1, y1, x2, y2 = self.box
+        return image[y1:y2, x1:x2]
+
+    def straighten(self, image):
+        """
+        Rotates a full frame for display. Not used on the detection path.
+        :param image: full BGR frame
+        :return: rotated copy of the frame, or the frame itself when no rotation is needed
+        """
+        if self.matrix is None:
+            return image
+        rows, cols = image.shape[:2]
+        return cv2.warpAffine(image, self.full_matrix, (cols, rows))
+
+    def prepare(self, roi):
+        """
+        Converts the monitored area to a blurred grayscale image.
+        :param roi: BGR monitored area, as returned by crop()
+        :return: the blurred grayscale buffer
+        """
+        cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        cv2.GaussianBlur(self.gray, self.blur_size, 0, dst=self.blurred)
+        return self.blurred
@@ -0,0 +1,103 @@
+"""
+Motion-driven frame-rate control.
+
+The camera idles at a low frame rate while the monitored area is empty and
+is switched to full rate as soon as motion appears. Day and night are told
+apart by the measured brightness of the monitored area, with hysteresis so
+that dusk doesn't flip back and forth, rather than by the clock. Rate
+changes are applied to the running source in place; the pipeline is never
+restarted.
+
+The idle rate is never so low that a vehicle arriving at idle_design_speed
+is lost: SpeedCamera raises it until such a vehicle would be seen in enough
+frames to be measured even if the camera stayed idle; see crossing_fps. The
+tracker follows it however far it moves between idle frames.
+"""
+
+from speedcam.speed import FEET_PER_SECOND_TO_MPH, feet_per_pixel
+
+
+def crossing_fps(width, image_width, field_of_view, distance, mph, samples):
+    """
+    Lowest frame rate at which a vehicle is seen in a number of frames while crossing a width.
+    :param width: e.g. of the monitored area, in camera pixels
+    :param image_width: width of the full frame, in camera pixels
+    :param field_of_view: horizontal field of view of the camera, in degrees
+    :param distance: distance to the nearer lane, in feet, where the width is crossed soonest
+    :param mph: speed of the vehicle
+    :param samples: frames it must be seen in, whatever the phase of its arrival
+    :return: frames per second
+    """
+    feet = width * feet_per_pixel(distance, image_width, field_of_view)
+    return samples * (mph / FEET_PER_SECOND_TO_MPH) / feet
+
+
+class RateController(object):
+    """
+    Chooses the capture rate from motion and brightness.
+    """
+
+    def __init__(self, source, day_fps=30, night_fps=15, idle_fps=5, idle_after=3.0,
+                 night_below=40.0, day_above=60.0, smoothing=0.02):
+        """
+        :param source: FrameSource whose rate is controlled
+        :param day_fps: rate while something is moving in daylight
+        :param night_fps: rate while something is moving at night, allowing longer exposures
+        :param idle_fps: rate while the monitored area is empty
+        :param idle_after: seconds without motion before dropping to idle_fps
+        :param night_below: smoothed mean brightness (0-255) under which it is night
+        :param day_above: smoothed mean brightness over which it is day again
+        :param smoothing: weight of each frame in the smoothed brightness
+        """
+        self.source = source
+        self.day_fps = day_fps
+        self.night_fps = night_fps
+        self.idle_fps = idle_fps
+        self.idle_after = idle_after
+        self.night_below = night_below
+        self.day_above = day_above
+        self.smoothing = smoothing
+
+        self.brightness = None
+        self.nighttime = False
+        self.active = True
+        self.last_motion = None
+        self.framerate = None
+        self.changes = 0
+
+    @property
+    def active_fps(self):
+        return self.night_fps if self.nighttime else self.day_fps
+
+    def update(self, timestamp, brightness, motion):
+        """
+        Feeds one processed frame to the controller, changing the source's rate if needed.
+        :param timestamp: capture time of the frame
+        :param brightness: mean brightness of the monitored area
+        :param motion: whether anything was found moving in the frame
+        :return: the frame rate now in effect
+        """
+        if self.brightness is None:
+            self.brightness = brightness
+            self.nighttime = brightness < self.night_below
+        else:
+            self.brightness += self.smoothing * (brightness - self.brightness)
+            if self.nighttime and self.brightness > self.day_above:
+                self.nighttime = False
+                print("Daylight detected (brightness {0:.0f}).".format(self.brightness))
+            elif not self.nighttime and self.brightness < self.night_below:
+                self.nighttime = True
+                print("Nighttime detected (brightness {0:.0f}).".format(self.brightness))
+
+        if motion or self.last_motion is None:
+            self.last_motion = timestamp
+            self.active = True
+        elif (timestamp - self.last_motion).total_seconds() >= self.idle_after:
+            self.active = False
+
+        framerate = self.active_fps if self.active else min(self.idle_fps, self.active_fps)
+        if framerate != self.framerate:
+            self.source.set_framerate(framerate)
+            self.framerate = framerate
+            self.changes += 1
+        return framerate
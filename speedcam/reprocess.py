@@ -0,0 +1,341 @@
+"""
+Offline reprocessing of archived footage.
+
+Runs the detection and speed pipeline over recorded video files with the
+current calibration, so past speeds can be regenerated after the field of
+view, the lane distances or the thresholds change.
+
+Every file is cut into chunks of --chunk-seconds, and the chunks are shared
+out to a pool of worker processes, one per core. Each chunk starts reading
+--warmup seconds early so the background is learnt before it begins, and
+keeps only the vehicles that left the monitored area within the chunk, so
+no vehicle is counted twice at a boundary. OpenCV is limited to one thread
+per worker; the pool supplies the parallelism.
+
+A run is identified by its run ID, by default derived from the calibration
+settings. Finished chunks are recorded in a progress file, and running the
+same command again skips them, so an interrupted run can simply be resumed.
+The progress file also records the settings, and a run can't be resumed
+with different ones.
+
+Results go either to the database table reprocessed_vehicles, as vehicles
+of the session "reprocess:<run ID>", apart from the live vehicles, rollups
+and exports, or with --output to one JSON lines file per chunk.
+
+The time a recording started is read from its file name, e.g.
+cam1-20160412-173000.h264 or 2016-04-12T17:30:00.avi, or else taken to be
+the file's modification time less its length.
+
+Usage:
+    python -m speedcam.reprocess [--config settings.json] [--run-id ID] [--output DIR] FILE ...
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+
+import cv2
+
+from speedcam.background import RUNNING_AVERAGE
+from speedcam.config import Config
+from speedcam.detector import Detector, vehicle_row
+from speedcam.rate import RateController
+from speedcam.sources import FileSource
+
+Chunk = namedtuple('Chunk', ['key', 'path', 'index', 'start_time', 'offset', 'duration', 'warmup'])
+
+# settings that change which vehicles are found or their speeds
+CALIBRATION = ('image_width', 'field_of_view', 'rotation_degrees', 'monitored_area', 'ltr_distance',
+               'rtl_distance', 'threshold', 'min_area', 'blob_min_aspect', 'blob_max_aspect',
+               'blob_reject_edges', 'blur_size', 'minimum_speed', 'maximum_speed',
+               'track_max_distance', 'track_max_missed', 'background_engine', 'day_learning_rate',
+               'night_learning_rate', 'colour_method', 'motion_gate', 'gate_levels', 'gate_threshold',
+               'gate_min_fraction', 'gate_refresh_frames', 'gate_refresh_max_frames', 'detection_scale')
+
+FILE_TIME = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})[T_ -]?(\d{2})[:.-]?(\d{2})[:.-]?(\d{2})')
+
+
+def calibration(config):
+    return dict((name, getattr(config, name)) for name in CALIBRATION)
+
+
+def calibration_id(config):
+    """
+    :param config: Config
+    :return: short hash of the calibration settings, the default run ID
+    """
+    encoded = json.dumps(calibration(config), sort_keys=True).encode('utf-8')
+    return 'cal-' + hashlib.sha1(encoded).hexdigest()[:10]
+
+
+def recording_start(path, length):
+    """
+    :param path: video file
+    :param length: length of the recording in seconds
+    :return: datetime the recording started
+    """
+    match = FILE_TIME.search(os.path.basename(path))
+    if match:
+        try:
+            return datetime.datetime(*[int(part) for part in match.groups()])
+        except ValueError:
+            pass
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path) - length)
+
+
+def plan_chunks(paths, chunk_seconds, warmup):
+    """
+    Cuts the files into chunks.
+    :param paths: video files
+    :param chunk_seconds: longest chunk, or None for one chunk per file
+    :param warmup: seconds read before each chunk, to learn the background
+    :return: list of Chunk
+    """
+    chunks = []
+    for path in paths:
+        source = FileSource(path).open()
+        length = source.length()
+        source.close()
+
+        start_time = recording_start(path, length)
+        if not chunk_seconds or length <= 0.0:
+            chunks.append(Chunk("{0}#0".format(path), path, 0, start_time, 0.0, None, 0.0))
+            continue
+
+        count = int(length // chunk_seconds) + (length % chunk_seconds > 0)
+        for index in range(count):
+            offset = index * chunk_seconds
+            duration = None if index == count - 1 else chunk_seconds  # the last chunk reads to the end
+            chunks.append(Chunk("{0}#{1}".format(path, index), path, index, start_time, offset, duration,
+                                min(warmup, offset)))
+    return chunks
+
+
+def process_chunk(chunk, settings, run_id):
+    """
+    Runs detection over one chunk. Called in the worker processes.
+    :param chunk: Chunk
+    :param settings: dict of Config settings
+    :param run_id: ID of the run
+    :return: dict with the chunk key, vehicle rows, frames read and seconds taken
+    """
+    cv2.setNumThreads(1)  # one process per core already; more threads only contend
+    started = time.time()
+    config = Config(**settings)
+    session_id = 'reprocess:{0}'.format(run_id)
+    begins = chunk.start_time + datetime.timedelta(seconds=chunk.offset)
+
+    source = FileSource(chunk.path, start_time=chunk.start_time, offset=chunk.offset - chunk.warmup,
+                        duration=None if chunk.duration is None else chunk.duration + chunk.warmup).open()
+    controller = RateController(source, config.day_fps, config.night_fps, config.idle_fps, config.idle_after)
+    detector = None
+    rows = []
+    try:
+        for frame in source.frames():
+            if detector is None:
+                detector = Detector.from_config(config, config.monitored_area, frame.image.shape)
+            nighttime = controller.nighttime
+            if config.background_engine == RUNNING_AVERAGE:
+                detector.background.learning_rate = \
+                    config.night_learning_rate if nighttime else config.day_learning_rate
+
+            result = detector.process(frame.image, frame.timestamp, nighttime)
+            controller.update(frame.timestamp, detector.background.brightness, bool(result.boxes))
+
+            for vehicle in result.vehicles:
+                if vehicle.track.last_seen < begins:
+                    continue  # belongs to the previous chunk
+                rows.append(vehicle_row(vehicle, session_id, "{0}:{1}:{2}".format(
+                    run_id, chunk.key, vehicle.track.id)))
+    finally:
+        source.close()
+
+    return dict(key=chunk.key, rows=rows, frames=source.frame_count, seconds=time.time() - started)
+
+
+class Progress(object):
+    """
+    Append-only record of the chunks of a run that are finished.
+    """
+
+    def __init__(self, path, run_id, settings):
+        """
+        :param path: progress file, created if missing
+        :param run_id: ID of the run
+        :param settings: calibration settings; must match the file's
+        :raise ValueError: if the file belongs to another run or other settings
+        """
+        self.path = path
+        self.done = set()
+        header = dict(run_id=run_id, settings=settings)
+
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+            if lines and json.loads(json.dumps(header)) != lines[0]:
+                raise ValueError("{0} was written by a different run or calibration; "
+                                 "use another --run-id or --progress".format(path))
+            self.done.update(line['key'] for line in lines[1:])
+            self._file = open(path, 'a')
+            if not lines:
+                self._write(header)
+        else:
+            self._file = open(path, 'a')
+            self._write(header)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def mark(self, key, **details):
+        """
+        Records a chunk as finished. Call only once its results are safely stored.
+        :param key: key of the chunk
+        :param details: anything else worth keeping
+        :return: None
+        """
+        self._write(dict(details, key=key))
+        self.done.add(key)
+
+    def close(self):
+        self._file.close()
+
+
+class DatabaseOutput(object):
+    """
+    Writes a run's vehicles to the reprocessed_vehicles table, idempotently.
+    """
+
+    def __init__(self, url, run_id):
+        from db import ReprocessedVehicles, ensure_schema, get_engine, insert_ignoring_duplicates, upsert_log
+
+        self.engine = get_engine(url)
+        ensure_schema(self.engine)
+        self.session_id = 'reprocess:{0}'.format(run_id)
+        self._vehicles = insert_ignoring_duplicates(ReprocessedVehicles, self.engine.dialect)
+        self._log = upsert_log(self.engine.dialect)
+        with self.engine.begin() as connection:
+            connection.execute(self._log, [dict(sessionID=self.session_id, timeOn=datetime.datetime.now())])
+
+    def write(self, key, rows):
+        if rows:
+            with self.engine.begin() as connection:
+                connection.execute(self._vehicles, rows)
+
+    def close(self):
+        with self.engine.begin() as connection:
+            connection.execute(self._log, [dict(sessionID=self.session_id, timeOff=datetime.datetime.now())])
+
+
+class FileOutput(object):
+    """
+    Writes each chunk's vehicles to its own JSON lines file in a directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, key, rows):
+        name = re.sub(r'[^\w.#-]+', '_', key).strip('_') + '.jsonl'
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'w') as f:
+            for row in rows:
+                f.write(json.dumps(dict(row, datetime=row['datetime'].isoformat())) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)  # a rerun of the chunk replaces it whole
+
+    def close(self):
+        pass
+
+
+def _process_chunk(args):
+    return process_chunk(*args)
+
+
+def reprocess(paths, config, run_id, output, progress, workers=None, chunk_seconds=600.0, warmup=10.0):
+    """
+    Reprocesses video files in a pool of worker processes.
+    :param paths: video files
+    :param config: Config holding the calibration to apply
+    :param run_id: ID of the run
+    :param output: DatabaseOutput or FileOutput
+    :param progress: Progress of the run; finished chunks are skipped
+    :param workers: worker processes; defaults to one per core
+    :param chunk_seconds: longest chunk, or None for one chunk per file
+    :param warmup: seconds read before each chunk, to learn the background
+    :return: (chunks processed, vehicles found)
+    """
+    chunks = [chunk for chunk in plan_chunks(paths, chunk_seconds, warmup) if chunk.key not in progress.done]
+    settings = config.as_dict()
+    print("{0}: {1} chunks to process, {2} already done".format(run_id, len(chunks), len(progress.done)))
+
+    if not workers:
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else multiprocessing.cpu_count()
+    pool = multiprocessing.get_context('spawn').Pool(workers)
+    started = time.time()
+    frames = vehicles = done = 0
+    try:
+        for result in pool.imap_unordered(_process_chunk, [(chunk, settings, run_id) for chunk in chunks]):
+            output.write(result['key'], result['rows'])
+            progress.mark(result['key'], vehicles=len(result['rows']), frames=result['frames'])
+            done += 1
+            frames += result['frames']
+            vehicles += len(result['rows'])
+            print("[{0}/{1}] {2}: {3} vehicles, {4} frames in {5:.1f}s ({6:.0f} FPS overall)".format(
+                done, len(chunks), result['key'], len(result['rows']), result['frames'], result['seconds'],
+                frames / max(time.time() - started, 1e-6)))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return done, vehicles
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocess archived video with the current calibration.")
+    parser.add_argument('paths', nargs='+', metavar='FILE', help="recorded video files")
+    parser.add_argument('--config', help="JSON file of settings, as for the speed camera")
+    parser.add_argument('--run-id', help="defaults to a hash of the calibration settings")
+    parser.add_argument('--output', metavar='DIR', help="write JSON lines files here instead of the database")
+    parser.add_argument('--database-url')
+    parser.add_argument('--progress', help="progress file; defaults to reprocess-<run ID>.progress")
+    parser.add_argument('--workers', type=int, help="worker processes; defaults to one per core")
+    parser.add_argument('--chunk-seconds', type=float, default=600.0, help="0 for one chunk per file")
+    parser.add_argument('--warmup', type=float, default=10.0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = {} if args.database_url is None else dict(database_url=args.database_url)
+    config = Config.load(args.config, **settings) if args.config else Config(**settings)
+
+    run_id = args.run_id or calibration_id(config)
+    progress = Progress(args.progress or 'reprocess-{0}.progress'.format(run_id), run_id,
+                        calibration(config))
+    output = FileOutput(args.output) if args.output else DatabaseOutput(config.database_url, run_id)
+    try:
+        chunks, vehicles = reprocess(args.paths, config, run_id, output, progress, args.workers,
+                                     args.chunk_seconds or None, args.warmup)
+    finally:
+        progress.close()
+    output.close()
+    print("{0}: {1} chunks, {2} vehicles".format(run_id, chunks, vehicles))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
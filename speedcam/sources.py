@@ -0,0 +1,316 @@
+"""
+Frame sources.
+
+Every source yields Frame tuples carrying the image and the time it was
+captured, so the detection loop never has to guess at timing with
+datetime.now(). Sources available:
+
+    PiCameraSource      - the Raspberry Pi camera module (picamera)
+    VideoCaptureSource  - any V4L2 / USB camera through cv2.VideoCapture
+    FileSource          - a recorded video file, replayed in real time or
+                          as fast as the CPU allows
+"""
+
+import datetime
+import time
+from collections import namedtuple
+
+import cv2
+
+Frame = namedtuple('Frame', ['image', 'timestamp', 'index'])
+
+
+class FrameSource(object):
+    """
+    Base class for all frame sources.
+    """
+
+    def __init__(self, resolution, framerate):
+        self.resolution = tuple(resolution)
+        self.framerate = framerate
+        self.frame_count = 0
+
+    def open(self):
+        """
+        Acquires the underlying device or file.
+        :return: self
+        """
+        return self
+
+    def close(self):
+        """
+        Releases the underlying device or file.
+        :return: None
+        """
+        pass
+
+    def frames(self):
+        """
+        Generator yielding Frame tuples until the source is exhausted. Each image is a new array
+        the source never writes to again, so it can be kept without copying, e.g. in a FrameRing.
+        :return: Frame
+        """
+        raise NotImplementedError
+
+    def capture(self):
+        """
+        Grabs a single frame, e.g. a reference image for drawing the monitored area.
+        :return: Frame, or None if nothing could be read.
+        """
+        for frame in self.frames():
+            return frame
+        return None
+
+    def set_framerate(self, framerate):
+        """
+        Changes the capture rate of the source.
+        :param framerate: frames per second
+        :return: None
+        """
+        self.framerate = framerate
+
+    def _make_frame(self, image, timestamp):
+        frame = Frame(image, timestamp, self.frame_count)
+        self.frame_count += 1
+        return frame
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PiCameraSource(FrameSource):
+    """
+    Raspberry Pi camera module.
+
+    The camera is opened at max_framerate and slowed down through
+    framerate_delta, which picamera allows while capturing.
+    """
+
+    def __init__(self, resolution, framerate, rotate=90, vflip=False, hflip=False, warmup=0.9, max_framerate=None):
+        super(PiCameraSource, self).__init__(resolution, framerate)
+        self.max_framerate = max(framerate, max_framerate or framerate)
+        self.rotate = rotate
+        self.vflip = vflip
+        self.hflip = hflip
+        self.warmup = warmup
+        self.camera = None
+        self.raw_capture = None
+
+    def open(self):
+        from picamera import PiCamera  # Only available on the Pi
+        from picamera.array import PiRGBArray
+
+        self.close()
+        self.camera = PiCamera()
+        self.camera.resolution = self.resolution
+        self.camera.framerate = self.max_framerate
+        self.camera.framerate_delta = self.framerate - self.max_framerate
+        self.camera.vflip = self.vflip
+        self.camera.hflip = self.hflip
+        self.camera.rotate = self.rotate
+
+        self.raw_capture = PiRGBArray(self.camera, size=self.camera.resolution)
+        time.sleep(self.warmup)  # allow the camera to warm up
+
+        return self
+
+    def close(self):
+        if self.camera is not None:
+            self.camera.close()
+            self.camera = None
+
+    def frames(self):
+        for frame in self.camera.capture_continuous(self.raw_capture, format="bgr", use_video_port=True):
+            timestamp = datetime.datetime.now()
+            image = frame.array
+            # clear the stream in preparation for the next frame
+            self.raw_capture.truncate(0)
+            yield self._make_frame(image, timestamp)
+
+    def set_framerate(self, framerate):
+        framerate = min(framerate, self.max_framerate)
+        super(PiCameraSource, self).set_framerate(framerate)
+        if self.camera is not None:
+            self.camera.framerate_delta = framerate - self.max_framerate
+
+
+class VideoCaptureSource(FrameSource):
+    """
+    V4L2 or USB camera opened through cv2.VideoCapture.
+    """
+
+    def __init__(self, device, resolution, framerate):
+        super(VideoCaptureSource, self).__init__(resolution, framerate)
+        self.device = device
+        self.capture_device = None
+
+    def open(self):
+        self.close()
+        self.capture_device = cv2.VideoCapture(self.device)
+        if not self.capture_device.isOpened():
+            raise IOError("Could not open video device {0}".format(self.device))
+
+        self.capture_device.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+        self.capture_device.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+        self.capture_device.set(cv2.CAP_PROP_FPS, self.framerate)
+
+        return self
+
+    def close(self):
+        if self.capture_device is not None:
+            self.capture_device.release()
+            self.capture_device = None
+
+    def frames(self):
+        while True:
+            grabbed, image = self.capture_device.read()
+            timestamp = datetime.datetime.now()
+            if not grabbed:
+                return
+            yield self._make_frame(image, timestamp)
+
+    def set_framerate(self, framerate):
+        super(VideoCaptureSource, self).set_framerate(framerate)
+        if self.capture_device is not None:
+            self.capture_device.set(cv2.CAP_PROP_FPS, framerate)
+
+
+class FileSource(FrameSource):
+    """
+    Recorded video file.
+
+    Timestamps are derived from the position within the file, so speeds come
+    out the same whether the file is replayed in real time or unthrottled.
+    A part of the file can be read by giving its offset and duration.
+    """
+
+    def __init__(self, path, realtime=False, start_time=None, offset=0.0, duration=None):
+        """
+        :param path: video file
+        :param realtime: replay at the recorded rate instead of unthrottled
+        :param start_time: datetime the recording started; defaults to now
+        :param offset: seconds into the file to start reading at
+        :param duration: seconds to read, or None for the rest of the file
+        """
+        super(FileSource, self).__init__((0, 0), 0)
+        self.path = path
+        self.realtime = realtime
+        self.start_time = start_time
+        self.offset = offset
+        self.duration = duration
+        self.capture_device = None
+
+    def open(self):
+        self.close()
+        self.capture_device = cv2.VideoCapture(self.path)
+        if not self.capture_device.isOpened():
+            raise IOError("Could not open video file {0}".format(self.path))
+
+        self.resolution = (int(self.capture_device.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                           int(self.capture_device.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.framerate = self.capture_device.get(cv2.CAP_PROP_FPS) or 30.0
+        if self.start_time is None:
+            self.start_time = datetime.datetime.now()
+        if self.offset:
+            self.capture_device.set(cv2.CAP_PROP_POS_MSEC, self.offset * 1000.0)
+
+        return self
+
+    def length(self):
+        """
+        :return: length of the whole file in seconds, 0.0 if the container doesn't say
+        """
+        frames = self.capture_device.get(cv2.CAP_PROP_FRAME_COUNT)
+        return max(frames, 0.0) / float(self.framerate)
+
+    def close(self):
+        if self.capture_device is not None:
+            self.capture_device.release()
+            self.capture_device = None
+
+    def frames(self):
+        wall_start = time.time()
+        while True:
+            grabbed, image = self.capture_device.read()
+            if not grabbed:
+                return
+
+            # Fall back on the nominal rate for containers without timestamps
+            offset = self.capture_device.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            if offset <= 0.0 and self.frame_count > 0:
+                offset = self.offset + self.frame_count / float(self.framerate)
+            if self.duration is not None and offset >= self.offset + self.duration:
+                return
+
+            if self.realtime:
+                delay = offset - self.offset - (time.time() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            timestamp = self.start_time + datetime.timedelta(seconds=offset)
+            yield self._make_frame(image, timestamp)
+
+    def set_framerate(self, framerate):
+        pass  # A recording plays back at the rate it was made
+
+
+class ThroughputMeter(object):
+    """
+    Measures how many frames per second the main loop actually processes.
+    """
+
+    def __init__(self):
+        self.started = None
+        self.frames = 0
+
+    def tick(self):
+        """
+        Counts one processed frame.
+        :return: None
+        """
+        if self.started is None:
+            self.started = time.time()
+        self.frames += 1
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return time.time() - self.started
+
+    def fps(self):
+        elapsed = self.elapsed()
+        if elapsed <= 0.0:
+            return 0.0
+        return self.frames / elapsed
+
+
+def open_source(kind, resolution, framerate, device=0, path=None, realtime=False, max_framerate=None,
+                generator=None):
+    """
+    Creates and opens a frame source by name.
+    :param kind: 'picamera', 'v4l2', 'file' or 'synthetic'
+    :param resolution: (width, height) to capture at
+    :param framerate: frames per second to capture at
+    :param device: device index or path for 'v4l2'
+    :param path: video file for 'file'; for 'synthetic', where to write the ground truth, or None
+    :param realtime: for 'file' and 'synthetic', deliver frames at their rate instead of unthrottled
+    :param max_framerate: for 'picamera', the highest rate the camera will be asked for later
+    :param generator: speedcam.synthetic.TrafficGenerator for 'synthetic'
+    :return: an opened FrameSource
+    """
+    if kind == 'picamera':
+        source = PiCameraSource(resolution, framerate, max_framerate=max_framerate)
+    elif kind == 'v4l2':
+        source = VideoCaptureSource(device, resolution, framerate)
+    elif kind == 'file':
+        source = FileSource(path, realtime=realtime)
+    elif kind == 'synthetic':
+        from speedcam.synthetic import SyntheticSource
+        source = SyntheticSource(generator, realtime=realtime, manifest_path=path)
+    else:
+        raise ValueError("Unknown frame source: {0}".format(kind))
+
+    return source.open()
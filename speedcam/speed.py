@@ -0,0 +1,117 @@
+"""
+Track-level speed estimation.
+
+Rather than recomputing a speed on every frame and taking the median, each
+track's history of (capture time, front-edge x) is converted to feet with a
+lookup table built once at start-up, and a straight line is fitted through
+it by least squares. Points far from the line (a headlight flare, a merge
+with a neighbouring blob) are rejected and the line refitted. The slope is
+the speed; how tightly the points fit gives the confidence.
+"""
+
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from speedcam.tracker import LEFT_TO_RIGHT, RIGHT_TO_LEFT
+
+FEET_PER_SECOND_TO_MPH = 0.681818
+
+SpeedEstimate = namedtuple('SpeedEstimate', ['mph', 'confidence', 'points'])
+
+# Stored as rating_version next to the confidence, which replaced the number of frames tracked as the rating
+CONFIDENCE_VERSION = 1
+
+
+def feet_per_pixel(distance, image_width, field_of_view):
+    """
+    Calculates the number of feet a single pixel represents.
+    :param distance: distance from the camera to the lane, in feet
+    :param image_width: width of the full frame in pixels
+    :param field_of_view: horizontal field of view of the camera, in degrees
+    :return: feet per pixel
+    """
+    frame_width_ft = 2 * (math.tan(math.radians(field_of_view * 0.5)) * distance)
+    return frame_width_ft / float(image_width)
+
+
+class PixelScale(object):
+    """
+    Lookup tables from x in the monitored area to feet along the road, one per direction.
+    """
+
+    def __init__(self, width, image_width, field_of_view, ltr_distance, rtl_distance, pixel_size=1.0):
+        """
+        :param width: width of the monitored area, in detection pixels
+        :param image_width: width of the full frame, in camera pixels
+        :param field_of_view: horizontal field of view of the camera, in degrees
+        :param ltr_distance: distance to the left-to-right lane, in feet
+        :param rtl_distance: distance to the right-to-left lane, in feet
+        :param pixel_size: camera pixels per detection pixel, e.g. 2 when detecting at half resolution
+        """
+        columns = np.arange(width + 1, dtype=np.float64) * pixel_size
+        self.tables = {
+            LEFT_TO_RIGHT: columns * feet_per_pixel(ltr_distance, image_width, field_of_view),
+            RIGHT_TO_LEFT: columns * feet_per_pixel(rtl_distance, image_width, field_of_view),
+        }
+
+    def feet(self, direction, xs):
+        """
+        :param direction: LEFT_TO_RIGHT or RIGHT_TO_LEFT
+        :param xs: array of x positions in the monitored area
+        :return: array of positions in feet
+        """
+        table = self.tables[direction]
+        return table[np.clip(xs, 0, len(table) - 1)]
+
+
+def fit_speed(times, feet, rejection=3.0, iterations=3, min_points=3):
+    """
+    Robust least-squares fit of position against time.
+    :param times: array of seconds
+    :param feet: array of positions in feet
+    :param rejection: points further than this many robust standard deviations from the line are dropped
+    :param iterations: most refits after rejecting points
+    :param min_points: fewest points a fit may rest on
+    :return: SpeedEstimate, or None if there are too few usable points
+    """
+    keep = np.ones(len(times), dtype=bool)
+    if keep.sum() < min_points or np.ptp(times) <= 0:
+        return None
+
+    for _ in range(iterations + 1):
+        t, x = times[keep], feet[keep]
+        slope, intercept = np.polyfit(t, x, 1)
+        residuals = feet - (slope * times + intercept)
+        sigma = 1.4826 * np.median(np.abs(residuals[keep]))  # median absolute deviation
+        inliers = np.abs(residuals) <= max(rejection * sigma, 0.5)  # never reject within half a foot
+        if inliers.sum() < min_points or np.array_equal(inliers, keep):
+            break
+        keep = inliers
+
+    t, x = times[keep], feet[keep]
+    n = len(t)
+    slope, intercept = np.polyfit(t, x, 1)
+    if n > 2:
+        residual_variance = np.sum((x - (slope * t + intercept)) ** 2) / (n - 2)
+        slope_error = math.sqrt(residual_variance / np.sum((t - t.mean()) ** 2))
+    else:
+        slope_error = abs(slope)
+
+    # Relative precision of the slope, scaled down by the share of points rejected
+    precision = max(0.0, 1.0 - slope_error / abs(slope)) if slope else 0.0
+    confidence = precision * n / float(len(times))
+    return SpeedEstimate(abs(slope) * FEET_PER_SECOND_TO_MPH, confidence, n)
+
+
+def estimate_track_speed(track, scale, **kwargs):
+    """
+    Estimates the speed of a finished track.
+    :param track: a tracker.Track
+    :param scale: PixelScale for the monitored area
+    :return: SpeedEstimate, or None if the track can't be measured
+    """
+    if track.direction not in (LEFT_TO_RIGHT, RIGHT_TO_LEFT):
+        return None
+    return fit_speed(track.times[:track.count], scale.feet(track.direction, track.front_edges()), **kwargs)
@@ -0,0 +1,219 @@
+"""
+Local store-and-forward spool.
+
+Detections are first appended to a SQLite file in WAL mode on the Pi, which
+takes microseconds and works whether or not the database is reachable. A
+Forwarder thread drains the spool to the database in batches and only
+removes records once the database transaction holding them has committed.
+Records are replayed after a crash or restart; the database ignores
+vehicles whose track_key it already has and merges log entries, so
+replaying never duplicates rows.
+
+The dashboard rollups are updated in the same transaction, from the
+vehicles the database actually inserted.
+
+SQLAlchemy and the database driver are only imported, and the engine only
+created, on the forwarder thread, so none of it delays the first frame.
+"""
+
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+VEHICLES = 'vehicles'
+LOG = 'log'
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError("Can't spool {0!r}".format(value))
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        value = obj['__datetime__']
+        fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+        return datetime.datetime.strptime(value, fmt)
+    return obj
+
+
+class Spool(object):
+    """
+    Durable, append-only queue of records kept in a SQLite file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS spool ("
+                                 "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL)")
+        self._connection.commit()
+
+    def append(self, kind, rows):
+        """
+        Appends records to the spool.
+        :param kind: VEHICLES or LOG
+        :param rows: list of dicts of column values
+        :return: None
+        """
+        records = [(kind, json.dumps(row, default=_encode)) for row in rows]
+        with self._lock:
+            self._connection.executemany("INSERT INTO spool (kind, payload) VALUES (?, ?)", records)
+            self._connection.commit()
+
+    def write(self, rows):
+        """
+        Sink interface for DetectionWriter: appends vehicles.
+        :param rows: list of dicts of column values
+        :return: None
+        """
+        self.append(VEHICLES, rows)
+
+    def pending(self, limit):
+        """
+        Oldest records not yet forwarded.
+        :param limit: most records to return
+        :return: list of (id, kind, row)
+        """
+        with self._lock:
+            records = self._connection.execute("SELECT id, kind, payload FROM spool ORDER BY id LIMIT ?",
+                                               (limit,)).fetchall()
+        return [(record_id, kind, json.loads(payload, object_hook=_decode)) for record_id, kind, payload in records]
+
+    def ack(self, last_id):
+        """
+        Removes every record up to and including last_id.
+        :param last_id: id of the last forwarded record
+        :return: None
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+            self._connection.commit()
+
+    def depth(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class Forwarder(threading.Thread):
+    """
+    Drains a Spool to the database in batches, retrying with backoff while it is unreachable.
+    """
+
+    def __init__(self, spool, engine, batch_size=500, poll_interval=2.0, max_backoff=60.0):
+        """
+        :param spool: Spool to drain
+        :param engine: SQLAlchemy engine of the database, or a function returning one
+        :param batch_size: most records forwarded per transaction
+        :param poll_interval: seconds to wait when the spool is empty
+        :param max_backoff: longest wait, in seconds, between retries while the database is failing
+        """
+        super(Forwarder, self).__init__(name="spool-forwarder")
+        self.daemon = True
+        self.spool = spool
+        self.engine = None if callable(engine) else engine
+        self.engine_factory = engine if callable(engine) else None
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+
+        self.schema_month = None
+        self.forwarded = 0
+        self.failures = 0
+        self.last_forward = None
+        self.last_error = None
+
+        self._stop_event = threading.Event()
+
+    def forward(self, records):
+        """
+        Writes one batch of spooled records in a single transaction.
+        :param records: list of (id, kind, row) as returned by Spool.pending()
+        :return: None
+        """
+        from db import Vehicles, aggregate_rollups, insert_ignoring_duplicates, merge_rollups, upsert_log
+
+        logs = [row for record_id, kind, row in records if kind == LOG]
+        vehicles = [dict({'evidence': None, 'rating_version': None}, **row)
+                    for record_id, kind, row in records if kind == VEHICLES]
+
+        with self.engine.begin() as connection:
+            for row in logs:  # sessions must exist before their vehicles
+                connection.execute(upsert_log(connection.dialect), row)
+            if vehicles:
+                table = Vehicles.__table__
+                statement = insert_ignoring_duplicates(table, connection.dialect).returning(
+                    table.c.datetime, table.c.speed, table.c.direction, table.c.rating, table.c.rating_version)
+                inserted = connection.execute(statement, vehicles).fetchall()
+                merge_rollups(connection, *aggregate_rollups(inserted))
+
+    def drain(self):
+        """
+        Forwards batches until the spool is empty.
+        :return: number of records forwarded
+        """
+        from db import ensure_schema
+
+        if self.engine is None:
+            self.engine = self.engine_factory()
+
+        month = datetime.date.today().replace(day=1)
+        if self.schema_month != month:  # also creates the coming months' partitions
+            ensure_schema(self.engine)
+            self.schema_month = month
+
+        count = 0
+        while True:
+            records = self.spool.pending(self.batch_size)
+            if not records:
+                return count
+            self.forward(records)
+            self.spool.ack(records[-1][0])
+            count += len(records)
+            self.forwarded += len(records)
+            self.last_forward = time.time()
+
+    def run(self):
+        backoff = self.poll_interval
+        while not self._stop_event.is_set():
+            try:
+                self.drain()
+            except Exception as e:  # Database unreachable; the records stay in the spool
+                self.failures += 1
+                self.last_error = e
+                print("Forwarding spooled detections failed, retrying in {0:.0f}s: {1}".format(backoff, e))
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            else:
+                backoff = self.poll_interval
+                self._stop_event.wait(self.poll_interval)
+
+    def stop(self, timeout=None):
+        """
+        Stops the thread and makes one last attempt to empty the spool.
+        :param timeout: seconds to wait for the thread
+        :return: None
+        """
+        self._stop_event.set()
+        self.join(timeout)
+        try:
+            self.drain()
+        except Exception as e:
+            print("{0} detections left in the spool: {1}".format(self.spool.depth(), e))
+
+    def stats(self):
+        return {
+            'spooled': self.spool.depth(),
+            'forwarded': self.forwarded,
+            'failures': self.failures,
+        }
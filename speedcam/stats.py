@@ -0,0 +1,392 @@
+"""
+Live speed statistics.
+
+Every measured vehicle is folded into running statistics as it is found,
+per direction, for the whole session and for each fixed time window (15
+minutes by default, the last day's worth kept). Each summary holds a count,
+the running mean and variance (Welford's method), the share over the speed
+threshold and a t-digest: a quantile sketch of at most a few hundred
+centroids, accurate at the tails, where the 85th percentile is, and
+mergeable, so both directions together or several windows together are
+summarised without keeping a single speed. Memory stays bounded however
+long the camera runs.
+
+A StatsPublisher thread writes them as a small JSON file every few
+seconds, so live figures such as the 85th-percentile speed need no query
+against the vehicles table.
+"""
+
+import datetime
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+
+QUANTILES = (0.5, 0.85, 0.95)
+ALL = 'all'
+
+
+class Moments(object):
+    """
+    Count, mean, variance, min and max, updated one value at a time.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """
+        Folds in another Moments, as if its values had been added here.
+        :return: self
+        """
+        if other.count:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.count = count
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        return self
+
+    def variance(self):
+        """
+        :return: sample variance, 0.0 with fewer than two values
+        """
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+
+class TDigest(object):
+    """
+    Merging t-digest (Dunning and Ertl): values are buffered and merged into
+    centroids sized by the k1 scale function, small at the tails and large
+    around the median.
+    """
+
+    def __init__(self, compression=100):
+        """
+        :param compression: larger is more accurate; at most about compression centroids are kept
+        """
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self._buffer = []
+        self._buffer_size = 5 * compression
+
+    def add(self, value, weight=1):
+        self._buffer.append((value, weight))
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer) >= self._buffer_size:
+            self._compress()
+
+    def merge(self, other):
+        """
+        Folds in another TDigest, as if its values had been added here.
+        :return: self
+        """
+        other._compress()
+        self._buffer.extend(zip(other.means, other.weights))
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _limit(self, q):
+        """
+        :return: the highest quantile a centroid starting at quantile q may reach
+        """
+        k = self.compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        return (math.sin(min(k * 2 * math.pi / self.compression, math.pi / 2)) + 1) / 2
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        points = sorted(list(zip(self.means, self.weights)) + self._buffer)
+        self._buffer = []
+        total = float(self.count)
+        means, weights = [], []
+        mean, weight = points[0]
+        below = 0.0  # weight of the finished centroids
+        limit = self._limit(0.0)
+        for value, w in points[1:]:
+            if (below + weight + w) / total <= limit:
+                weight += w
+                mean += (value - mean) * w / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                below += weight
+                limit = self._limit(below / total)
+                mean, weight = value, w
+        means.append(mean)
+        weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def quantile(self, q):
+        """
+        :param q: quantile, 0 to 1
+        :return: estimated value, or None with no values
+        """
+        self._compress()
+        if not self.count:
+            return None
+        means, weights = self.means, self.weights
+        rank = q * self.count
+        if len(means) == 1 or rank <= weights[0] / 2.0:
+            # between the minimum and the centre of the first centroid
+            span = weights[0] / 2.0
+            return self.min + (means[0] - self.min) * min(rank / span, 1.0) if span else means[0]
+
+        below = 0.0
+        for i in range(len(means) - 1):
+            centre = below + weights[i] / 2.0
+            following = below + weights[i] + weights[i + 1] / 2.0
+            if rank <= following:
+                return means[i] + (means[i + 1] - means[i]) * (rank - centre) / (following - centre)
+            below += weights[i]
+
+        # between the centre of the last centroid and the maximum
+        span = weights[-1] / 2.0
+        return means[-1] + (self.max - means[-1]) * min((rank - (self.count - span)) / span, 1.0)
+
+
+class SpeedSummary(object):
+    """
+    Moments, quantile sketch and share over the threshold of a set of speeds.
+    """
+
+    def __init__(self, threshold, compression=100):
+        """
+        :param threshold: speed over which a vehicle is a speeder
+        :param compression: of the t-digest
+        """
+        self.threshold = threshold
+        self.compression = compression
+        self.moments = Moments()
+        self.digest = TDigest(compression)
+        self.over = 0
+
+    def add(self, mph):
+        self.moments.add(mph)
+        self.digest.add(mph)
+        if mph > self.threshold:
+            self.over += 1
+
+    def merge(self, other):
+        """
+        :return: self
+        """
+        self.moments.merge(other.moments)
+        self.digest.merge(other.digest)
+        self.over += other.over
+        return self
+
+    def as_dict(self, quantiles=QUANTILES):
+        """
+        :return: count, mean, std, min, max, p50 and the like, and the share over the threshold
+        """
+        moments = self.moments
+        if not moments.count:
+            return OrderedDict([('count', 0)])
+        summary = OrderedDict([
+            ('count', moments.count),
+            ('mean', round(moments.mean, 2)),
+            ('std', round(moments.std(), 2)),
+            ('min', round(moments.min, 2)),
+            ('max', round(moments.max, 2)),
+        ])
+        for q in quantiles:
+            summary['p{0:g}'.format(q * 100)] = round(self.digest.quantile(q), 2)
+        summary['over_threshold'] = round(self.over / float(moments.count), 4)
+        return summary
+
+
+class SpeedStatistics(object):
+    """
+    SpeedSummary per direction, for the session and for each recent time window. Thread safe.
+    """
+
+    def __init__(self, threshold, window_seconds=900, windows=96, quantiles=QUANTILES, compression=100):
+        """
+        :param threshold: speed over which a vehicle is a speeder
+        :param window_seconds: length of each time window, aligned to the clock
+        :param windows: most windows kept, the earliest dropped first
+        :param quantiles: quantiles reported, 0 to 1
+        :param compression: of the t-digests
+        """
+        self.threshold = threshold
+        self.window_seconds = window_seconds
+        self.windows = windows
+        self.quantiles = tuple(quantiles)
+        self.compression = compression
+        self.session = OrderedDict()  # direction: SpeedSummary
+        self.recent = {}  # window start, seconds since the epoch: {direction: SpeedSummary}
+        self._lock = threading.Lock()
+
+    def _summary(self, summaries, direction):
+        summary = summaries.get(direction)
+        if summary is None:
+            summary = summaries[direction] = SpeedSummary(self.threshold, self.compression)
+        return summary
+
+    def add(self, direction, mph, when):
+        """
+        Counts one vehicle. Called from the detection loop, once per vehicle. Vehicles may come out of
+        time order, e.g. replayed; one from before every window kept only counts for the session.
+        :param direction: e.g. "North", as in the vehicles table
+        :param mph: measured speed
+        :param when: datetime the vehicle was seen
+        :return: None
+        """
+        start = int(when.timestamp() // self.window_seconds * self.window_seconds)
+        with self._lock:
+            self._summary(self.session, direction).add(mph)
+            window = self.recent.get(start)
+            if window is None:
+                if len(self.recent) >= self.windows and start < min(self.recent):
+                    return
+                window = self.recent[start] = OrderedDict()
+                while len(self.recent) > self.windows:
+                    del self.recent[min(self.recent)]
+            self._summary(window, direction).add(mph)
+
+    def _directions(self, summaries):
+        """
+        :return: OrderedDict of the summary of each direction, and of all of them merged
+        """
+        merged = SpeedSummary(self.threshold, self.compression)
+        figures = OrderedDict()
+        for direction, summary in sorted(summaries.items()):
+            figures[direction] = summary.as_dict(self.quantiles)
+            merged.merge(summary)
+        figures[ALL] = merged.as_dict(self.quantiles)
+        return figures
+
+    def session_summary(self):
+        """
+        :return: SpeedSummary of every vehicle of the session, both directions merged
+        """
+        merged = SpeedSummary(self.threshold, self.compression)
+        with self._lock:
+            for summary in self.session.values():
+                merged.merge(summary)
+        return merged
+
+    def describe(self):
+        """
+        :return: one line for the status display
+        """
+        summary = self.session_summary()
+        if not summary.moments.count:
+            return "No vehicles yet"
+        return "{0} vehicles, mean {1:.1f} MPH, 85th percentile {2:.1f} MPH, {3:.0%} over {4}".format(
+            summary.moments.count, summary.moments.mean, summary.digest.quantile(0.85),
+            summary.over / float(summary.moments.count), self.threshold)
+
+    def gauges(self, prefix='speed'):
+        """
+        :return: dict of the session's count, mean, 85th percentile and share over the threshold, for Metrics
+        """
+        summary = self.session_summary()
+        if not summary.moments.count:
+            return {prefix + '_vehicles': 0}
+        return {
+            prefix + '_vehicles': summary.moments.count,
+            prefix + '_mean_mph': summary.moments.mean,
+            prefix + '_p85_mph': summary.digest.quantile(0.85),
+            prefix + '_over_threshold': summary.over / float(summary.moments.count),
+        }
+
+    def as_dict(self):
+        """
+        :return: the session's and each recent window's figures, by direction, as plain data
+        """
+        with self._lock:
+            windows = []
+            for start, summaries in sorted(self.recent.items()):
+                window = OrderedDict([
+                    ('start', datetime.datetime.fromtimestamp(start).isoformat()),
+                    ('end', datetime.datetime.fromtimestamp(start + self.window_seconds).isoformat()),
+                ])
+                window.update(self._directions(summaries))
+                windows.append(window)
+            return OrderedDict([
+                ('time', datetime.datetime.now().isoformat()),
+                ('threshold', self.threshold),
+                ('window_seconds', self.window_seconds),
+                ('session', self._directions(self.session)),
+                ('windows', windows),
+            ])
+
+
+class StatsPublisher(threading.Thread):
+    """
+    Writes speed statistics to a JSON file at a fixed interval.
+    """
+
+    def __init__(self, collect, path, interval=5.0):
+        """
+        :param collect: callable returning the statistics as plain data, e.g. SpeedStatistics.as_dict
+        :param path: JSON file, rewritten atomically
+        :param interval: seconds between writes
+        """
+        super(StatsPublisher, self).__init__(name="stats-publisher")
+        self.daemon = True
+        self.collect = collect
+        self.path = path
+        self.interval = interval
+        self.publications = 0
+        self.last_error = None
+        self._stop_event = threading.Event()
+
+    def publish(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.collect(), f, indent=1)
+        os.replace(temporary, self.path)  # readers never see a half-written file
+        self.publications += 1
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as e:  # Statistics are never worth stopping detection for
+                if self.last_error is None:
+                    print("Publishing speed statistics failed: {0}".format(e))
+                self.last_error = e
+
+    def stop(self, timeout=None):
+        """
+        Stops the thread after one final write.
+        :param timeout: seconds to wait for the thread
+        :return: None
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        try:
+            self.publish()
+        except Exception as e:
+            self.last_error = e
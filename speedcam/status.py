@@ -0,0 +1,148 @@
+"""
+Status output.
+
+The detection loop never prints a status screen itself. It records events
+and the StatusRenderer thread redraws the status at a fixed, low rate, so
+the cost to the loop is a lock and a deque append per event. Output modes:
+
+    TERMINAL - redraw the terminal in place with ANSI escapes (no shell is spawned)
+    LOG      - one JSON line per interval, for journald or a log file
+    FILE     - rewrite a JSON status file atomically, for other programs to read
+    NONE     - record events only
+"""
+
+import datetime
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict, deque
+
+TERMINAL = 'terminal'
+LOG = 'log'
+FILE = 'file'
+NONE = 'none'
+
+MODES = (TERMINAL, LOG, FILE, NONE)
+
+CLEAR = '\033[H\033[J'
+
+
+def _encode(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+class StatusRenderer(threading.Thread):
+    """
+    Redraws the status at a fixed rate on its own thread.
+    """
+
+    def __init__(self, collect, mode=TERMINAL, interval=1.0, path='status.json', title='Car Speed Detector',
+                 events=5, stream=None):
+        """
+        :param collect: callable returning an OrderedDict of status fields, called on the renderer thread
+        :param mode: TERMINAL, LOG, FILE or NONE
+        :param interval: seconds between redraws
+        :param path: status file for FILE
+        :param title: heading of the terminal screen
+        :param events: number of recent events shown
+        :param stream: where TERMINAL and LOG write, stdout by default
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown status mode: {0}".format(mode))
+
+        super(StatusRenderer, self).__init__(name="status")
+        self.daemon = True
+        self.collect = collect
+        self.mode = mode
+        self.interval = interval
+        self.path = path
+        self.title = title
+        self.stream = stream or sys.stdout
+        self.renders = 0
+        self.last_error = None
+
+        self._events = deque(maxlen=events)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def event(self, message):
+        """
+        Records something worth telling the user, shown on the next redraw.
+        :param message: text of the event
+        :return: None
+        """
+        with self._lock:
+            self._events.append((datetime.datetime.now(), message))
+
+    def snapshot(self):
+        """
+        :return: OrderedDict of the current fields, with the recent events under 'events'
+        """
+        status = OrderedDict([('time', datetime.datetime.now())])
+        status.update(self.collect())
+        with self._lock:
+            status['events'] = list(self._events)
+        return status
+
+    def render(self):
+        """
+        Writes the status once in the configured mode.
+        :return: None
+        """
+        if self.mode == NONE:
+            return
+
+        status = self.snapshot()
+        if self.mode == TERMINAL:
+            self._render_terminal(status)
+        elif self.mode == LOG:
+            status['events'] = [message for _, message in status['events']]
+            self.stream.write(json.dumps(status, default=_encode) + '\n')
+            self.stream.flush()
+        elif self.mode == FILE:
+            status['events'] = [dict(time=when, message=message) for when, message in status['events']]
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(status, f, default=_encode, indent=1)
+            os.replace(temporary, self.path)  # readers never see a half-written file
+        self.renders += 1
+
+    def _render_terminal(self, status):
+        lines = ["=" * 57, self.title.center(57).rstrip(), "=" * 57]
+        events = status.pop('events')
+        status['time'] = status['time'].strftime('%Y-%m-%d %H:%M:%S')
+        for name, value in status.items():
+            lines.append("{0:<24} {1}".format(name.replace('_', ' ').capitalize() + ':', value))
+        if events:
+            lines.append("")
+            for when, message in events:
+                lines.append("{0}  {1}".format(when.strftime('%H:%M:%S'), message))
+
+        self.stream.write(CLEAR + "\n".join(lines) + "\n")
+        self.stream.flush()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.render()
+            except Exception as e:  # A full disk or a closed terminal shouldn't take detection down
+                self.last_error = e
+                self.stream.write("Status output failed: {0}\n".format(e))
+                self._stop_event.wait(10 * self.interval)
+
+    def stop(self, timeout=None):
+        """
+        Stops redrawing after one final render.
+        :param timeout: seconds to wait for the thread
+        :return: None
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+        try:
+            self.render()
+        except Exception as e:  # the rest of shutdown, flushing vehicles included, must still run
+            self.last_error = e
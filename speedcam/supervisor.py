@@ -0,0 +1,469 @@
+"""
+Several cameras or lanes, one process each.
+
+The supervisor starts one worker process per pipeline (a camera and a
+monitored area with its own calibration) and pins each to a CPU core.
+Workers run capture and detection only; the vehicles and log entries they
+find come back over a single multiprocessing queue to the supervisor, which
+owns the one spool, detection writer and database forwarder for all of
+them.
+
+Workers send a heartbeat with their throughput every second. A worker that
+dies, or whose heartbeats stop because its camera hung, is terminated and
+restarted after a delay that doubles with every consecutive failure. A
+worker whose recorded video simply ended is left finished.
+
+Usage:
+    python -m speedcam.supervisor pipelines.json [--dry-run] [--database-url URL]
+
+where pipelines.json holds shared settings and one entry per pipeline:
+
+    {"settings": {"frame_source": "v4l2", "day_fps": 30},
+     "pipelines": [
+        {"name": "north", "video_device": 0, "monitored_area": [65, 260, 615, 315],
+         "ltr_distance": 27, "rtl_distance": 34},
+        {"name": "south", "video_device": 1, "monitored_area": [40, 200, 600, 250],
+         "ltr_distance": 45, "rtl_distance": 52, "cpu": 3}]}
+
+Each worker opens its own frame source, and a camera can only be opened
+once, so every camera pipeline needs a camera of its own: two lanes seen
+by one camera are one pipeline, with a monitored area spanning both.
+Pipelines that would share a picamera or a v4l2 device are rejected when
+the file is read. Recorded videos may be shared.
+
+A pipeline given a preview_port serves its own browser preview, see
+speedcam.preview; each publishes to a frame bus named after it. The
+supervisor keeps the live speed statistics of every pipeline, see
+speedcam.stats, and writes them together to speed_stats_path.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from speedcam.app import SpeedCamera, _database_engine
+from speedcam.config import Config
+from speedcam.metrics import Metrics, MetricsExporter
+from speedcam.spool import Spool, Forwarder, LOG, VEHICLES
+from speedcam.stats import SpeedStatistics, StatsPublisher
+from speedcam.status import StatusRenderer
+from speedcam.writer import DetectionWriter
+
+EVENT = 'event'
+HEARTBEAT = 'heartbeat'
+
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+
+class _Channel(object):
+    """
+    Stands in for the spool, the writer and the status renderer inside a worker, sending everything to the supervisor.
+    """
+
+    def __init__(self, name, messages):
+        self.name = name
+        self.messages = messages
+        self.vehicles = 0
+
+    def submit(self, row):
+        self.messages.put((self.name, VEHICLES, row))
+        self.vehicles += 1
+        return True
+
+    def append(self, kind, rows):
+        for row in rows:
+            self.messages.put((self.name, kind, row))
+
+    def event(self, message):
+        self.messages.put((self.name, EVENT, message))
+
+
+class PipelineWorker(SpeedCamera):
+    """
+    A headless SpeedCamera whose output goes to the supervisor.
+    """
+
+    def __init__(self, name, config, messages, stop_event, heartbeat_interval=1.0):
+        super(PipelineWorker, self).__init__(config)
+        self.name = name
+        self.channel = _Channel(name, messages)
+        self.stop_event = stop_event
+        self.heartbeat_interval = heartbeat_interval
+        self.last_heartbeat = 0.0
+
+    def start(self):
+        self.spool = self.writer = self.status = self.channel
+        self.open_camera()
+        self.log_entry("in")  # Log usage
+        self.start_evidence()
+        self.start_capture()
+        self.start_viewers()
+        self.heartbeat()
+
+    def heartbeat(self):
+        frame = self.metrics.histograms.get('frame')
+        self.channel.messages.put((self.name, HEARTBEAT, dict(
+            pid=os.getpid(),
+            frames=self.meter.frames,
+            fps=self.meter.fps(),
+            vehicles=self.channel.vehicles,
+            requested_fps=self.controller.framerate or 0,
+            dropped_frames=self.frame_queue.dropped,
+            frame_p99_ms=frame.quantile(0.99) * 1000.0 if frame else 0.0,
+        )))
+        self.last_heartbeat = time.time()
+
+    def process(self, frame):
+        keep_going = super(PipelineWorker, self).process(frame)
+        if time.time() - self.last_heartbeat >= self.heartbeat_interval:
+            self.heartbeat()
+        return keep_going and not self.stop_event.is_set()
+
+    def stop(self):
+        if self.capture_thread is not None:
+            self.capture_thread.stop()
+            self.capture_thread.join(2.0)
+            self.heartbeat()
+        self.stop_viewers()
+        if self.camera is not None:
+            self.camera.close()
+        if self.evidence is not None:
+            self.evidence.stop(30.0)
+        if self.capture_thread is not None and self.capture_thread.error is not None:
+            raise IOError("Capture failed: {0}".format(self.capture_thread.error))
+
+
+def run_pipeline(name, config, cpu, messages, stop_event):
+    """
+    Entry point of a worker process.
+    :param name: name of the pipeline
+    :param config: Config of the pipeline
+    :param cpu: core to pin the process to, or None
+    :param messages: multiprocessing queue to the supervisor
+    :param stop_event: multiprocessing event set when the worker should stop
+    :return: None
+    """
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):  # Linux only
+        os.sched_setaffinity(0, {cpu})
+
+    worker = PipelineWorker(name, config, messages, stop_event)
+    try:
+        worker.start()
+        worker.run()
+    finally:
+        worker.stop()
+
+
+class Pipeline(object):
+    """
+    The supervisor's view of one worker process.
+    """
+
+    def __init__(self, name, config, cpu=None):
+        self.name = name
+        self.config = config
+        self.cpu = cpu
+        self.process = None
+        self.stop_event = None
+        self.state = None
+        self.started = None
+        self.last_heartbeat = None
+        self.stats = {}
+        self.speeds = SpeedStatistics(config.speed_threshold, config.speed_stats_window, config.speed_stats_windows)
+        self.restarts = 0
+        self.failures = 0  # consecutive
+        self.restart_at = None
+
+    def summary(self):
+        return "{0}, {1:.1f} FPS, {2} frames, {3} vehicles, {4} restarts".format(
+            self.state, self.stats.get('fps', 0.0), self.stats.get('frames', 0), self.stats.get('vehicles', 0),
+            self.restarts)
+
+
+class Supervisor(object):
+    """
+    Runs and watches the pipelines, writing their vehicles through one shared writer.
+    """
+
+    def __init__(self, config, pipelines, heartbeat_timeout=10.0, restart_delay=5.0, max_restart_delay=300.0):
+        """
+        :param config: Config with the shared settings: spool, database, status and metrics
+        :param pipelines: list of Pipeline
+        :param heartbeat_timeout: seconds without a heartbeat before a worker is taken for hung
+        :param restart_delay: seconds before restarting a failed worker, doubled on each consecutive failure
+        :param max_restart_delay: longest delay before a restart
+        """
+        self.config = config
+        self.pipelines = OrderedDict((pipeline.name, pipeline) for pipeline in pipelines)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        self.context = multiprocessing.get_context('spawn')  # no threads or open files are inherited
+        self.messages = self.context.Queue()
+        self.metrics = Metrics(config.metrics_enabled)
+        self.spool = None
+        self.writer = None
+        self.forwarder = None
+        self.status = None
+        self.exporter = None
+        self.stats_publisher = None
+        self._receiver = None
+        self._stop_event = threading.Event()
+
+    def start_pipeline(self, pipeline):
+        pipeline.stop_event = self.context.Event()
+        pipeline.process = self.context.Process(
+            target=run_pipeline, name="pipeline-{0}".format(pipeline.name),
+            args=(pipeline.name, pipeline.config, pipeline.cpu, self.messages, pipeline.stop_event))
+        pipeline.process.start()
+        pipeline.state = RUNNING
+        pipeline.started = pipeline.last_heartbeat = time.time()
+        pipeline.restart_at = None
+
+    def receive(self):
+        """
+        Hands what the workers send to the writer, the spool and the status display, until stopped.
+        :return: None
+        """
+        while not (self._stop_event.is_set() and self.messages.empty()):
+            try:
+                name, kind, payload = self.messages.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            pipeline = self.pipelines[name]
+            if kind == VEHICLES:
+                self.writer.submit(payload)
+                pipeline.speeds.add(payload['direction'], payload['speed'], payload['datetime'])
+                self.metrics.count('vehicles')
+            elif kind == LOG:
+                self.spool.append(LOG, [payload])
+            elif kind == HEARTBEAT:
+                pipeline.stats = payload
+                pipeline.last_heartbeat = time.time()
+                pipeline.failures = 0 if payload['frames'] else pipeline.failures
+            elif kind == EVENT:
+                self.status.event("{0}: {1}".format(name, payload))
+
+    def check(self):
+        """
+        Restarts workers that died or stopped sending heartbeats.
+        :return: True while any pipeline is still running or waiting to restart
+        """
+        now = time.time()
+        for pipeline in self.pipelines.values():
+            if pipeline.state == RUNNING:
+                process = pipeline.process
+                if not process.is_alive():
+                    if process.exitcode == 0:
+                        pipeline.state = FINISHED
+                        self.status.event("{0}: finished".format(pipeline.name))
+                        continue
+                    reason = "exited with code {0}".format(process.exitcode)
+                elif now - pipeline.last_heartbeat > self.heartbeat_timeout:
+                    reason = "no heartbeat for {0:.0f}s".format(now - pipeline.last_heartbeat)
+                    process.terminate()
+                    process.join(5.0)
+                else:
+                    continue
+
+                delay = min(self.restart_delay * 2 ** pipeline.failures, self.max_restart_delay)
+                pipeline.failures += 1
+                pipeline.state = FAILED
+                pipeline.restart_at = now + delay
+                self.status.event("{0}: {1}, restarting in {2:.0f}s".format(pipeline.name, reason, delay))
+                self.metrics.count('pipeline_failures')
+
+            elif pipeline.state == FAILED and now >= pipeline.restart_at:
+                pipeline.restarts += 1
+                self.start_pipeline(pipeline)
+
+        return any(pipeline.state != FINISHED for pipeline in self.pipelines.values())
+
+    def status_fields(self):
+        fields = OrderedDict([
+            ('pipelines', len(self.pipelines)),
+            ('spooled_rows', self.spool.depth()),
+            ('written', self.writer.written),
+        ])
+        for pipeline in self.pipelines.values():
+            fields[pipeline.name] = pipeline.summary()
+        return fields
+
+    def pipeline_gauges(self):
+        gauges = {}
+        for pipeline in self.pipelines.values():
+            for name in ('fps', 'frames', 'vehicles', 'requested_fps', 'dropped_frames', 'frame_p99_ms'):
+                gauges['pipeline_{0}_{1}'.format(pipeline.name, name)] = pipeline.stats.get(name, 0)
+            gauges['pipeline_{0}_restarts'.format(pipeline.name)] = pipeline.restarts
+            gauges['pipeline_{0}_up'.format(pipeline.name)] = int(pipeline.state == RUNNING)
+            gauges.update(pipeline.speeds.gauges('pipeline_{0}_speed'.format(pipeline.name)))
+        return gauges
+
+    def speed_statistics(self):
+        return OrderedDict((pipeline.name, pipeline.speeds.as_dict()) for pipeline in self.pipelines.values())
+
+    def start(self):
+        config = self.config
+        self.spool = Spool(config.spool_path)
+        self.writer = DetectionWriter(self.spool, config.db_batch_size, config.db_flush_interval,
+                                      metrics=self.metrics)
+        self.writer.start()
+        if not config.dry_run:
+            self.forwarder = Forwarder(self.spool, _database_engine(config.database_url))
+            self.forwarder.start()
+
+        self.status = StatusRenderer(self.status_fields, config.status_mode, config.status_interval,
+                                     config.status_path, title='Car Speed Detector Supervisor')
+        self.status.start()
+        self._receiver = threading.Thread(target=self.receive, name="supervisor-receiver")
+        self._receiver.daemon = True
+        self._receiver.start()
+
+        self.metrics.add_collector(self.pipeline_gauges)
+        self.metrics.add_collector(lambda: {'writer_' + name: value for name, value in self.writer.stats().items()})
+        if config.metrics_enabled:
+            self.exporter = MetricsExporter(self.metrics, config.metrics_prometheus_path, config.metrics_json_path,
+                                            config.metrics_interval)
+            self.exporter.start()
+        if config.speed_stats_path:
+            self.stats_publisher = StatsPublisher(self.speed_statistics, config.speed_stats_path,
+                                                  config.speed_stats_interval)
+            self.stats_publisher.start()
+
+        for pipeline in self.pipelines.values():
+            self.start_pipeline(pipeline)
+
+    def run(self, interval=1.0):
+        """
+        Watches the pipelines until they have all finished, or CTRL+C.
+        :param interval: seconds between health checks
+        :return: None
+        """
+        try:
+            while self.check():
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+    def stop(self, timeout=10.0):
+        """
+        Stops every worker, then writes out everything they sent.
+        :param timeout: seconds each worker gets to stop cleanly before it is terminated
+        :return: None
+        """
+        for pipeline in self.pipelines.values():
+            if pipeline.stop_event is not None:
+                pipeline.stop_event.set()
+        for pipeline in self.pipelines.values():
+            if pipeline.process is not None:
+                pipeline.process.join(timeout)
+                if pipeline.process.is_alive():
+                    pipeline.process.terminate()
+                    pipeline.process.join(5.0)
+
+        self._stop_event.set()
+        self._receiver.join()
+        self.status.stop(2.0)
+        if self.exporter is not None:
+            self.exporter.stop(2.0)
+        if self.stats_publisher is not None:
+            self.stats_publisher.stop(2.0)
+        self.writer.stop(30.0)
+        if self.forwarder is not None:
+            self.forwarder.stop(30.0)
+        for pipeline in self.pipelines.values():
+            print("{0}: {1}".format(pipeline.name, pipeline.summary()))
+        print("Detection writer: {written} written, {dropped} dropped, {failed} failed".format(
+            **self.writer.stats()))
+        self.spool.close()
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def camera_device(config):
+    """
+    :param config: Config of a pipeline
+    :return: the camera the pipeline opens, comparable between pipelines, or None for a video or synthetic traffic
+    """
+    if config.frame_source == 'picamera':
+        return 'picamera'
+    if config.frame_source == 'v4l2':
+        device = config.video_device
+        return '/dev/video{0}'.format(device) if isinstance(device, int) else os.path.realpath(device)
+    return None
+
+
+def load_pipelines(path, **overrides):
+    """
+    Reads the shared settings and the pipelines from a JSON file.
+    :param path: JSON file, see the module docstring
+    :param overrides: settings that take precedence over the file, for every pipeline
+    :return: (shared Config, list of Pipeline)
+    :raises ValueError: if two pipelines open the same camera
+    """
+    with open(path) as f:
+        description = json.load(f)
+
+    shared = dict(description.get('settings', {}), **overrides)
+    cpus = available_cpus()
+    if len(cpus) > len(description['pipelines']):
+        cpus = cpus[1:]  # leave the first core to the supervisor, the writer and the OS
+
+    pipelines = []
+    devices = {}  # camera: name of the pipeline opening it
+    for index, settings in enumerate(description['pipelines']):
+        settings = dict(settings)
+        name = settings.pop('name', 'pipeline{0}'.format(index + 1))
+        cpu = settings.pop('cpu', cpus[index % len(cpus)])
+        config = Config(**shared).update(**settings)
+        device = camera_device(config)
+        if device in devices:
+            raise ValueError("Pipelines {0} and {1} both open {2}; a camera can only be opened once".format(
+                devices[device], name, device))
+        if device is not None:
+            devices[device] = name
+        # workers have no screen or terminal of their own, but may each serve a preview
+        config.update(use_x=False, draw_monitored_area=False, status_mode='none')
+        if config.frame_bus_name is not None:
+            config.update(frame_bus_name='{0}-{1}'.format(config.frame_bus_name, name))
+        pipelines.append(Pipeline(name, config, cpu))
+    return Config(**shared), pipelines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run several speed camera pipelines, one process each.")
+    parser.add_argument('pipelines', help="JSON file of shared settings and pipelines")
+    parser.add_argument('--database-url')
+    parser.add_argument('--dry-run', action='store_true', default=None,
+                        help="spool vehicles without connecting to the database")
+    parser.add_argument('--heartbeat-timeout', type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    overrides = dict((name, value) for name, value in (('database_url', args.database_url),
+                                                       ('dry_run', args.dry_run)) if value is not None)
+    config, pipelines = load_pipelines(args.pipelines, **overrides)
+    supervisor = Supervisor(config, pipelines, heartbeat_timeout=args.heartbeat_timeout)
+    supervisor.start()
+    try:
+        supervisor.run()
+    finally:
+        supervisor.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
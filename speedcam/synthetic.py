@@ -0,0 +1,431 @@
+"""
+Synthetic road scenes with known traffic.
+
+TrafficGenerator renders a road at any resolution and frame rate, 1080p60
+included, with vehicles arriving at random in both directions at known
+speeds, the light drifting and stepping as clouds pass, headlights and
+their glare after dark, and sensor noise. Every vehicle it draws goes into
+a ground-truth manifest.
+
+SyntheticSource is a FrameSource, so frame_source 'synthetic' feeds the
+generated frames through exactly the pipeline carspeed.py runs on a camera,
+at day_fps, image_width x image_height, with the calibration and the
+monitored area of the config. Replayed unthrottled it measures throughput;
+in real time it stands in for a camera in soak runs, see
+benchmarks/soak.py.
+
+The manifest has the format benchmarks.detection reads, with the time each
+vehicle's centre crosses the middle of the monitored area, plus when it
+entered and left the area. Frames and manifest can also be written to a
+video file for benchmarks.detection:
+
+    python -m speedcam.synthetic road.avi [--seconds 60] [--width 1920 --height 1080 --fps 60]
+
+Rendering is kept cheap so that the generator is not what is measured: the
+road is drawn once, vehicles are filled rectangles, and noise is a slice at
+a random offset of a precomputed field, applied with saturating adds.
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import time
+
+import cv2
+import numpy as np
+
+from speedcam.config import DEFAULTS
+from speedcam.sources import FrameSource
+from speedcam.speed import FEET_PER_SECOND_TO_MPH, feet_per_pixel
+
+LTR = 'ltr'
+RTL = 'rtl'
+REFERENCE_WIDTH = 640  # vehicle sizes are given for this frame width and scaled with it
+NOISE_ROWS = 64  # distinct noise offsets
+
+
+def scaled_area(width, height):
+    """
+    :return: the default monitored_area, which is for 640x480, scaled to a frame size
+    """
+    x1, y1, x2, y2 = DEFAULTS['monitored_area']
+    sx, sy = width / float(REFERENCE_WIDTH), height / 480.0
+    return int(x1 * sx), int(y1 * sy), int(x2 * sx), int(y2 * sy)
+
+
+class Lane(object):
+    """
+    One direction of traffic, in its own band of rows across the monitored area.
+    """
+
+    def __init__(self, direction, top, bottom, step_per_mph):
+        self.direction = direction
+        self.top = top
+        self.bottom = bottom
+        self.step_per_mph = step_per_mph  # pixels per frame at 1 mph
+        self.next_arrival = 0.0  # frame
+        self.last = None  # the vehicle most recently started, which the next one must not catch
+
+
+class TrafficGenerator(object):
+    """
+    Renders frames of a road with known traffic and records it.
+    """
+
+    def __init__(self, width=640, height=480, fps=30.0, box=None, field_of_view=53.5, ltr_distance=27,
+                 rtl_distance=34, vehicles_per_minute=6.0, speeds=(15, 55), directions=(LTR, RTL), light=1.0,
+                 light_period=None, light_steps_per_minute=0.0, headlights_below=0.35, noise=4.0, duration=None,
+                 seed=0):
+        """
+        :param width: frame width in pixels, which is also the image_width of the speed calibration
+        :param height: frame height in pixels
+        :param fps: frame rate
+        :param box: monitored area, (upper left x, upper left y, lower right x, lower right y); by default
+            the default monitored_area scaled to the frame
+        :param field_of_view: horizontal field of view of the camera, in degrees
+        :param ltr_distance: distance to the left-to-right lane, in feet
+        :param rtl_distance: distance to the right-to-left lane, in feet
+        :param vehicles_per_minute: mean arrivals per minute in each direction
+        :param speeds: (slowest, fastest) mph, drawn uniformly
+        :param directions: LTR and/or RTL
+        :param light: brightness of the scene, 1.0 for full daylight
+        :param light_period: seconds of a full day-night-day cycle, or None for constant light
+        :param light_steps_per_minute: sudden changes of light per minute, like clouds
+        :param headlights_below: light level under which vehicles have their headlights on
+        :param noise: standard deviation of the sensor noise, in grey levels
+        :param duration: seconds to generate, or None for no end
+        :param seed: for the traffic, the light and the noise
+        """
+        self.width = width
+        self.height = height
+        self.fps = float(fps)
+        self.box = tuple(box or scaled_area(width, height))
+        self.field_of_view = field_of_view
+        self.vehicles_per_minute = vehicles_per_minute
+        self.speeds = tuple(speeds)
+        self.light = light
+        self.light_period = light_period
+        self.light_steps_per_minute = light_steps_per_minute
+        self.headlights_below = headlights_below
+        self.noise = noise
+        self.frames_total = None if duration is None else int(round(duration * self.fps))
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        self.scale = width / float(REFERENCE_WIDTH)
+
+        # one band of rows per direction, apart enough that passing vehicles stay separate blobs
+        x1, y1, x2, y2 = self.box
+        rows = y2 - y1
+        bands = {LTR: (y1 + int(0.05 * rows), y1 + int(0.40 * rows)),
+                 RTL: (y1 + int(0.60 * rows), y2 - int(0.05 * rows))}
+        if len(directions) == 1:
+            bands = {directions[0]: (y1 + int(0.15 * rows), y2 - int(0.15 * rows))}
+        distances = {LTR: ltr_distance, RTL: rtl_distance}
+        self.lanes = []
+        for direction in directions:
+            top, bottom = bands[direction]
+            step = 1.0 / FEET_PER_SECOND_TO_MPH / feet_per_pixel(distances[direction], width, field_of_view) / self.fps
+            lane = Lane(direction, top, bottom, step)
+            lane.next_arrival = self._headway()
+            self.lanes.append(lane)
+
+        self.vehicles = []  # on screen or waiting to enter
+        self.truth = []
+        self.index = 0
+        self._cloud = 1.0
+        self._cloud_target = 1.0
+        self._road = self._draw_road()
+        self._noise_up, self._noise_down = self._noise_field()
+
+    def _headway(self):
+        if self.vehicles_per_minute <= 0:
+            return float('inf')
+        return self.rng.exponential(60.0 / self.vehicles_per_minute) * self.fps
+
+    def _draw_road(self):
+        rng = np.random.RandomState(self.seed)
+        road = rng.randint(70, 140, (self.height, self.width, 3)).astype(np.uint8)
+        kernel = max(int(9 * self.scale) | 1, 3)
+        road = cv2.GaussianBlur(road, (kernel, kernel), 0)
+        # kerb lines above and below the monitored area, and a dashed centre line between the lanes
+        x1, y1, x2, y2 = self.box
+        thickness = max(int(2 * self.scale), 1)
+        cv2.line(road, (0, y1 - 2 * thickness), (self.width, y1 - 2 * thickness), (190, 190, 190), thickness)
+        cv2.line(road, (0, y2 + 2 * thickness), (self.width, y2 + 2 * thickness), (190, 190, 190), thickness)
+        if len(self.lanes) == 2:
+            middle = (self.lanes[0].bottom + self.lanes[1].top) // 2
+            dash = int(20 * self.scale)
+            for x in range(0, self.width, 2 * dash):
+                cv2.line(road, (x, middle), (x + dash, middle), (160, 160, 160), thickness)
+        return road
+
+    def _noise_field(self):
+        if not self.noise:
+            return None, None
+        rng = np.random.RandomState(self.seed + 1)
+        field = rng.normal(0.0, self.noise, (self.height + NOISE_ROWS, self.width, 3))
+        return (np.clip(field, 0, 255).astype(np.uint8), np.clip(-field, 0, 255).astype(np.uint8))
+
+    def light_level(self, seconds):
+        """
+        :param seconds: time into the scene
+        :return: brightness of the scene, 1.0 for full daylight
+        """
+        level = self.light
+        if self.light_period:
+            level *= 0.55 + 0.45 * math.cos(2 * math.pi * seconds / self.light_period)
+        return max(level * self._cloud, 0.03)
+
+    def _spawn(self, lane):
+        """
+        Starts a vehicle in a lane, no earlier than it can go without catching the one ahead.
+        """
+        mph = float(self.rng.uniform(*self.speeds))
+        step = mph * lane.step_per_mph
+        length = int(self.rng.randint(120, 260) * self.scale)
+        dark = self.rng.rand() < 0.5
+        colour = tuple(int(c) for c in (self.rng.randint(0, 50, 3) if dark else self.rng.randint(170, 256, 3)))
+        start = lane.next_arrival
+        gap = 30 * self.scale
+        leader = lane.last
+        if leader is not None:
+            leaves = leader['start'] + (self.width + leader['length']) / leader['step']
+            start = max(start, leader['start'] + (leader['length'] + gap) / leader['step'],
+                        leaves - (self.width - gap) / step)
+
+        x1, y1, x2, y2 = self.box
+        centre = (x1 + x2) / 2.0
+        if lane.direction == LTR:
+            entered, middle, left = x1 / step, (centre + length / 2.0) / step, (x2 + length) / step
+        else:
+            entered = (self.width - x2) / step
+            middle = (self.width + length / 2.0 - centre) / step
+            left = (self.width - x1 + length) / step
+        vehicle = dict(id=len(self.truth) + 1, lane=lane, direction=lane.direction, speed=mph, step=step,
+                       length=length, colour=colour, start=start, end=start + (self.width + length) / step)
+        self.truth.append(dict(id=vehicle['id'], time=(start + middle) / self.fps, speed=mph,
+                               direction=lane.direction, entered=(start + entered) / self.fps,
+                               left=(start + left) / self.fps, length=length, colour=list(colour)))
+        self.vehicles.append(vehicle)
+        lane.last = vehicle
+        lane.next_arrival = start + self._headway()
+
+    def _draw_vehicle(self, image, vehicle, light, headlights):
+        lane, length = vehicle['lane'], vehicle['length']
+        travelled = (self.index - vehicle['start']) * vehicle['step']
+        if vehicle['direction'] == LTR:
+            front = travelled
+            back = front - length
+        else:
+            front = self.width - travelled
+            back = front + length
+        left, right = int(min(front, back)), int(max(front, back))
+        top, bottom = lane.top, lane.bottom
+        colour = tuple(int(c * light) for c in vehicle['colour'])
+        cv2.rectangle(image, (max(left, 0), top), (min(right, self.width - 1), bottom), colour, -1)
+        # windows, darker than the body
+        height = bottom - top
+        inset = max(int(length * 0.25), 1)
+        cv2.rectangle(image, (max(left + inset, 0), top + height // 4),
+                      (min(right - inset, self.width - 1), bottom - height // 4),
+                      tuple(c // 2 for c in colour), -1)
+        if headlights:
+            self._draw_lights(image, int(front), top, bottom, 1 if vehicle['direction'] == LTR else -1)
+
+    def _draw_lights(self, image, front, top, bottom, ahead):
+        """
+        Headlights at the front of a vehicle, and the glare they throw onto the road ahead of it.
+        """
+        height = bottom - top
+        radius = max(height // 6, 2)
+        for y in (top + height // 4, bottom - height // 4):
+            cv2.circle(image, (front, y), radius, (255, 255, 255), -1)
+        # the glare: a bright cone on the road, stronger near the car
+        reach = int(height * 3)
+        x_from, x_to = sorted((front, front + ahead * reach))
+        x_from, x_to = max(x_from, 0), min(x_to, self.width)
+        if x_to <= x_from:
+            return
+        y_from, y_to = max(top - height // 2, 0), min(bottom + height // 2, self.height)
+        xs = np.abs(np.arange(x_from, x_to) - front) / float(reach)
+        ys = (np.arange(y_from, y_to) - (top + bottom) / 2.0) / float(height)
+        glare = (170 * np.exp(-3 * xs)[np.newaxis, :] * np.exp(-4 * ys ** 2)[:, np.newaxis]).astype(np.uint8)
+        region = image[y_from:y_to, x_from:x_to]
+        cv2.add(region, cv2.merge((glare, glare, glare)), dst=region)
+
+    def render(self):
+        """
+        Draws the next frame.
+        :return: (BGR image, seconds into the scene), or None once the duration is over
+        """
+        if self.frames_total is not None and self.index >= self.frames_total:
+            return None
+        seconds = self.index / self.fps
+
+        # clouds: now and then the light steps to a new level, over a fraction of a second
+        if self.light_steps_per_minute and self.rng.rand() < self.light_steps_per_minute / 60.0 / self.fps:
+            self._cloud_target = float(self.rng.uniform(0.6, 1.0))
+        self._cloud += (self._cloud_target - self._cloud) * min(3.0 / self.fps, 1.0)
+        light = self.light_level(seconds)
+        headlights = light < self.headlights_below
+
+        for lane in self.lanes:
+            while lane.next_arrival <= self.index:
+                self._spawn(lane)
+        self.vehicles = [v for v in self.vehicles if v['end'] > self.index]
+
+        image = cv2.convertScaleAbs(self._road, alpha=light)
+        for vehicle in self.vehicles:
+            if vehicle['start'] <= self.index:
+                self._draw_vehicle(image, vehicle, light, headlights)
+        if self._noise_up is not None:
+            rows = self.height
+            up, down = self.rng.randint(0, NOISE_ROWS, 2)
+            cv2.add(image, self._noise_up[up:up + rows], dst=image)
+            cv2.subtract(image, self._noise_down[down:down + rows], dst=image)
+
+        self.index += 1
+        return image, seconds
+
+    def frames(self):
+        """
+        :return: generator of (BGR image, seconds into the scene) until the duration is over
+        """
+        while True:
+            frame = self.render()
+            if frame is None:
+                return
+            yield frame
+
+    def manifest(self, video=None, start_time=None):
+        """
+        Ground truth of the vehicles that have left the monitored area so far.
+        :param video: name of the video file the frames were written to, if any
+        :param start_time: datetime of the first frame, when the frames were timestamped
+        :return: dict, see benchmarks.detection
+        """
+        seconds = self.index / self.fps
+        manifest = dict(
+            fps=self.fps, resolution=[self.width, self.height], monitored_area=list(self.box),
+            field_of_view=self.field_of_view, seed=self.seed, frames=self.index,
+            vehicles=[vehicle for vehicle in self.truth if vehicle['left'] <= seconds])
+        if video is not None:
+            manifest['video'] = video
+        if start_time is not None:
+            manifest['start_time'] = start_time.isoformat()
+        return manifest
+
+
+class SyntheticSource(FrameSource):
+    """
+    Generated frames, timestamped as if captured at the generator's frame rate.
+    """
+
+    def __init__(self, generator, realtime=False, start_time=None, manifest_path=None):
+        """
+        :param generator: TrafficGenerator
+        :param realtime: deliver frames at the generator's rate instead of unthrottled
+        :param start_time: datetime of the first frame; defaults to now
+        :param manifest_path: JSON file the ground truth is written to on close, or None
+        """
+        super(SyntheticSource, self).__init__((generator.width, generator.height), generator.fps)
+        self.generator = generator
+        self.realtime = realtime
+        self.start_time = start_time
+        self.manifest_path = manifest_path
+
+    def open(self):
+        if self.start_time is None:
+            self.start_time = datetime.datetime.now()
+        return self
+
+    def close(self):
+        if self.manifest_path is not None and self.start_time is not None:
+            write_manifest(self.manifest_path, self.generator.manifest(start_time=self.start_time))
+
+    def frames(self):
+        wall_start = time.time()
+        for image, seconds in self.generator.frames():
+            if self.realtime:
+                delay = seconds - (time.time() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield self._make_frame(image, self.start_time + datetime.timedelta(seconds=seconds))
+
+    def set_framerate(self, framerate):
+        pass  # The scene is generated at one rate
+
+
+def write_manifest(path, manifest):
+    """
+    Writes a manifest atomically.
+    :return: None
+    """
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temporary, path)
+
+
+def generator_from_config(config):
+    """
+    The TrafficGenerator for frame_source 'synthetic'. The default monitored_area, which is for
+    640x480, is scaled to image_width x image_height; any other must fit in the frame.
+    :param config: Config
+    :return: TrafficGenerator, whose box is the monitored area to detect in
+    """
+    width, height = config.resolution
+    box = tuple(config.monitored_area)
+    if box == tuple(DEFAULTS['monitored_area']):
+        box = scaled_area(width, height)
+    x1, y1, x2, y2 = box
+    if not (0 <= x1 < x2 <= width and 0 <= y1 < y2 <= height):
+        raise ValueError("monitored_area {0} does not fit in the {1}x{2} synthetic frames".format(box, width, height))
+    return TrafficGenerator(width, height, config.day_fps, box,
+                            config.field_of_view, config.ltr_distance, config.rtl_distance,
+                            config.synthetic_vehicles_per_minute, config.synthetic_speeds,
+                            light_period=config.synthetic_light_period,
+                            light_steps_per_minute=config.synthetic_light_steps_per_minute,
+                            noise=config.synthetic_noise, duration=config.synthetic_duration,
+                            seed=config.synthetic_seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic road video and its ground truth.")
+    parser.add_argument('video', help="MJPG .avi to write; the manifest goes next to it as .json")
+    parser.add_argument('--seconds', type=float, default=60.0)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--fps', type=float, default=30.0)
+    parser.add_argument('--traffic', type=float, default=6.0, help="vehicles per minute in each direction")
+    parser.add_argument('--light-period', type=float, help="seconds of a full day-night cycle")
+    parser.add_argument('--clouds', type=float, default=0.0, help="sudden changes of light per minute")
+    parser.add_argument('--noise', type=float, default=4.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    generator = TrafficGenerator(args.width, args.height, args.fps, vehicles_per_minute=args.traffic,
+                                 light_period=args.light_period, light_steps_per_minute=args.clouds,
+                                 noise=args.noise, duration=args.seconds, seed=args.seed)
+    writer = cv2.VideoWriter(args.video, cv2.VideoWriter_fourcc(*'MJPG'), args.fps, (args.width, args.height))
+    if not writer.isOpened():
+        raise IOError("Could not write {0}".format(args.video))
+    started = time.time()
+    try:
+        for image, seconds in generator.frames():
+            writer.write(image)
+    finally:
+        writer.release()
+    elapsed = time.time() - started
+
+    path = os.path.splitext(args.video)[0] + '.json'
+    write_manifest(path, generator.manifest(video=os.path.basename(args.video)))
+    print("{0} frames ({1:.0f} FPS including encoding), {2} vehicles; ground truth in {3}".format(
+        generator.index, generator.index / elapsed, len(generator.manifest()['vehicles']), path))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
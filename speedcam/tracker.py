@@ -0,0 +1,203 @@
+"""
+Multi-vehicle tracking.
+
+Every blob found in the monitored area is associated with a track by the
+distance between its centre and where each track is expected to be, so
+vehicles travelling in both directions can be followed at the same time.
+A track finishes when its front edge reaches the far side of the monitored
+area (it exited) or when it goes unseen for a few frames (it was lost).
+
+Per-frame cost is bounded by max_detections and max_tracks, and each track
+keeps its positions in fixed-size arrays.
+"""
+
+import numpy as np
+
+UNKNOWN = 0
+LEFT_TO_RIGHT = 1
+RIGHT_TO_LEFT = 2
+
+
+class Track(object):
+    """
+    One vehicle followed through the monitored area.
+    """
+
+    def __init__(self, track_id, box, blob, timestamp, capacity=128):
+        self.id = track_id
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.times = np.zeros(capacity, dtype=np.float64)  # seconds since first_seen
+        self.xs = np.zeros(capacity, dtype=np.int32)
+        self.widths = np.zeros(capacity, dtype=np.int32)
+        self.count = 0
+        self.missed = 0
+        self.exited = False
+        self.box = box
+        self.blob = blob
+        self.add(box, blob, timestamp)
+
+    def add(self, box, blob, timestamp):
+        """
+        Records where the vehicle was seen.
+        :param box: (x, y, w, h) bounding box in monitored-area coordinates
+        :param blob: identifies the blob in the frame, e.g. its label, kept for colour extraction
+        :param timestamp: capture time of the frame
+        :return: None
+        """
+        x, y, w, h = box
+        if self.count < len(self.times):  # once the history is full, only the latest box is kept
+            self.times[self.count] = (timestamp - self.first_seen).total_seconds()
+            self.xs[self.count] = x
+            self.widths[self.count] = w
+            self.count += 1
+        self.box = box
+        self.blob = blob
+        self.last_seen = timestamp
+        self.missed = 0
+
+    @property
+    def centroid(self):
+        x, y, w, h = self.box
+        return x + w / 2.0, y + h / 2.0
+
+    @property
+    def direction(self):
+        if self.count < 2:
+            return UNKNOWN
+        start = self.xs[0] + self.widths[0] / 2.0
+        end = self.xs[self.count - 1] + self.widths[self.count - 1] / 2.0
+        return LEFT_TO_RIGHT if end >= start else RIGHT_TO_LEFT
+
+    def front_edges(self):
+        """
+        x of the front of the vehicle throughout its history.
+        :return: array of x for right-to-left travel, x + w for left-to-right
+        """
+        if self.direction == RIGHT_TO_LEFT:
+            return self.xs[:self.count]
+        return self.xs[:self.count] + self.widths[:self.count]
+
+    def predict(self, timestamp):
+        """
+        Where the centre of the vehicle is expected to be at a given time.
+        :param timestamp: capture time of the frame
+        :return: (x, y)
+        """
+        cx, cy = self.centroid
+        if self.count < 2:
+            return cx, cy
+
+        last, previous = self.count - 1, self.count - 2
+        dt = self.times[last] - self.times[previous]
+        if dt <= 0:
+            return cx, cy
+        velocity = ((self.xs[last] + self.widths[last] / 2.0) -
+                    (self.xs[previous] + self.widths[previous] / 2.0)) / dt
+        return cx + velocity * (timestamp - self.last_seen).total_seconds(), cy
+
+
+class CentroidTracker(object):
+    """
+    Associates blobs with tracks frame by frame.
+    """
+
+    def __init__(self, width, max_distance=120, max_missed=3, edge_margin=2, max_tracks=8,
+                 max_detections=16, history=128, interval=None):
+        """
+        :param width: width of the monitored area in pixels
+        :param max_distance: furthest, in pixels, a blob may be from a track's predicted centre
+        :param interval: seconds after which max_distance applies; a track unseen for longer may be
+            further off in proportion, as its first frames are when the camera was idling. None: always
+        :param max_missed: frames a track may go unseen before it is dropped
+        :param edge_margin: a track whose front edge comes this close to the far side has exited
+        :param max_tracks: most vehicles followed at once
+        :param max_detections: most blobs, largest first, considered per frame
+        :param history: positions kept per track
+        """
+        self.width = width
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.edge_margin = edge_margin
+        self.max_tracks = max_tracks
+        self.max_detections = max_detections
+        self.history = history
+        self.interval = interval
+        self.tracks = []
+        self.next_id = 1
+
+    def clear(self):
+        self.tracks = []
+
+    def _has_exited(self, track):
+        x, y, w, h = track.box
+        if track.direction == RIGHT_TO_LEFT:
+            return x <= self.edge_margin
+        if track.direction == LEFT_TO_RIGHT:
+            return x + w >= self.width - self.edge_margin
+        return False
+
+    def _gating_distance(self, track, timestamp):
+        if self.interval is None:
+            return self.max_distance
+        elapsed = (timestamp - track.last_seen).total_seconds()
+        return self.max_distance * max(1.0, elapsed / self.interval)
+
+    def update(self, boxes, blobs, timestamp):
+        """
+        Feeds the blobs found in one frame to the tracker.
+        :param boxes: list of (x, y, w, h) bounding boxes
+        :param blobs: what identifies each blob, matching boxes
+        :param timestamp: capture time of the frame
+        :return: (tracks seen this frame, tracks that finished this frame)
+        """
+        if len(boxes) > self.max_detections:
+            order = sorted(range(len(boxes)), key=lambda i: boxes[i][2] * boxes[i][3], reverse=True)
+            keep = order[:self.max_detections]
+            boxes = [boxes[i] for i in keep]
+            blobs = [blobs[i] for i in keep]
+
+        matched_tracks = set()
+        matched_boxes = set()
+        if self.tracks and boxes:
+            predicted = np.array([track.predict(timestamp) for track in self.tracks])
+            centres = np.array([(x + w / 2.0, y + h / 2.0) for x, y, w, h in boxes])
+            distances = np.hypot(predicted[:, None, 0] - centres[None, :, 0],
+                                 predicted[:, None, 1] - centres[None, :, 1])
+            gating = np.array([self._gating_distance(track, timestamp) for track in self.tracks])
+
+            # Greedy assignment, closest pairs first
+            for flat in np.argsort(distances, axis=None):
+                t, b = np.unravel_index(flat, distances.shape)
+                if distances[t, b] > gating.max():
+                    break
+                if distances[t, b] > gating[t] or t in matched_tracks or b in matched_boxes:
+                    continue
+                self.tracks[t].add(boxes[b], blobs[b], timestamp)
+                matched_tracks.add(t)
+                matched_boxes.add(b)
+
+        seen = [self.tracks[t] for t in sorted(matched_tracks)]
+        finished = []
+        active = []
+        for index, track in enumerate(self.tracks):
+            if index not in matched_tracks:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    finished.append(track)
+                    continue
+            elif self._has_exited(track):
+                track.exited = True
+                finished.append(track)
+                continue
+            active.append(track)
+
+        for b, box in enumerate(boxes):
+            if b not in matched_boxes and len(active) < self.max_tracks:
+                track = Track(self.next_id, box, blobs[b], timestamp, self.history)
+                self.next_id += 1
+                active.append(track)
+                seen.append(track)
+
+        self.tracks = active
+        return seen, finished
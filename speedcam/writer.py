@@ -0,0 +1,153 @@
+"""
+Asynchronous detection writer.
+
+The detection loop hands finished vehicles to a DetectionWriter, which
+queues them and writes them in bulk to a sink from its own thread: either
+straight to the database (DatabaseSink) or to the local spool (see
+spool.py) that is forwarded to the database separately. A flush happens
+when batch_size records are waiting or flush_interval seconds have passed,
+whichever comes first. submit() never blocks: if the queue is full because
+the database cannot keep up, the record is dropped and counted.
+
+Rows carry a track_key, and rows whose key is already stored are skipped by
+the database, so writing a batch twice is harmless.
+"""
+
+import queue
+import threading
+import time
+
+
+class DatabaseSink(object):
+    """
+    Inserts batches of rows into a table.
+    """
+
+    def __init__(self, engine, table):
+        """
+        :param engine: SQLAlchemy engine
+        :param table: Table (or mapped class) with a unique track_key column
+        """
+        self.engine = engine
+        self.table = getattr(table, '__table__', table)
+
+    def write(self, rows):
+        """
+        Inserts a batch in one transaction as a single executemany.
+        :param rows: list of dicts of column values
+        :return: None
+        """
+        from db import insert_ignoring_duplicates
+
+        with self.engine.begin() as connection:
+            connection.execute(insert_ignoring_duplicates(self.table, connection.dialect), rows)
+
+
+class DetectionWriter(threading.Thread):
+    """
+    Writes rows to a sink in batches on a background thread.
+    """
+
+    def __init__(self, sink, batch_size=50, flush_interval=5.0, maxsize=10000, metrics=None):
+        """
+        :param sink: object with a write(rows) method, e.g. DatabaseSink or Spool
+        :param batch_size: flush once this many rows are waiting
+        :param flush_interval: flush at least this often, in seconds, while rows are waiting
+        :param maxsize: rows that may wait before submit() starts dropping them
+        :param metrics: Metrics to time each write into as the 'db_write' stage, or None
+        """
+        super(DetectionWriter, self).__init__(name="detection-writer")
+        self.daemon = True
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize)
+        self.metrics = metrics
+
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.max_depth = 0
+        self.last_flush = None
+        self.last_flush_seconds = 0.0
+        self.last_error = None
+
+        self._stop_event = threading.Event()
+
+    def submit(self, row):
+        """
+        Queues a row for writing. Never waits on the database.
+        :param row: dict of column values
+        :return: True if the row was queued, False if it was dropped.
+        """
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def flush(self, rows):
+        started = time.time()
+        try:
+            self.sink.write(rows)
+        except Exception as e:  # Keep running; the sink may recover
+            self.failed += len(rows)
+            self.last_error = e
+            print("Write of {0} vehicles failed: {1}".format(len(rows), e))
+        else:
+            self.written += len(rows)
+            self.flushes += 1
+            self.last_flush = time.time()
+        self.last_flush_seconds = time.time() - started
+        if self.metrics is not None:
+            self.metrics.observe('db_write', self.last_flush_seconds)
+
+    def run(self):
+        rows = []
+        deadline = None
+        while not (self._stop_event.is_set() and self.queue.empty()):
+            timeout = self.flush_interval if deadline is None else max(0.0, deadline - time.time())
+            try:
+                rows.append(self.queue.get(timeout=timeout))
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+            except queue.Empty:
+                pass
+
+            if rows and (len(rows) >= self.batch_size or time.time() >= deadline):
+                self.flush(rows)
+                rows = []
+                deadline = None
+
+        if rows:
+            self.flush(rows)
+
+    def stop(self, timeout=None):
+        """
+        Flushes whatever is waiting and stops the thread.
+        :param timeout: seconds to wait for the final flush
+        :return: None
+        """
+        self._stop_event.set()
+        self.join(timeout)
+
+    def stats(self):
+        """
+        :return: dict of writer counters, for back-pressure monitoring
+        """
+        return {
+            'depth': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'submitted': self.submitted,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'flushes': self.flushes,
+            'last_flush_seconds': self.last_flush_seconds,
+        }